@@ -0,0 +1,154 @@
+"""
+Attaches the files in a ZIP archive to the documents whose ids match their
+file names.
+
+Entries are streamed from the archive to CouchDB one at a time without
+extracting them. Uploads run on a pool of threads, each reading from its own
+handle on the archive, and the revisions of the documents to attach files to
+are fetched in batches ahead of the uploads.
+"""
+import mimetypes
+import os
+import posixpath
+import threading
+import zipfile
+from cStringIO import StringIO
+
+from couchdbkit.resource import ResourceError, escape_docid
+from restkit.util import url_quote
+
+# Rules for deriving the id of the document to attach an archive entry to
+# from the entry's path within the archive.
+FILENAME_RULES = (
+    ("stem", "File name without extension (sp-1.jpg attaches to sp-1)"),
+    ("name", "File name (sp-1.jpg attaches to sp-1.jpg)"),
+    ("path", "Path without extension (labels/sp-1.jpg attaches to labels/sp-1)"),
+)
+
+
+def document_id(entry_name, rule):
+    """
+    Returns the id of the document the archive entry with the given path
+    belongs to according to the given filename rule.
+    """
+    if rule == "path":
+        return posixpath.splitext(entry_name)[0]
+
+    name = posixpath.basename(entry_name)
+    if rule == "stem":
+        return posixpath.splitext(name)[0]
+
+    return name
+
+
+class EntryStream(object):
+    """
+    Reads an archive entry for upload. Only ``read`` is exposed because the
+    uploader rewinds bodies that can seek and archive entries can't.
+    """
+    def __init__(self, entry):
+        self.entry = entry
+
+    def read(self, size=-1):
+        return self.entry.read(size)
+
+    def close(self):
+        self.entry.close()
+
+
+class ArchiveReader(object):
+    """
+    Opens a separate ``ZipFile`` for each thread that reads from an archive,
+    because a ``ZipFile`` can only read one entry at a time.
+    """
+    def __init__(self, file):
+        if isinstance(file, basestring):
+            path = file
+        elif hasattr(file, "temporary_file_path"):
+            path = file.temporary_file_path()
+        else:
+            # Small uploads are kept in memory by Django.
+            path = None
+            data = file.read()
+
+        if path is not None:
+            self.open_file = lambda: open(path, "rb")
+        else:
+            self.open_file = lambda: StringIO(data)
+
+        self.local = threading.local()
+        self.archives = []
+        self.lock = threading.Lock()
+
+    def archive(self):
+        archive = getattr(self.local, "archive", None)
+        if archive is None:
+            archive = self.local.archive = zipfile.ZipFile(self.open_file())
+            with self.lock:
+                self.archives.append(archive)
+
+        return archive
+
+    def entries(self):
+        """
+        Returns the ``ZipInfo`` of each file in the archive in archive order.
+        """
+        return [info for info in self.archive().infolist()
+                if not info.filename.endswith("/")]
+
+    def open(self, info):
+        return EntryStream(self.archive().open(info))
+
+    def close(self):
+        with self.lock:
+            for archive in self.archives:
+                archive.fp.close()
+                archive.close()
+
+            self.archives = []
+
+
+def attach_entries(database, reader, doc_id, rev, infos):
+    """
+    Uploads the given archive entries in order as attachments of the document
+    with the given id and revision, and returns a tuple of the entry name and
+    an error message or None for each entry.
+    """
+    results = []
+    for info in infos:
+        if rev is None:
+            results.append((info.filename,
+                            "There is no document with id '%s'." % doc_id))
+            continue
+
+        name = posixpath.basename(info.filename)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        try:
+            stream = reader.open(info)
+            try:
+                response = database.res(escape_docid(doc_id)).put(
+                    url_quote(name, safe=""),
+                    payload=stream,
+                    headers={"Content-Type": content_type,
+                             "Content-Length": str(info.file_size)},
+                    rev=rev
+                )
+                rev = response.json_body["rev"]
+            finally:
+                stream.close()
+        except (ResourceError, zipfile.BadZipfile, IOError, OSError), e:
+            results.append((info.filename, str(e) or e.__class__.__name__))
+        else:
+            results.append((info.filename, None))
+
+    return results
+
+
+def is_archive(file):
+    """
+    Returns True if the given uploaded file is a ZIP archive.
+    """
+    try:
+        return zipfile.is_zipfile(file)
+    finally:
+        file.seek(0, os.SEEK_SET)
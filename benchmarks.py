@@ -0,0 +1,326 @@
+"""
+Benchmarks for measuring the throughput of Cushion's data import and the
+latency of its pages.
+
+Benchmarks that need a database run against a ``FakeCouchDB`` with generated
+datasets, so Cushion's own cost and the number of round trips it makes show up
+without a CouchDB server. Its ``latency`` simulates a remote server.
+"""
+from contextlib import contextmanager
+import os
+import random
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.test.client import RequestFactory
+
+import couch
+import views
+from fakecouch import FakeCouchDB
+from forms import ImportDataForm
+from importer import coerce_rows, coerce_rows_parallel, read_csv
+from models import registry as registered_models
+
+SPECIMEN_COLUMNS = (
+    "genus",
+    "species",
+    "latitude",
+    "longitude",
+    "year",
+    "month",
+    "day",
+    "collector",
+    "collection",
+    "elevation",
+    "elevation_units",
+    "notes"
+)
+
+
+def write_specimen_csv(fh, rows, seed=0):
+    """
+    Writes a header and the given number of rows of synthetic Specimen data to
+    the given file object.
+    """
+    generator = random.Random(seed)
+    fh.write("%s\n" % ",".join(SPECIMEN_COLUMNS))
+
+    for i in xrange(rows):
+        fh.write("%s\n" % ",".join((
+            "Genus%i" % generator.randint(0, 50),
+            "species%i" % generator.randint(0, 500),
+            "%.5f" % generator.uniform(-90, 90),
+            "%.5f" % generator.uniform(-180, 180),
+            str(generator.randint(1900, 2010)),
+            str(generator.randint(1, 12)),
+            str(generator.randint(1, 28)),
+            "Collector %i" % generator.randint(0, 100),
+            generator.choice(("RBC", "UBC", "UCB")),
+            str(generator.randint(0, 3000)),
+            generator.choice(("m.", "ft.")),
+            "Specimen %i" % i
+        )))
+
+
+def time_coercion(path, results_for_rows):
+    """
+    Returns the number of seconds it takes to read and coerce every row of the
+    CSV file at the given path with the given function.
+    """
+    fh = open(path, "rU")
+    try:
+        start = time.time()
+        column_names, rows = read_csv(fh, ",")
+        for line_num, doc, error in results_for_rows(column_names, rows):
+            pass
+        return time.time() - start
+    finally:
+        fh.close()
+
+
+def benchmark_coercion(rows=50000, processes=None):
+    """
+    Compares the throughput of serial, columnar, and parallel coercion of the
+    given number of rows of synthetic Specimen data and returns a list of
+    tuples of the method name, seconds, and rows per second.
+    """
+    model = registered_models["Specimen"]
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    fh = os.fdopen(fd, "w")
+    try:
+        write_specimen_csv(fh, rows)
+        fh.close()
+
+        timings = (
+            ("serial", time_coercion(
+                path,
+                lambda column_names, rows: coerce_rows(model, column_names,
+                                                       rows, columnar=False)
+            )),
+            ("columnar", time_coercion(
+                path,
+                lambda column_names, rows: coerce_rows(model, column_names, rows)
+            )),
+            ("parallel", time_coercion(
+                path,
+                lambda column_names, rows: coerce_rows_parallel(
+                    "Specimen",
+                    column_names,
+                    rows,
+                    processes
+                )
+            )),
+        )
+    finally:
+        fh.close()
+        os.remove(path)
+
+    return [(name, seconds, rows / seconds) for name, seconds in timings]
+
+
+@contextmanager
+def fake_server(latency=0, row_latency=0):
+    """
+    Runs a fake CouchDB server and points Cushion at it for the duration of
+    the block.
+    """
+    server = FakeCouchDB(latency, row_latency).start()
+    original_url = settings.COUCHDB_SERVER
+    settings.COUCHDB_SERVER = server.url
+    couch.reset()
+    try:
+        yield server
+    finally:
+        settings.COUCHDB_SERVER = original_url
+        couch.reset()
+        server.stop()
+
+
+def specimen_docs(count, seed=0):
+    """
+    Yields the given number of synthetic Specimen documents.
+    """
+    generator = random.Random(seed)
+    for i in xrange(count):
+        yield {
+            "_id": "specimen-%08i" % i,
+            "doc_type": "Specimen",
+            "genus": "Genus%i" % generator.randint(0, 50),
+            "species": "species%i" % generator.randint(0, 500),
+            "latitude": generator.uniform(-90, 90),
+            "longitude": generator.uniform(-180, 180),
+            "elevation": generator.randint(0, 10000),
+            "notes": "Specimen %i" % i
+        }
+
+
+def by_genus(doc):
+    if doc.get("doc_type") == "Specimen":
+        yield [doc["genus"], doc["species"]], doc["elevation"]
+
+
+class BenchmarkUser(AnonymousUser):
+    """
+    A user that passes ``login_required`` without a user database.
+    """
+    pk = None
+
+    def is_authenticated(self):
+        return True
+
+
+def page_request(path, data=None):
+    """
+    Returns a GET request for a Cushion page by a logged in user.
+    """
+    request = RequestFactory().get(path, data or {})
+    request.user = BenchmarkUser()
+    request.session = {}
+    request._messages = CookieStorage(request)
+    return request
+
+
+def time_requests(view, requests, *args):
+    """
+    Returns the number of seconds it takes to respond to each of the given
+    requests with the given view function, with view results cached by
+    Cushion cleared before each request.
+    """
+    start = time.time()
+    for request in requests:
+        couch.view_cache.clear()
+        response = view(request, *args)
+        if response.status_code != 200:
+            raise AssertionError("%s responded with %i."
+                                 % (request.path, response.status_code))
+
+    return time.time() - start
+
+
+def benchmark_import(rows=20000, latency=0, batch_size=1000, processes=None):
+    """
+    Compares the throughput of streamed imports of the given number of rows
+    of synthetic Specimen data, coerced serially and in parallel, and returns
+    a list of tuples of the method name, seconds, and rows per second.
+    """
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    fh = os.fdopen(fd, "w")
+    try:
+        write_specimen_csv(fh, rows)
+        fh.close()
+
+        timings = []
+        for name, parallel in (("import", False), ("parallel import", True)):
+            with fake_server(latency) as server:
+                database = couch.get_database("benchmark_import")
+                form = ImportDataForm.for_options({
+                    "model": "Specimen",
+                    "delimiter": ",",
+                    "overwrite": False,
+                    "skip_duplicates": True,
+                    "stream": True,
+                    "batch_size": batch_size,
+                    "parallel": parallel
+                })
+
+                start = time.time()
+                errors = form.import_data(database, path)
+                timings.append((name, time.time() - start))
+                if errors:
+                    raise AssertionError("The import failed: %s"
+                                         % (errors[:1],))
+    finally:
+        fh.close()
+        os.remove(path)
+
+    return [(name, seconds, rows / seconds) for name, seconds in timings]
+
+
+def benchmark_empty_database(docs=20000, latency=0):
+    """
+    Compares the time it takes to empty a database of the given number of
+    documents by deleting them and by recreating the database, and returns a
+    list of tuples of the method name, seconds, and documents per second.
+    """
+    timings = []
+    for name, empty in (("empty", views.empty_database),
+                        ("recreate", views.recreate_database)):
+        with fake_server(latency) as server:
+            server.save_docs("benchmark_empty", specimen_docs(docs))
+            server.add_view("benchmark_empty", "specimens", "by_genus",
+                            by_genus)
+
+            start = time.time()
+            empty("benchmark_empty")
+            timings.append((name, time.time() - start))
+
+    return [(name, seconds, docs / seconds) for name, seconds in timings]
+
+
+def benchmark_index_page(databases=50, requests=10, latency=0.005):
+    """
+    Measures the time it takes to render the index page listing the given
+    number of databases, and returns a list of a tuple of the page name,
+    seconds per page, and pages per second.
+    """
+    with fake_server(latency) as server:
+        for i in xrange(databases):
+            server.save_docs("benchmark_%03i" % i, specimen_docs(10, i))
+
+        seconds = time_requests(
+            views.index,
+            [page_request("/") for i in xrange(requests)]
+        )
+
+    return [("index page", seconds / requests, requests / seconds)]
+
+
+def benchmark_pagination(docs=100000, depths=(0, 1000, 10000, 90000),
+                         requests=3, limit=10, latency=0,
+                         row_latency=0.000002):
+    """
+    Measures the time it takes to render a page of a view at each of the given
+    depths, with pages found by skipping rows and by starting at the key of
+    the previous page's last row, and returns a list of tuples of the paging
+    method and depth, seconds per page, and pages per second.
+
+    ``row_latency`` is the number of seconds the fake server takes to read
+    each row, including skipped rows.
+    """
+    path = "/benchmark_pages/_design/specimens/_view/by_genus/"
+    args = ("benchmark_pages", "by_genus", "specimens")
+    timings = []
+    with fake_server(latency, row_latency) as server:
+        server.save_docs("benchmark_pages", specimen_docs(docs))
+        server.add_view("benchmark_pages", "specimens", "by_genus", by_genus)
+        database = couch.get_database("benchmark_pages")
+
+        # Build the view before timing pages of it.
+        database.view("specimens/by_genus", limit=1).first()
+
+        for depth in depths:
+            data = {"skip": depth, "limit": limit}
+            timings.append(("skip %i" % depth, time_requests(
+                views.view,
+                [page_request(path, data) for i in xrange(requests)],
+                *args
+            )))
+
+            data = {"paging": "keyset", "limit": limit}
+            if depth:
+                previous = database.view("specimens/by_genus", skip=depth - 1,
+                                         limit=1).first()
+                data["after"] = views.row_position(previous)
+
+            timings.append(("keyset %i" % depth, time_requests(
+                views.view,
+                [page_request(path, data) for i in xrange(requests)],
+                *args
+            )))
+
+    return [(name, seconds / requests, requests / seconds)
+            for name, seconds in timings]
+
@@ -0,0 +1,177 @@
+"""
+Compacts databases and their view indexes and reports on compactions in
+progress.
+
+CouchDB compacts in the background, so ``compact`` only starts the compaction
+of a database, of the view indexes of each of its design documents, and the
+removal of index files no longer used by any view. Their progress is read
+from the server's active tasks.
+
+``compact_fragmented`` compacts the databases whose files have grown to a
+multiple of the size of their data one at a time, for running regularly with
+the ``cushion_compact`` command.
+"""
+import logging
+import re
+import time
+
+from couchdbkit.exceptions import ResourceNotFound
+from restkit.errors import ResourceError
+
+from couch import all_dbs, views_by_design_doc
+
+log = logging.getLogger(__name__)
+
+COMPACTION_TASKS = ("database_compaction", "view_compaction")
+
+# Seconds to wait between checks for running compactions.
+POLL_INTERVAL = 10
+
+# Seconds to wait for a requested compaction to show up as running.
+START_TIMEOUT = 60
+
+
+def task_database(task):
+    """
+    Returns the name of the database the given active task is working on.
+    CouchDB 2 and later name the file of a shard of the database instead.
+    """
+    database_name = task.get("database", "")
+    match = re.match(r"^shards/[^/]+/(.+)\.\d+$", database_name)
+    if match:
+        return match.group(1)
+
+    return database_name
+
+
+def compaction_tasks(server, database_name=None):
+    """
+    Returns the running compactions of the given database or of every
+    database. Compactions of shards of the same database are reported
+    separately.
+    """
+    return [task for task in server.active_tasks()
+            if task.get("type") in COMPACTION_TASKS and
+            (database_name is None or task_database(task) == database_name)]
+
+
+def visible_compaction_tasks(server, database_name):
+    """
+    Returns the running compactions of the given database, or an empty list
+    if they can't be read, as only server admins can read the active tasks.
+    """
+    try:
+        return compaction_tasks(server, database_name)
+    except ResourceError, e:
+        log.debug("Couldn't read the active tasks: %s" % e)
+        return []
+
+
+def wait_for_compactions(server, database_name=None, interval=POLL_INTERVAL):
+    """
+    Returns once the given database, or every database, has no compactions
+    running, checking every given number of seconds.
+    """
+    while compaction_tasks(server, database_name):
+        time.sleep(interval)
+
+
+def wait_for_compaction(server, database, disk_size, interval=POLL_INTERVAL,
+                        timeout=START_TIMEOUT):
+    """
+    Returns once the compactions just started for the given database have
+    finished, checking every given number of seconds.
+
+    CouchDB can take a moment to register a compaction, so compactions only
+    count as finished once they were seen running, or once the database file
+    has shrunk from the given size. If neither happens within ``timeout``
+    seconds, the compactions are taken to have finished unseen.
+    """
+    started = time.time()
+    seen = False
+    while True:
+        info = database.info()
+        if info.get("compact_running") or \
+           compaction_tasks(server, database.dbname):
+            seen = True
+        elif seen or file_sizes(info)[0] < disk_size or \
+             time.time() - started > timeout:
+            return
+
+        time.sleep(interval)
+
+
+def compact(database):
+    """
+    Starts compacting the given database and the view indexes of each of its
+    design documents, and removing index files of views that no longer exist.
+    """
+    database.compact()
+    for design_doc_name in views_by_design_doc(database):
+        database.compact(design_doc_name)
+
+    database.view_cleanup()
+
+
+def file_sizes(info):
+    """
+    Returns a tuple of the size of a database's file and the size of the
+    data in it from the given database info. Either is None if the server
+    doesn't report it.
+    """
+    if "sizes" in info:
+        return info["sizes"].get("file"), info["sizes"].get("active")
+
+    return info.get("disk_size"), info.get("data_size")
+
+
+def fragmentation(info):
+    """
+    Returns the ratio of the size of a database's file to the size of the
+    data in it from the given database info, or None if it isn't known.
+    """
+    disk_size, data_size = file_sizes(info)
+    if disk_size is None or not data_size:
+        return None
+
+    return disk_size / float(data_size)
+
+
+def compact_fragmented(server, threshold, min_size=0, database_names=None,
+                       interval=POLL_INTERVAL):
+    """
+    Compacts each of the given databases, or every database, whose file is
+    at least ``min_size`` bytes and more than ``threshold`` times the size of
+    its data. Only one compaction runs at a time: each database is compacted
+    once no other compactions are running on the server, and is waited for
+    before the next is started. Databases that don't exist are skipped.
+
+    Returns a list of a tuple of the name and fragmentation of each database
+    compacted.
+    """
+    compacted = []
+    for database_name in database_names or all_dbs():
+        if database_name.startswith("_"):
+            continue
+
+        # Look the database up without creating it if it doesn't exist.
+        database = server[database_name]
+        try:
+            info = database.info()
+        except ResourceNotFound:
+            log.warning("Database '%s' doesn't exist" % database_name)
+            continue
+
+        ratio = fragmentation(info)
+        disk_size = file_sizes(info)[0]
+        if ratio is None or ratio <= threshold or disk_size < min_size:
+            continue
+
+        wait_for_compactions(server, interval=interval)
+        log.info("Compacting database '%s' at %.2f times the size of its data"
+                 % (database_name, ratio))
+        compact(database)
+        wait_for_compaction(server, database, disk_size, interval)
+        compacted.append((database_name, ratio))
+
+    return compacted
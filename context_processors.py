@@ -0,0 +1,28 @@
+from django.conf import settings
+
+from couch import recorded_calls
+
+
+def couch_timing(request):
+    """
+    Adds the CouchDB requests recorded so far while handling the request to
+    the context as ``couchdb_timing`` if ``CUSHION_TIMING_PANEL`` is set,
+    which defaults to ``DEBUG``. Requests are only recorded by
+    ``CouchTimingMiddleware``.
+    """
+    if not getattr(settings, "CUSHION_TIMING_PANEL", settings.DEBUG):
+        return {}
+
+    calls = recorded_calls()
+    if calls is None:
+        return {}
+
+    calls = [dict(call, duration_ms=call["duration"] * 1000)
+             for call in calls]
+    return {"couchdb_timing": {
+        "calls": calls,
+        "count": len(calls),
+        "duration_ms": sum([call["duration_ms"] for call in calls]),
+        "bytes_in": sum([call["bytes_in"] for call in calls]),
+        "bytes_out": sum([call["bytes_out"] for call in calls])
+    }}
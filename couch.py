@@ -0,0 +1,395 @@
+"""
+Process-wide access to the CouchDB server at ``COUCHDB_SERVER``.
+
+All requests share one ``Server`` whose connections are kept alive in a pool,
+and a short-lived list of known databases so database handles can be looked
+up without asking the server whether the database exists.
+
+View results are kept in memory and revalidated with the ETag CouchDB sent
+with them, so unchanged results are not transferred or decoded again.
+
+Independent requests can be made at the same time on a shared pool of
+threads with ``concurrently``.
+
+Requests to CouchDB made by a thread can be recorded with their method, path,
+status, size, and duration between ``start_recording`` and ``stop_recording``.
+"""
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from couchdbkit import Server
+from couchdbkit.resource import CouchDBResponse, CouchdbResource, encode_params
+from django.conf import settings
+from django.utils import simplejson
+from restkit import Resource
+from restkit.errors import ResourceError
+
+from utils import LRUCache, gather
+
+_server = None
+_databases = {}
+_databases_fetched = 0
+_lock = threading.RLock()
+_pool = None
+
+# Revisions of design documents and their view names by database name.
+_design_docs = {}
+
+# Results of recently requested views by database name, view path and query
+# parameters.
+view_cache = LRUCache(getattr(settings, "CUSHION_VIEW_CACHE_SIZE", 100))
+
+# The list of CouchDB requests being recorded by each thread, if any.
+_recording = threading.local()
+
+
+def start_recording():
+    """
+    Starts recording the CouchDB requests made by the current thread.
+    """
+    _recording.calls = []
+
+
+def stop_recording():
+    """
+    Stops recording the CouchDB requests made by the current thread and
+    returns the requests recorded.
+    """
+    calls = recorded_calls()
+    _recording.calls = None
+    return calls or []
+
+
+def recorded_calls():
+    """
+    Returns the list of CouchDB requests recorded so far by the current
+    thread, or None if the thread isn't recording.
+    """
+    return getattr(_recording, "calls", None)
+
+
+def recorded(function):
+    """
+    Returns a function that calls the given function with its CouchDB requests
+    recorded along with those of the current thread, for running on another
+    thread such as one of a pool.
+    """
+    calls = recorded_calls()
+    if calls is None:
+        return function
+
+    def call(*args, **kwargs):
+        previous = recorded_calls()
+        _recording.calls = calls
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _recording.calls = previous
+
+    return call
+
+
+class RecordedResponse(CouchDBResponse):
+    """
+    Adds the size of the body and the time taken to read it to the recorded
+    request it answers, if any.
+    """
+    call = None
+
+    def body_string(self, charset=None, unicode_errors="strict"):
+        start = time.time()
+        body = CouchDBResponse.body_string(self, charset, unicode_errors)
+        if self.call is not None:
+            self.call["bytes_in"] = len(body)
+            self.call["duration"] += time.time() - start
+
+        return body
+
+
+class RecordedResource(CouchdbResource):
+    """
+    A CouchDB resource that records the method, path, status, bytes sent and
+    received, and duration of each request made while the current thread is
+    recording.
+    """
+    def __init__(self, uri="http://127.0.0.1:5984", **client_opts):
+        # ``CouchdbResource`` always sets its own response class.
+        client_opts["response_class"] = RecordedResponse
+        Resource.__init__(self, uri=uri, **client_opts)
+        self.safe = ":/%"
+
+    def request(self, method, path=None, payload=None, headers=None,
+                **params):
+        calls = recorded_calls()
+        if calls is None:
+            return CouchdbResource.request(self, method, path, payload,
+                                           headers, **params)
+
+        headers = headers or {}
+        if payload is not None and not hasattr(payload, "read") and \
+           not isinstance(payload, basestring):
+            payload = simplejson.dumps(payload).encode("utf-8")
+            headers.setdefault("Content-Type", "application/json")
+
+        if isinstance(payload, basestring):
+            bytes_out = len(payload)
+        else:
+            bytes_out = int(headers.get("Content-Length") or 0)
+
+        call = {
+            "method": method,
+            "path": "/".join([urlparse.urlsplit(self.uri).path.rstrip("/"),
+                              (path or "").lstrip("/")]).rstrip("/") or "/",
+            "status": None,
+            "bytes_out": bytes_out,
+            "bytes_in": 0,
+            "duration": 0
+        }
+        calls.append(call)
+
+        start = time.time()
+        try:
+            response = CouchdbResource.request(self, method, path, payload,
+                                               headers, **params)
+        except ResourceError, e:
+            call["status"] = e.status_int
+            raise
+        finally:
+            call["duration"] += time.time() - start
+
+        call["status"] = response.status_int
+        call["bytes_in"] = int(response.headers.get("content-length") or 0)
+        response.call = call
+        return response
+
+
+def get_server():
+    """
+    Returns the shared server, creating it on first use with a connection
+    pool of ``CUSHION_POOL_SIZE`` connections and a socket timeout of
+    ``CUSHION_TIMEOUT`` seconds.
+    """
+    global _server
+
+    with _lock:
+        if _server is None:
+            _server = Server(
+                settings.COUCHDB_SERVER,
+                resource_class=RecordedResource,
+                pool_size=getattr(settings, "CUSHION_POOL_SIZE", 10),
+                timeout=getattr(settings, "CUSHION_TIMEOUT", 300)
+            )
+
+    return _server
+
+
+def get_pool():
+    """
+    Returns the shared pool of threads for making CouchDB requests at the same
+    time, creating it on first use with ``CUSHION_FANOUT_THREADS`` threads.
+    """
+    global _pool
+
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, "CUSHION_FANOUT_THREADS", 20))
+
+    return _pool
+
+
+def concurrently(functions, timeout=None, return_exceptions=False):
+    """
+    Calls each of the given functions without arguments on the shared pool at
+    the same time and returns their results in order, as ``utils.gather``
+    does. The CouchDB requests the functions make are recorded along with
+    those of the current thread.
+
+    Functions called this way must not call ``concurrently`` themselves, as
+    they could wait forever for a thread of a pool they are all using.
+    """
+    return gather(get_pool(),
+                  [recorded(function) for function in functions],
+                  timeout=timeout,
+                  return_exceptions=return_exceptions)
+
+
+def reset():
+    """
+    Forgets the shared server, the known databases, and cached design
+    documents and views, so the next request connects to ``COUCHDB_SERVER``
+    again.
+    """
+    global _server, _databases, _databases_fetched
+
+    with _lock:
+        _server = None
+        _databases = {}
+        _databases_fetched = 0
+        _design_docs.clear()
+
+    view_cache.clear()
+
+
+def all_dbs():
+    """
+    Returns the names of the databases on the server, asking the server again
+    only when the list is older than ``CUSHION_DATABASES_TTL`` seconds.
+    """
+    global _databases, _databases_fetched
+
+    ttl = getattr(settings, "CUSHION_DATABASES_TTL", 10)
+    with _lock:
+        if time.time() - _databases_fetched <= ttl:
+            return sorted(_databases.keys())
+
+    # Ask the server without holding the lock, so a slow response doesn't
+    # hold up other threads.
+    database_names = get_server().all_dbs()
+
+    with _lock:
+        _databases = dict([(database_name, _databases.get(database_name))
+                           for database_name in database_names])
+        _databases_fetched = time.time()
+        return sorted(_databases.keys())
+
+
+def get_database(database_name):
+    """
+    Returns a handle for the database with the given name. The database is
+    created if it isn't known to exist.
+    """
+    all_dbs()
+
+    with _lock:
+        database = _databases.get(database_name)
+        known = database_name in _databases
+
+    if database is not None:
+        return database
+
+    server = get_server()
+    if known:
+        database = server[database_name]
+    else:
+        database = server.get_or_create_db(database_name)
+
+    with _lock:
+        # Keep the handle of another thread that got there first.
+        if _databases.get(database_name) is None:
+            _databases[database_name] = database
+
+        return _databases[database_name]
+
+
+def forget_database(database_name):
+    """
+    Removes the database with the given name from the known databases and
+    drops its cached views after it has been deleted.
+    """
+    with _lock:
+        _databases.pop(database_name, None)
+        _design_docs.pop(database_name, None)
+
+    for key in view_cache.keys():
+        if key[0] == database_name:
+            view_cache.delete(key)
+
+
+def design_doc_revisions(database):
+    return dict([(row["id"], row["value"]["rev"])
+                 for row in database.all_docs(startkey="_design",
+                                              endkey="_design0")])
+
+
+def views_by_design_doc(database):
+    """
+    Returns the sorted view names of each design document in the given
+    database by design document name.
+
+    Design documents are fetched together in one request and cached until the
+    revision of one of them changes. Once cached, checking for changes only
+    needs a request for the revisions of the design documents.
+    """
+    with _lock:
+        cached = _design_docs.get(database.dbname)
+
+    if cached is not None and cached[0] == design_doc_revisions(database):
+        return cached[1]
+
+    # Fetch all documents defining a key range that includes only design
+    # documents.
+    revisions = {}
+    views = {}
+    for row in database.all_docs(startkey="_design", endkey="_design0",
+                                 include_docs=True):
+        doc = row["doc"]
+        revisions[row["id"]] = doc["_rev"]
+        if "views" in doc:
+            # Convert "_design/mydesigndoc" to "mydesigndoc".
+            design_doc_name = row["id"].split("/")[1]
+            views[design_doc_name] = sorted(doc["views"].keys())
+
+    with _lock:
+        _design_docs[database.dbname] = (revisions, views)
+
+    return views
+
+
+class ViewResults(object):
+    """
+    The rows of a view request along with the view's total number of rows and
+    the ETag CouchDB sent with them.
+    """
+    def __init__(self, result, etag):
+        self.rows = result.get("rows", [])
+        self.total_rows = result.get("total_rows", len(self.rows))
+        self.offset = result.get("offset", 0)
+        self.etag = etag
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def get_view_path(view_name):
+    """
+    Returns the path of the given view relative to its database, where view
+    names are "_all_docs" or "designname/viewname".
+    """
+    if view_name.startswith("_"):
+        return view_name
+
+    design_doc_name, view_name = view_name.split("/", 1)
+    return "_design/%s/_view/%s" % (design_doc_name, view_name)
+
+
+def view(database, view_name, **params):
+    """
+    Returns the results of the given view with the given query parameters.
+
+    Results are cached by database, view and query parameters. A cached result
+    is revalidated by sending its ETag with the request, so CouchDB only sends
+    the rows again when the view has changed since.
+    """
+    view_path = get_view_path(view_name)
+    key = (database.dbname, view_path,
+           tuple(sorted(encode_params(params).items())))
+
+    cached = view_cache.get(key)
+    headers = {}
+    if cached is not None and cached.etag:
+        headers["If-None-Match"] = cached.etag
+
+    response = database.res.get(view_path, headers=headers, **params)
+    if response.status_int == 304:
+        return cached
+
+    results = ViewResults(response.json_body, response.headers.get("etag"))
+    if results.etag:
+        view_cache.set(key, results)
+
+    return results
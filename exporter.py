@@ -0,0 +1,127 @@
+"""
+Exports the rows of views as CSV or newline-delimited JSON.
+
+Rows are read one page at a time, each page starting at the key and document
+id of the last row of the previous page, so exports of any size use the same
+memory and every page costs the same to read no matter how far into the view
+it is.
+"""
+import csv
+from cStringIO import StringIO
+import itertools
+
+from django.utils import simplejson
+
+from models import registry as registered_models
+from utils import batches
+
+# Number of rows to read from CouchDB per request.
+PAGE_SIZE = 1000
+
+# Content types of the export formats.
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8"
+}
+
+# Number of bytes of CSV data to send at a time.
+CHUNK_SIZE = 64 * 1024
+
+# Document fields left out of CSV exports.
+INTERNAL_FIELDS = ("_id", "_rev", "_attachments", "doc_type")
+
+
+def view_rows(database, view_name, params, page_size=PAGE_SIZE):
+    """
+    Yields every row of the given view with the given query parameters.
+    """
+    params = dict(params)
+    start = None
+
+    while True:
+        if start is not None:
+            params["startkey"] = start["key"]
+            if "id" in start:
+                params["startkey_docid"] = start["id"]
+            params["skip"] = 1
+
+        rows = list(database.view(view_name, limit=page_size, **params))
+        for row in rows:
+            yield row
+
+        if len(rows) < page_size:
+            return
+
+        start = rows[-1]
+
+
+def csv_value(value):
+    if value is None:
+        return ""
+    elif isinstance(value, unicode):
+        return value.encode("utf-8")
+    elif isinstance(value, (dict, list, bool)):
+        return simplejson.dumps(value)
+
+    return str(value)
+
+
+def model_columns(model, docs):
+    """
+    Returns the CSV columns for documents of the given model: the document id,
+    the model's properties, and any other fields found in the given documents.
+    """
+    properties = sorted(model._properties.keys())
+    extra_fields = set()
+    for doc in docs:
+        extra_fields.update(doc.keys())
+
+    extra_fields.difference_update(properties)
+    extra_fields.difference_update(INTERNAL_FIELDS)
+    return ["_id"] + properties + sorted(extra_fields)
+
+
+def export_csv(rows, model_name=None):
+    """
+    Yields the given view rows as chunks of CSV data. Rows are written with
+    their id, key, and value unless a registered model is given, in which case
+    the documents included with the rows are written with the model's
+    properties as columns.
+    """
+    rows = iter(rows)
+    model = registered_models.get(model_name) if model_name else None
+
+    if model is None:
+        columns = ["id", "key", "value"]
+        first_rows = []
+        get_values = lambda row: [row.get("id"), row["key"], row["value"]]
+    else:
+        # Fields that aren't properties of the model are found in the first
+        # page of documents.
+        first_rows = list(itertools.islice(rows, PAGE_SIZE))
+        columns = model_columns(model, [row.get("doc") or {}
+                                        for row in first_rows])
+        get_values = lambda row: [(row.get("doc") or {}).get(column)
+                                  for column in columns]
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for row in itertools.chain(first_rows, rows):
+        writer.writerow([csv_value(value) for value in get_values(row)])
+
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export_ndjson(rows):
+    """
+    Yields the given view rows as lines of JSON, a page of rows at a time.
+    """
+    for page in batches(rows, PAGE_SIZE):
+        yield "".join(["%s\n" % simplejson.dumps(row) for row in page])
@@ -0,0 +1,932 @@
+"""
+An in-process stand-in for a CouchDB server, for benchmarks and tests that
+need Cushion's real client code to talk to a database without running
+CouchDB.
+
+``FakeCouchDB`` serves the parts of the CouchDB HTTP API that Cushion uses
+from memory on a local port: databases, documents, ``_all_docs`` including
+``keys`` lookups, ``_bulk_docs``, views, attachments with ranges, and the
+``_changes`` feed including long polling. Views are defined with Python map
+functions that yield a key and value for each document. Every request can be
+delayed by a fixed or computed number of seconds to simulate a remote server.
+
+Keys are collated by type like CouchDB, but strings are compared by code point
+rather than with the Unicode Collation Algorithm.
+"""
+import base64
+import BaseHTTPServer
+import bisect
+import hashlib
+import itertools
+import re
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+from django.utils import simplejson
+
+
+class HTTPError(Exception):
+    """
+    An error response with a CouchDB error name and reason.
+    """
+    def __init__(self, status, error, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+
+def not_found(reason="missing"):
+    return HTTPError(404, "not_found", reason)
+
+
+def conflict():
+    return HTTPError(409, "conflict", "Document update conflict.")
+
+
+def collation_key(value):
+    """
+    Returns a key that sorts JSON values in CouchDB's view collation order:
+    null, false, true, numbers, strings, arrays, and objects.
+    """
+    if value is None:
+        return (0,)
+    elif value is False:
+        return (1,)
+    elif value is True:
+        return (2,)
+    elif isinstance(value, (int, long, float)):
+        return (3, value)
+    elif isinstance(value, basestring):
+        return (4, value)
+    elif isinstance(value, (list, tuple)):
+        return (5, tuple([collation_key(item) for item in value]))
+
+    return (6, tuple([(key, collation_key(item))
+                      for key, item in value.items()]))
+
+
+def json_param(params, name, default=None):
+    if name not in params:
+        return default
+
+    try:
+        return simplejson.loads(params[name])
+    except ValueError:
+        raise HTTPError(400, "bad_request",
+                        "Invalid JSON for '%s'." % name)
+
+
+def bool_param(params, name, default=False):
+    if name not in params:
+        return default
+
+    return params[name] == "true"
+
+
+def int_param(params, name, default=None):
+    if name not in params:
+        return default
+
+    try:
+        return int(params[name])
+    except ValueError:
+        raise HTTPError(400, "bad_request",
+                        "Invalid number for '%s'." % name)
+
+
+class SortedRows(object):
+    """
+    View rows sorted by collated key and document id, with the lookups needed
+    to answer queries by key range or by keys.
+    """
+    def __init__(self, rows):
+        """
+        Takes a list of (key, id, value) tuples in any order.
+        """
+        rows = sorted([(collation_key(key), id, key, value)
+                       for key, id, value in rows])
+        self.sort_keys = [row[0] for row in rows]
+        self.ids = [row[1] for row in rows]
+        self.rows = [(key, id, value) for sort_key, id, key, value in rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def position(self, key, docid=None, right=False):
+        """
+        Returns the index of the first row after (if ``right``) or at the
+        given key and, if given, document id.
+        """
+        sort_key = collation_key(key)
+        if docid is None:
+            if right:
+                return bisect.bisect_right(self.sort_keys, sort_key)
+            return bisect.bisect_left(self.sort_keys, sort_key)
+
+        low = bisect.bisect_left(self.sort_keys, sort_key)
+        high = bisect.bisect_right(self.sort_keys, sort_key, low)
+        if right:
+            return bisect.bisect_right(self.ids, docid, low, high)
+        return bisect.bisect_left(self.ids, docid, low, high)
+
+    def with_key(self, key):
+        """
+        Returns the rows with the given key.
+        """
+        return self.rows[self.position(key):self.position(key, right=True)]
+
+    def query(self, params):
+        """
+        Returns the offset of the first row, the rows selected by the key
+        range, direction, skip, and limit of the given query parameters, and
+        the number of rows read to find them including skipped rows.
+        """
+        descending = bool_param(params, "descending")
+        inclusive_end = bool_param(params, "inclusive_end", True)
+
+        if "key" in params:
+            key = json_param(params, "key")
+            startkey = endkey = key
+            has_start = has_end = True
+        else:
+            has_start = "startkey" in params or "start_key" in params
+            has_end = "endkey" in params or "end_key" in params
+            startkey = json_param(params, "startkey",
+                                  json_param(params, "start_key"))
+            endkey = json_param(params, "endkey",
+                                json_param(params, "end_key"))
+
+        startkey_docid = params.get("startkey_docid",
+                                    params.get("start_key_doc_id"))
+        endkey_docid = params.get("endkey_docid",
+                                  params.get("end_key_doc_id"))
+
+        low, high = 0, len(self.rows)
+        if not descending:
+            if has_start:
+                low = self.position(startkey, startkey_docid)
+            if has_end:
+                high = self.position(endkey, endkey_docid, inclusive_end)
+            offset = low
+        else:
+            if has_start:
+                high = self.position(startkey, startkey_docid, True)
+            if has_end:
+                low = self.position(endkey, endkey_docid, not inclusive_end)
+            offset = len(self.rows) - high
+
+        high = max(low, high)
+        skip = min(max(int_param(params, "skip", 0), 0), high - low)
+        limit = int_param(params, "limit")
+        if limit is None:
+            limit = high - low
+        count = min(max(limit, 0), high - low - skip)
+
+        if descending:
+            stop = high - skip
+            rows = self.rows[stop - count:stop]
+            rows.reverse()
+        else:
+            rows = self.rows[low + skip:low + skip + count]
+
+        return offset + skip, rows, skip + count
+
+
+class FakeDatabase(object):
+    """
+    The documents, attachments, and changes of one database.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.attachments = {}
+        self.ids = []
+        self.security = {}
+
+        # The id of the document changed by each update in order, so the
+        # update with sequence ``n`` is at index ``n - 1``, and the sequence
+        # of the last update of each document.
+        self.log = []
+        self.seqs = {}
+
+        # Sizes of the JSON of the current revision of each document, and the
+        # size of every revision and attachment written since the last
+        # compaction.
+        self.sizes = {}
+        self.data_size = 0
+        self.disk_size = 0
+        self.view_rows = {}
+
+    @property
+    def update_seq(self):
+        return len(self.log)
+
+    def info(self):
+        return {
+            "db_name": self.name,
+            "doc_count": len(self.ids),
+            "doc_del_count": len(self.docs) - len(self.ids),
+            "update_seq": self.update_seq,
+            "purge_seq": 0,
+            "compact_running": False,
+            "disk_size": self.disk_size,
+            "data_size": self.data_size,
+            "instance_start_time": "0",
+            "disk_format_version": 5,
+            "committed_update_seq": self.update_seq
+        }
+
+    def get(self, doc_id, rev=None, attachments=False):
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            raise not_found()
+        elif doc.get("_deleted"):
+            raise not_found("deleted")
+        elif rev is not None and rev != doc["_rev"]:
+            raise not_found()
+
+        doc = dict(doc)
+        if attachments and "_attachments" in doc:
+            stored = self.attachments.get(doc_id, {})
+            doc["_attachments"] = dict([
+                (name, dict([(key, value) for key, value in info.items()
+                             if key != "stub"],
+                            data=base64.b64encode(stored[name])))
+                for name, info in doc["_attachments"].items()
+            ])
+
+        return doc
+
+    def save(self, doc, attachments=None):
+        """
+        Stores a new revision of the given document and returns its revision.
+        Inline attachment data is stored and replaced by stubs, and stubs keep
+        the data of the current revision. Attachments can also be replaced by
+        passing a dictionary of data by name.
+        """
+        doc_id = doc.get("_id")
+        if not doc_id:
+            doc_id = doc["_id"] = uuid.uuid4().hex
+
+        current = self.docs.get(doc_id)
+        if current is None:
+            if doc.get("_rev"):
+                raise conflict()
+            generation = 0
+        elif current.get("_deleted"):
+            if doc.get("_rev") not in (None, current["_rev"]):
+                raise conflict()
+            generation = int(current["_rev"].split("-")[0])
+        else:
+            if doc.get("_rev") != current["_rev"]:
+                raise conflict()
+            generation = int(current["_rev"].split("-")[0])
+
+        doc = dict(doc)
+        stored = self.attachments.get(doc_id, {})
+        if attachments is None:
+            attachments = {}
+            for name, info in (doc.get("_attachments") or {}).items():
+                if "data" in info:
+                    attachments[name] = (info.get("content_type"),
+                                         base64.b64decode(info["data"]))
+                elif name in stored:
+                    attachments[name] = (info.get("content_type"),
+                                         stored[name])
+                else:
+                    raise HTTPError(412, "missing_stub",
+                                    "Attachment '%s' has no data." % name)
+
+        doc.pop("_attachments", None)
+        encoded = simplejson.dumps(doc, sort_keys=True)
+        rev = "%i-%s" % (generation + 1, hashlib.md5(
+            "%s%s" % (current and current["_rev"], encoded)
+        ).hexdigest())
+        doc["_rev"] = rev
+
+        if attachments and not doc.get("_deleted"):
+            previous = (current or {}).get("_attachments") or {}
+            doc["_attachments"] = {}
+            for name, (content_type, data) in attachments.items():
+                info = previous.get(name)
+                if info is None or stored.get(name) != data:
+                    info = {"revpos": generation + 1}
+
+                doc["_attachments"][name] = {
+                    "content_type": content_type or "application/octet-stream",
+                    "revpos": info["revpos"],
+                    "digest": "md5-%s" % base64.b64encode(
+                        hashlib.md5(data).digest()
+                    ),
+                    "length": len(data),
+                    "stub": True
+                }
+            self.attachments[doc_id] = dict([
+                (name, data) for name, (content_type, data)
+                in attachments.items()
+            ])
+        else:
+            self.attachments.pop(doc_id, None)
+
+        if doc.get("_deleted"):
+            doc = {"_id": doc_id, "_rev": rev, "_deleted": True}
+
+        exists = current is not None and not current.get("_deleted")
+        if doc.get("_deleted") and exists:
+            self.ids.pop(bisect.bisect_left(self.ids, doc_id))
+        elif not doc.get("_deleted") and not exists:
+            bisect.insort(self.ids, doc_id)
+
+        size = len(encoded)
+        for name, (content_type, data) in (attachments or {}).items():
+            size += len(data)
+        self.disk_size += size
+
+        if doc.get("_deleted"):
+            size = 0
+        self.data_size += size - self.sizes.get(doc_id, 0)
+        self.sizes[doc_id] = size
+
+        self.docs[doc_id] = doc
+        self.log.append(doc_id)
+        self.seqs[doc_id] = self.update_seq
+
+        return doc_id, rev
+
+    def current_attachments(self, doc_id):
+        """
+        Returns the content type and data of each attachment of the current
+        revision of the given document by name.
+        """
+        doc = self.get(doc_id)
+        stored = self.attachments.get(doc_id, {})
+        return dict([(name, (info["content_type"], stored[name]))
+                     for name, info in (doc.get("_attachments") or {}).items()])
+
+    def all_docs(self):
+        """
+        Returns the rows of ``_all_docs`` without documents.
+        """
+        rows = self.view_rows.get("_all_docs")
+        if rows is None or rows[0] != self.update_seq:
+            rows = self.view_rows["_all_docs"] = (self.update_seq, SortedRows(
+                [(doc_id, doc_id, {"rev": self.docs[doc_id]["_rev"]})
+                 for doc_id in self.ids]
+            ))
+
+        return rows[1]
+
+    def view(self, path, map_function):
+        """
+        Returns the rows of the view at the given path with the given map
+        function, mapping every document again if any has changed since the
+        rows were last mapped.
+        """
+        rows = self.view_rows.get(path)
+        if rows is None or rows[0] != self.update_seq:
+            mapped = []
+            for doc_id in self.ids:
+                if doc_id.startswith("_design/"):
+                    continue
+
+                for key, value in map_function(self.docs[doc_id]) or ():
+                    mapped.append((key, doc_id, value))
+
+            rows = self.view_rows[path] = (self.update_seq,
+                                           SortedRows(mapped))
+
+        return rows[1]
+
+    def changes(self, since, limit=None, descending=False):
+        """
+        Returns the latest change of each document changed after the given
+        sequence as a list of the sequence and document id.
+        """
+        if descending:
+            seqs = xrange(self.update_seq, since, -1)
+        else:
+            seqs = xrange(since + 1, self.update_seq + 1)
+
+        changes = ((seq, self.log[seq - 1]) for seq in seqs)
+        return list(itertools.islice(
+            ((seq, doc_id) for seq, doc_id in changes
+             if self.seqs[doc_id] == seq),
+            limit
+        ))
+
+    def compact(self):
+        self.disk_size = self.data_size
+
+
+class FakeCouchDB(object):
+    """
+    Serves fake databases over HTTP on a local port from a background thread.
+
+    ``latency`` is the number of seconds every request is delayed by, or a
+    function of the request method and path returning the number of seconds.
+    Requests for ``_all_docs`` and views are further delayed by
+    ``row_latency`` seconds for every row read, including skipped rows, like
+    CouchDB reading through its B-tree.
+
+    The server reports the tasks in ``active_tasks`` as its running tasks.
+    Compactions finish as soon as they are requested.
+    """
+    def __init__(self, latency=0, row_latency=0, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.row_latency = row_latency
+        self.databases = {}
+        self.map_functions = {}
+        self.active_tasks = []
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.httpd = FakeCouchServer((host, port), FakeCouchHandler)
+        self.httpd.couch = self
+        self.url = "http://%s:%i" % self.httpd.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        with self.changed:
+            self.changed.notify_all()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def create_database(self, name):
+        with self.lock:
+            if name not in self.databases:
+                self.databases[name] = FakeDatabase(name)
+
+            return self.databases[name]
+
+    def add_view(self, database_name, design_doc_name, view_name,
+                 map_function):
+        """
+        Defines a view with a Python function that takes a document and
+        yields or returns a (key, value) pair for each row it emits. The view
+        is added to the design document, creating the database and design
+        document if needed, so Cushion lists it.
+        """
+        with self.lock:
+            database = self.create_database(database_name)
+            doc_id = "_design/%s" % design_doc_name
+            try:
+                doc = database.get(doc_id)
+            except HTTPError:
+                doc = {"_id": doc_id, "language": "python"}
+
+            doc.setdefault("views", {})[view_name] = {
+                "map": "%s.%s" % (map_function.__module__,
+                                  map_function.__name__)
+            }
+            database.save(doc)
+            self.map_functions[(database_name, design_doc_name,
+                                view_name)] = map_function
+            self.changed.notify_all()
+
+    def save_docs(self, database_name, docs):
+        """
+        Stores the given documents directly, without going through HTTP, for
+        setting up large datasets quickly. Returns the saved revisions.
+        """
+        with self.lock:
+            database = self.create_database(database_name)
+            revs = [database.save(doc)[1] for doc in docs]
+            self.changed.notify_all()
+            return revs
+
+    def delay(self, method, path):
+        if callable(self.latency):
+            seconds = self.latency(method, path)
+        else:
+            seconds = self.latency
+
+        if seconds:
+            time.sleep(seconds)
+
+
+class FakeCouchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # Accept as many connections at once as Cushion's pools may open, rather
+    # than the default of 5, which makes further clients retry after a second.
+    request_queue_size = 128
+
+
+class FakeCouchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers one HTTP request to the fake server with its JSON API.
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = "CouchDB/1.6.1 (fake)"
+
+    # Send each response in as few packets as possible.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_HEAD(self):
+        self.handle_method("HEAD")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+    def do_COPY(self):
+        self.handle_method("COPY")
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(";")[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return "".join(chunks)
+
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else ""
+
+    def handle_method(self, method):
+        couch = self.server.couch
+        url = urlparse.urlsplit(self.path)
+        segments = [urllib.unquote(segment).decode("utf-8")
+                    for segment in url.path.split("/") if segment]
+        params = dict([(name, value.decode("utf-8")) for name, value
+                       in urlparse.parse_qsl(url.query,
+                                             keep_blank_values=True)])
+        body = self.read_body()
+        headers = {}
+
+        couch.delay(method, url.path)
+        self.rows_read = 0
+        try:
+            status, result = self.route(couch, method, segments, params,
+                                        body, headers)
+        except NotModified:
+            status, result = 304, None
+        except HTTPError, e:
+            status, result = e.status, {"error": e.error, "reason": e.reason}
+        except Exception, e:
+            status, result = 500, {"error": "unknown_error", "reason": str(e)}
+
+        if isinstance(result, str):
+            data = result
+            headers.setdefault("Content-Type", "application/octet-stream")
+        elif result is None:
+            data = ""
+        else:
+            data = "%s\n" % simplejson.dumps(result)
+            headers.setdefault("Content-Type", "application/json")
+
+        if self.rows_read and couch.row_latency:
+            time.sleep(self.rows_read * couch.row_latency)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if method != "HEAD":
+            self.wfile.write(data)
+
+    def database(self, couch, name):
+        database = couch.databases.get(name)
+        if database is None:
+            raise not_found("no_db_file")
+        return database
+
+    def route(self, couch, method, segments, params, body, headers):
+        if not segments:
+            return 200, {"couchdb": "Welcome", "version": "1.6.1"}
+
+        name = segments[0]
+        if name == "_all_dbs":
+            with couch.lock:
+                return 200, sorted(couch.databases.keys())
+        elif name == "_active_tasks":
+            with couch.lock:
+                return 200, list(couch.active_tasks)
+        elif name == "_uuids":
+            count = int_param(params, "count", 1)
+            return 200, {"uuids": [uuid.uuid4().hex for i in xrange(count)]}
+
+        if len(segments) == 1:
+            return self.route_database(couch, method, name, params, body)
+
+        with couch.lock:
+            database = self.database(couch, name)
+            resource = segments[1]
+            rest = segments[2:]
+
+            if resource == "_all_docs":
+                keys = self.keys(params, body)
+                return 200, self.query_all_docs(database, params, keys,
+                                                headers)
+            elif resource == "_bulk_docs":
+                return 201, self.bulk_docs(couch, database, body)
+            elif resource == "_changes":
+                return self.changes(couch, database, params)
+            elif resource == "_security":
+                if method == "PUT":
+                    database.security = simplejson.loads(body)
+                    return 200, {"ok": True}
+                return 200, database.security
+            elif resource in ("_compact", "_view_cleanup",
+                              "_ensure_full_commit"):
+                if resource == "_compact" and not rest:
+                    database.compact()
+                return 202, {"ok": True}
+            elif resource == "_design":
+                if not rest:
+                    raise not_found()
+                doc_id = "_design/%s" % rest[0]
+                if len(rest) >= 3 and rest[1] == "_view":
+                    return 200, self.query_view(couch, database, rest[0],
+                                                rest[2], params,
+                                                self.keys(params, body),
+                                                headers)
+                rest = rest[1:]
+            else:
+                doc_id = resource
+
+            if rest:
+                return self.attachment(couch, database, method, doc_id,
+                                       "/".join(rest), params, body,
+                                       headers)
+
+            return self.document(couch, database, method, doc_id, params,
+                                 body, headers)
+
+    def route_database(self, couch, method, name, params, body):
+        with couch.lock:
+            if method == "PUT":
+                if name in couch.databases:
+                    raise HTTPError(412, "file_exists",
+                                    "The database could not be created, "
+                                    "the file already exists.")
+                if not re.match(r"^[a-z][a-z0-9_$()+/-]*$", name):
+                    raise HTTPError(400, "illegal_database_name",
+                                    "Name: '%s'." % name)
+                couch.create_database(name)
+                return 201, {"ok": True}
+            elif method == "DELETE":
+                self.database(couch, name)
+                del couch.databases[name]
+                for key in couch.map_functions.keys():
+                    if key[0] == name:
+                        del couch.map_functions[key]
+                return 200, {"ok": True}
+            elif method == "POST":
+                database = self.database(couch, name)
+                doc_id, rev = database.save(simplejson.loads(body))
+                couch.changed.notify_all()
+                return 201, {"ok": True, "id": doc_id, "rev": rev}
+
+            return 200, self.database(couch, name).info()
+
+    def keys(self, params, body):
+        if body:
+            return simplejson.loads(body).get("keys")
+        return json_param(params, "keys")
+
+    def etag(self, database, headers):
+        etag = '"%i"' % database.update_seq
+        headers["ETag"] = etag
+        if self.headers.get("If-None-Match") == etag:
+            raise NotModified()
+
+    def rows_result(self, database, rows, offset, total_rows, params,
+                    headers):
+        include_docs = bool_param(params, "include_docs")
+        results = []
+        for row in rows:
+            if isinstance(row, dict):
+                results.append(row)
+                continue
+
+            key, doc_id, value = row
+            result = {"id": doc_id, "key": key, "value": value}
+            if include_docs:
+                doc = database.docs.get(doc_id)
+                result["doc"] = doc if doc and not doc.get("_deleted") else None
+            results.append(result)
+
+        return {"total_rows": total_rows, "offset": offset, "rows": results}
+
+    def query_all_docs(self, database, params, keys, headers):
+        self.etag(database, headers)
+        rows = database.all_docs()
+        if keys is not None:
+            selected = []
+            for key in keys:
+                doc = database.docs.get(key)
+                if doc is None:
+                    selected.append({"key": key, "error": "not_found"})
+                elif doc.get("_deleted"):
+                    selected.append((key, key, {"rev": doc["_rev"],
+                                                "deleted": True}))
+                else:
+                    selected.append((key, key, {"rev": doc["_rev"]}))
+            self.rows_read = len(keys)
+            return self.rows_result(database, selected, 0, len(rows),
+                                    params, headers)
+
+        offset, selected, self.rows_read = rows.query(params)
+        return self.rows_result(database, selected, offset, len(rows),
+                                params, headers)
+
+    def query_view(self, couch, database, design_doc_name, view_name, params,
+                   keys, headers):
+        map_function = couch.map_functions.get((database.name,
+                                                design_doc_name, view_name))
+        if map_function is None:
+            raise not_found("missing_named_view")
+
+        self.etag(database, headers)
+        rows = database.view("%s/%s" % (design_doc_name, view_name),
+                             map_function)
+        if keys is not None:
+            selected = []
+            for key in keys:
+                selected.extend(rows.with_key(key))
+            offset = 0
+            self.rows_read = len(selected)
+        else:
+            offset, selected, self.rows_read = rows.query(params)
+
+        return self.rows_result(database, selected, offset, len(rows),
+                                params, headers)
+
+    def bulk_docs(self, couch, database, body):
+        results = []
+        for doc in simplejson.loads(body)["docs"]:
+            try:
+                doc_id, rev = database.save(doc)
+            except HTTPError, e:
+                results.append({"id": doc.get("_id"), "error": e.error,
+                                "reason": e.reason})
+            else:
+                results.append({"id": doc_id, "rev": rev})
+
+        couch.changed.notify_all()
+        return results
+
+    def document(self, couch, database, method, doc_id, params, body,
+                 headers):
+        if method in ("GET", "HEAD"):
+            doc = database.get(doc_id, params.get("rev"),
+                               bool_param(params, "attachments"))
+            headers["ETag"] = '"%s"' % doc["_rev"]
+            return 200, doc
+        elif method == "PUT":
+            doc = simplejson.loads(body)
+            doc["_id"] = doc_id
+            if "rev" in params:
+                doc["_rev"] = params["rev"]
+            doc_id, rev = database.save(doc)
+        elif method == "DELETE":
+            database.get(doc_id)
+            doc_id, rev = database.save({"_id": doc_id,
+                                         "_rev": params.get("rev"),
+                                         "_deleted": True})
+        else:
+            raise HTTPError(405, "method_not_allowed",
+                            "Only GET,HEAD,PUT,DELETE allowed")
+
+        couch.changed.notify_all()
+        return 201, {"ok": True, "id": doc_id, "rev": rev}
+
+    def attachment(self, couch, database, method, doc_id, name, params, body,
+                   headers):
+        if method in ("GET", "HEAD"):
+            return self.get_attachment(database, doc_id, name, headers)
+
+        try:
+            doc = database.get(doc_id)
+        except HTTPError:
+            if method != "PUT" or "rev" in params:
+                raise
+            doc = {"_id": doc_id}
+
+        if doc.get("_rev") != params.get("rev"):
+            raise conflict()
+
+        attachments = ("_rev" in doc and database.current_attachments(doc_id)
+                       or {})
+        if method == "PUT":
+            attachments[name] = (self.headers.get("Content-Type"), body)
+        elif method == "DELETE":
+            if attachments.pop(name, None) is None:
+                raise not_found()
+        else:
+            raise HTTPError(405, "method_not_allowed",
+                            "Only GET,HEAD,PUT,DELETE allowed")
+
+        doc_id, rev = database.save(doc, attachments)
+        couch.changed.notify_all()
+        return 201, {"ok": True, "id": doc_id, "rev": rev}
+
+    def get_attachment(self, database, doc_id, name, headers):
+        doc = database.get(doc_id)
+        info = (doc.get("_attachments") or {}).get(name)
+        if info is None:
+            raise not_found()
+
+        data = database.attachments[doc_id][name]
+        etag = '"%s"' % info["digest"]
+        headers.update({"ETag": etag,
+                        "Accept-Ranges": "bytes",
+                        "Content-Type": info["content_type"]})
+        if self.headers.get("If-None-Match") == etag:
+            raise NotModified()
+
+        match = re.match(r"^bytes=(\d*)-(\d*)$",
+                         self.headers.get("Range", ""))
+        if match is None or not any(match.groups()):
+            return 200, data
+
+        first, last = match.groups()
+        if first:
+            first = int(first)
+            last = min(int(last), len(data) - 1) if last else len(data) - 1
+        else:
+            first = max(len(data) - int(last), 0)
+            last = len(data) - 1
+
+        if first > last:
+            headers["Content-Range"] = "bytes */%i" % len(data)
+            raise HTTPError(416, "requested_range_not_satisfiable",
+                            "Requested range not satisfiable")
+
+        headers["Content-Range"] = "bytes %i-%i/%i" % (first, last, len(data))
+        return 206, data[first:last + 1]
+
+    def changes(self, couch, database, params):
+        since = int_param(params, "since", 0)
+        limit = int_param(params, "limit")
+        descending = bool_param(params, "descending")
+        include_docs = bool_param(params, "include_docs")
+
+        changes = database.changes(since, limit, descending)
+        if not changes and params.get("feed") == "longpoll":
+            deadline = time.time() + int_param(params, "timeout", 60000) / 1000.0
+            while not changes and time.time() < deadline:
+                couch.changed.wait(deadline - time.time())
+                if couch.databases.get(database.name) is not database:
+                    break
+                changes = database.changes(since, limit, descending)
+
+        results = []
+        for seq, doc_id in changes:
+            doc = database.docs[doc_id]
+            result = {"seq": seq, "id": doc_id,
+                      "changes": [{"rev": doc["_rev"]}]}
+            if doc.get("_deleted"):
+                result["deleted"] = True
+            if include_docs:
+                result["doc"] = doc
+            results.append(result)
+
+        if results:
+            last_seq = results[-1]["seq"]
+        else:
+            last_seq = since if not descending else 0
+
+        return 200, {"results": results, "last_seq": last_seq}
+
+
+class NotModified(HTTPError):
+    def __init__(self):
+        HTTPError.__init__(self, 304, None, "Not Modified")
@@ -1,22 +1,58 @@
-import csv
+import collections
 import difflib
 import logging
+from multiprocessing.pool import ThreadPool
 import pprint
-import traceback
 
 from couchdbkit.exceptions import BulkSaveError
 from django import forms
+from django.conf import settings
 from django.utils.datastructures import SortedDict
 
+from archives import (
+    FILENAME_RULES,
+    ArchiveReader,
+    attach_entries,
+    document_id,
+    is_archive
+)
+from couch import recorded
+from importer import (
+    DuplicateIndex,
+    coerce_rows,
+    coerce_rows_parallel,
+    existing_revisions,
+    existing_rows,
+    read_csv,
+    row_values
+)
+from jobs import AttachProgress, ImportProgress
 from models import (
     registry as registered_models,
-    Registry
+    Registry,
+    UniqueDocument
 )
+from utils import LRUCache, batches, map_ahead
 
 log = logging.getLogger(__name__)
 form_registry = Registry()
 view_form_registry = Registry()
 
+# Type to form field mappings for forms generated from documents.
+TYPE_TO_FIELD = {
+    int: forms.IntegerField,
+    float: forms.FloatField,
+    str: forms.CharField,
+    unicode: forms.CharField,
+    bool: forms.BooleanField
+}
+
+# Form classes generated from documents by their document type and field
+# names and types.
+document_form_cache = LRUCache(
+    getattr(settings, "CUSHION_FORM_CACHE_SIZE", 100)
+)
+
 
 class CreateDatabaseForm(forms.Form):
     name = forms.CharField(help_text="Note that only lowercase characters (a-z), digits (0-9), or any of the characters _, $, (, ), +, -, and / are allowed.")
@@ -46,96 +82,307 @@ class ImportDataForm(forms.Form):
         help_text="Optional delimiter for CSV records.",
         required=False,
     )
+    stream = forms.BooleanField(
+        required=False,
+        label="Save data in batches while reading the file",
+        help_text="Rows that can't be imported are reported without preventing the other rows from being saved."
+    )
+    batch_size = forms.IntegerField(
+        required=False,
+        min_value=1,
+        help_text="Optional number of documents to save at a time when saving in batches."
+    )
+    parallel = forms.BooleanField(
+        required=False,
+        label="Coerce rows in parallel",
+        help_text="Uses all processors to coerce rows for the selected model."
+    )
+    background = forms.BooleanField(
+        required=False,
+        label="Import in the background",
+        help_text="Shows the progress of the import on this page while it runs."
+    )
+    validate_only = forms.BooleanField(
+        required=False,
+        label="Only check the data",
+        help_text="Coerces every row and looks for duplicates without saving anything."
+    )
+
+    # Extension of the copy of the data file kept by background jobs and the
+    # class of their progress.
+    FILE_EXTENSION = "csv"
+    progress_class = ImportProgress
+
+    # Default number of documents sent to the database per bulk save when
+    # streaming data.
+    BATCH_SIZE = 1000
+
+    # Number of document ids to look up per request when checking for existing
+    # documents and the number of those requests to run at the same time.
+    WINDOW_SIZE = 1000
+    EXISTENCE_THREADS = 4
+
+    # Maximum number of errors kept when checking data. Errors beyond this are
+    # only counted.
+    MAX_VALIDATION_ERRORS = 1000
 
     def clean_delimiter(self):
         return self.DELIMITER_STRING_MAP[self.cleaned_data["delimiter"]]
 
-    def import_data(self, database, file):
+    def clean_batch_size(self):
+        return self.cleaned_data["batch_size"] or self.BATCH_SIZE
+
+    def options(self):
+        """
+        Returns the cleaned import options other than the uploaded file.
+        """
+        options = dict(self.cleaned_data)
+        options.pop("file", None)
+        return options
+
+    @classmethod
+    def for_options(cls, options):
+        """
+        Returns a form with the given cleaned import options to resume an
+        import with.
+        """
+        form = cls()
+        form.cleaned_data = dict([(str(key), value)
+                                  for key, value in options.items()])
+
+        # The csv module only accepts byte string delimiters.
+        form.cleaned_data["delimiter"] = str(form.cleaned_data["delimiter"])
+        return form
+
+    def import_data(self, database, file, progress=None, checkpoint=None):
         """
-        Parses the given file object as a CSV file and adds the contents to the
-        given database using the first row as attribute names for each column.
+        Parses the given file object or path as a CSV file and adds the
+        contents to the given database using the first row as attribute names
+        for each column.
+
+        If streaming was requested, documents are saved in batches while the
+        file is read instead of after the whole file has been read, so memory
+        use doesn't grow with the size of the file. A checkpoint is recorded in
+        the given ``ImportProgress``, if any, after each saved batch and an
+        import can be resumed from a checkpoint by passing it back to this
+        method.
+
+        If only checking the data was requested, every row is coerced and
+        checked for duplicates but nothing is saved, and errors are reported
+        in the compact form added by ``add_validation_error``.
         """
+        if progress is None:
+            progress = ImportProgress()
+
+        progress.validate_only = bool(self.cleaned_data.get("validate_only"))
+
+        if isinstance(file, basestring):
+            path = file
+        else:
+            path = file.temporary_file_path()
+
         # Open the file in universal-newline mode to support CSV files created
         # on different operating systems.
-        fh = open(file.temporary_file_path(), "rU")
+        fh = open(path, "rU")
+        errors = progress.errors
+
+        try:
+            if progress.validate_only:
+                for doc in self.read_documents(fh, errors, progress, checkpoint):
+                    pass
+            elif self.cleaned_data["stream"]:
+                positions = collections.deque()
+                documents = self.read_documents(fh, errors, progress,
+                                                checkpoint, positions)
+
+                # The first batch after a checkpoint may have been saved in part
+                # before the import stopped. Document ids don't change between
+                # runs, so it is safe to save that batch again over any of its
+                # documents that were saved.
+                replay = checkpoint is not None
+
+                for batch in batches(documents, self.cleaned_data["batch_size"]):
+                    errors.extend(self.save_documents(database, batch,
+                                                      replay or None))
+                    replay = False
+                    progress.commit()
+            else:
+                docs = list(self.read_documents(fh, errors, progress))
 
-        reader = csv.reader(fh, delimiter=self.cleaned_data["delimiter"])
-        errors = []
-        docs = []
-        for row in reader:
-            if reader.line_num == 1:
-                # Get all non-empty column names using the first row of the
-                # data.
-                column_names = filter(lambda i: i, row)
-                continue
+                # Only try to save documents if there weren't any errors.
+                if len(errors) == 0:
+                    errors.extend(self.save_documents(database, docs))
+                    progress.batches_saved += 1
+        finally:
+            # Clean up after we're done reading the file.
+            fh.close()
+
+        return errors
 
-            column_range = xrange(min(len(column_names), len(row)))
-            doc = {}
-            # TODO: Replace this for loop with a zip.
-            for i in column_range:
-                # Map row value to corresponding column name.
-                if len(row[i]) > 0:
-                    doc[column_names[i]] = row[i]
+    def read_documents(self, fh, errors, progress, checkpoint=None,
+                       positions=None):
+        """
+        Yields one document for each non-empty row of the given CSV file object
+        using the selected model, if any, to coerce the row's values. Rows that
+        can't be coerced are added to the given list of errors instead.
+
+        If a deque of positions is given, the position in the file of each
+        yielded document is recorded in the given progress.
+        """
+        column_names, rows = read_csv(fh, self.cleaned_data["delimiter"],
+                                      checkpoint, positions)
+        rows = progress.counted_rows(rows)
+        progress.column_names = column_names
+        model_name = self.cleaned_data["model"]
+
+        if model_name:
+            model = registered_models.get(model_name)
+            if self.cleaned_data["parallel"]:
+                results = coerce_rows_parallel(model_name, column_names, rows)
+            else:
+                results = coerce_rows(model, column_names, rows)
+        else:
+            model = None
+            results = ((line_num, row_values(column_names, row), None)
+                       for line_num, row in rows)
+
+        # Find duplicate unique documents before they are saved, keeping only
+        # the current batch of documents to compare duplicates with when
+        # streaming, and none when only checking the data.
+        if model is not None and issubclass(model, UniqueDocument):
+            if progress.validate_only:
+                recent_size = 1
+            elif self.cleaned_data["stream"]:
+                recent_size = self.cleaned_data["batch_size"]
+            else:
+                recent_size = None
+
+            duplicates = DuplicateIndex(recent_size)
+        else:
+            duplicates = None
+
+        for line_num, doc, error in results:
+            if error is not None:
+                progress.count_error(error["type"], error["column"])
+                if progress.validate_only:
+                    self.add_validation_error(errors, progress, line_num, error)
+                else:
+                    errors.append((doc, "Row %i:\n%s" % (line_num, error["message"])))
+                continue
 
             # Skip empty documents.
-            if len(doc) == 0:
+            if model is None and len(doc) == 0:
                 continue
 
-            if self.cleaned_data["model"]:
-                model = registered_models.get(self.cleaned_data["model"])
-                try:
-                    doc = model.coerce(doc)
-                    doc = model(**doc)
-                    # doc["type"] = self.cleaned_data["model"].lower()
-                    docs.append(doc)
-                except (KeyError, ValueError), e:
-                    errors.append((doc, traceback.format_exc()))
-            else:
-                docs.append(doc)
-
-        # Clean up after we're done reading the file.
-        fh.close()
-
-        # Only try to save documents if there weren't any errors.
-        if len(errors) == 0:
-            # Check for existing documents with the same ids as the imported
-            # documents.
-            keys = [doc.get_id for doc in docs if getattr(doc, "get_id", None)]
-            existing_docs = self.existing_docs(database, keys, docs)
-
-            if len(existing_docs) > 0:
-                if self.cleaned_data["overwrite"]:
-                    # If the user approved document overwriting, update each
-                    # document of imported data to the current revision of that
-                    # document in the database.
-                    docs = existing_docs
+            progress.rows_coerced += 1
+            progress.changed()
+
+            if duplicates is not None and not duplicates.add(doc):
+                if self.cleaned_data["skip_duplicates"]:
+                    continue
+
+                progress.count_error("Duplicate")
+                if progress.validate_only:
+                    self.add_validation_error(errors, progress, line_num, {
+                        "type": "Duplicate",
+                        "column": None,
+                        "value": doc.get_id,
+                        "message": "Duplicate of a document earlier in the file."
+                    })
                 else:
-                    # If the user didn't approve document overwriting, return an
-                    # error list for the conflicting documents.
-                    errors = [(existing_doc, "Document already exists.")
-                              for existing_doc in existing_docs]
-
-            if len(errors) == 0:
-                try:
-                    database.bulk_save([getattr(doc, "_doc", None) or doc
-                                        for doc in docs])
-                except BulkSaveError, e:
-                    if not self.cleaned_data["skip_duplicates"]:
-                        # Show the difference between apparently duplicated
-                        # records.
-                        keys = set([error["id"] for error in e.errors])
-                        docs_by_id = {}
-                        for doc in docs:
-                            doc_id = doc._doc["_id"]
-                            if doc_id in keys:
-                                docs_by_id.setdefault(doc_id, []).append(doc._doc)
-
-                        for key in keys:
-                            if key in docs_by_id:
-                                errors.append((
-                                    self.diff_docs(docs_by_id[key][0], docs_by_id[key][1]),
-                                    "Duplicate document; differences between documents shown."
-                                ))
+                    original = duplicates.original(doc)
+                    if original is not None:
+                        errors.append((
+                            self.diff_docs(original, doc._doc),
+                            "Row %i: Duplicate document; differences between documents shown." % line_num
+                        ))
+                    else:
+                        errors.append((
+                            doc._doc,
+                            "Row %i: Duplicate of a document earlier in the file." % line_num
+                        ))
+                continue
+
+            if positions is not None:
+                while positions and positions[0][0] <= line_num:
+                    progress.position = positions.popleft()
+                    progress.rows_read += 1
+
+            yield doc
+
+    def add_validation_error(self, errors, progress, line_num, error):
+        """
+        Adds the given error for the row at the given line number to the given
+        list of errors as a dictionary of the row number, column, value, and
+        message, unless ``MAX_VALIDATION_ERRORS`` errors have been kept
+        already.
+        """
+        if len(errors) >= self.MAX_VALIDATION_ERRORS:
+            progress.errors_dropped += 1
+            return
+
+        errors.append({
+            "row": line_num,
+            "column": error["column"],
+            "value": error["value"],
+            "message": error["message"]
+        })
+
+    def save_documents(self, database, docs, overwrite=None):
+        """
+        Saves the given documents to the database in one bulk request and
+        returns a list of errors for documents that couldn't be saved.
+        Existing documents are overwritten if requested by the form or by the
+        given ``overwrite`` argument.
+        """
+        if overwrite is None:
+            overwrite = self.cleaned_data["overwrite"]
+
+        errors = []
+
+        # Check for existing documents with the same ids as the imported
+        # documents.
+        keys = [doc.get_id for doc in docs if getattr(doc, "get_id", None)]
+        existing_docs = self.existing_docs(database, keys, docs)
+
+        if len(existing_docs) > 0 and not overwrite:
+            # If the user didn't approve document overwriting, report the
+            # conflicting documents and save the others. Otherwise the
+            # existing documents have been updated to their current revisions
+            # so they are overwritten.
+            errors.extend([(existing_doc, "Document already exists.")
+                           for existing_doc in existing_docs])
+            existing = set([id(existing_doc) for existing_doc in existing_docs])
+            docs = [doc for doc in docs if id(doc) not in existing]
+            if not docs:
+                return errors
+
+        try:
+            database.bulk_save([getattr(doc, "_doc", None) or doc
+                                for doc in docs])
+        except BulkSaveError, e:
+            if not self.cleaned_data["skip_duplicates"]:
+                # Show the difference between apparently duplicated
+                # records.
+                keys = set([error["id"] for error in e.errors])
+                docs_by_id = {}
+                for doc in docs:
+                    doc = getattr(doc, "_doc", None) or doc
+                    doc_id = doc.get("_id")
+                    if doc_id in keys:
+                        docs_by_id.setdefault(doc_id, []).append(doc)
+
+                for key in keys:
+                    key_docs = docs_by_id.get(key, [])
+                    if len(key_docs) > 1:
+                        errors.append((
+                            self.diff_docs(key_docs[0], key_docs[1]),
+                            "Duplicate document; differences between documents shown."
+                        ))
+                    elif key_docs:
+                        # The document conflicts with one saved by an earlier
+                        # batch of the same import.
+                        errors.append((key_docs[0], "Document already exists."))
 
         return errors
 
@@ -154,25 +401,27 @@ class ImportDataForm(forms.Form):
         )
 
     def existing_docs(self, database, ids, docs=None):
-        existing_docs = database.documents(keys=ids)
-        existing_docs = filter(lambda x: "error" not in x, existing_docs)
-
         # If no documents are given to manipulate, return the documents fetched
-        # from the database. If documents are given and exist in the database,
-        # update given documents with the revisions of the documents in the
-        # database. Otherwise there is nothing to do.
+        # from the database.
         if docs is None:
-            docs = existing_docs
-        elif len(existing_docs) > 0:
-            revisions_by_id = dict([(doc["id"], doc["value"]["rev"])
-                                    for doc in existing_docs])
-            for doc in docs:
-                if "_id" in doc and doc["_id"] in revisions_by_id:
-                    doc._doc["_rev"] = revisions_by_id[doc["_id"]]
-        else:
-            docs = []
+            return list(existing_rows(database, ids, self.WINDOW_SIZE,
+                                      self.EXISTENCE_THREADS))
 
-        return docs
+        # If documents are given, update those that exist in the database with
+        # the revisions of the documents in the database and return them.
+        revisions_by_id = dict(existing_revisions(database, ids,
+                                                  self.WINDOW_SIZE,
+                                                  self.EXISTENCE_THREADS))
+        if len(revisions_by_id) == 0:
+            return []
+
+        existing = []
+        for doc in docs:
+            if "_id" in doc and doc["_id"] in revisions_by_id:
+                doc._doc["_rev"] = revisions_by_id[doc["_id"]]
+                existing.append(doc)
+
+        return existing
 
 
 class AttachFileForm(forms.Form):
@@ -182,37 +431,205 @@ class AttachFileForm(forms.Form):
     file = forms.FileField(label="Select a file:")
 
 
+class AttachArchiveForm(forms.Form):
+    """
+    Attaches the files in an uploaded ZIP archive to the documents whose ids
+    match the files' names.
+    """
+    file = forms.FileField(label="Select a ZIP archive:")
+    filename_rule = forms.ChoiceField(
+        choices=FILENAME_RULES,
+        label="Match files to document ids by"
+    )
+    background = forms.BooleanField(
+        required=False,
+        label="Attach in the background",
+        help_text="Shows the progress of the attachment on this page while it runs."
+    )
+
+    FILE_EXTENSION = "zip"
+    progress_class = AttachProgress
+
+    # Number of archive entries to fetch document revisions for at a time and
+    # the number of files to upload at the same time.
+    BATCH_SIZE = 100
+    UPLOAD_THREADS = 8
+
+    def clean_file(self):
+        file = self.cleaned_data["file"]
+        if not is_archive(file):
+            raise forms.ValidationError("The file is not a ZIP archive.")
+
+        return file
+
+    def options(self):
+        """
+        Returns the cleaned options other than the uploaded archive.
+        """
+        options = dict(self.cleaned_data)
+        options.pop("file", None)
+        return options
+
+    @classmethod
+    def for_options(cls, options):
+        """
+        Returns a form with the given cleaned options to resume attaching
+        files with.
+        """
+        form = cls()
+        form.cleaned_data = dict([(str(key), value)
+                                  for key, value in options.items()])
+        return form
+
+    def import_data(self, database, file, progress=None, checkpoint=None):
+        """
+        Attaches each file in the given ZIP archive file object or path to the
+        document with the id derived from the file's name and returns a list
+        of the names of the files that couldn't be attached along with the
+        reason.
+
+        Files are handled in batches. The revisions of the documents of a
+        batch are fetched together, then the batch's files are streamed from
+        the archive on several threads, with the files of each document
+        uploaded one after another. A checkpoint is recorded in the given
+        ``AttachProgress``, if any, after each batch and attaching can be
+        resumed from a checkpoint by passing it back to this method.
+        """
+        if progress is None:
+            progress = AttachProgress()
+
+        errors = progress.errors
+        reader = ArchiveReader(file)
+        pool = ThreadPool(self.UPLOAD_THREADS)
+
+        try:
+            entries = reader.entries()
+            progress.files_total = len(entries)
+
+            start = 0
+            if checkpoint is not None:
+                start = checkpoint["entries"]
+                progress.files_read = start
+                progress.files_attached = checkpoint["files_attached"]
+
+            for offset in xrange(start, len(entries), self.BATCH_SIZE):
+                batch = entries[offset:offset + self.BATCH_SIZE]
+
+                infos_by_id = collections.OrderedDict()
+                for info in batch:
+                    doc_id = document_id(info.filename,
+                                         self.cleaned_data["filename_rule"])
+                    infos_by_id.setdefault(doc_id, []).append(info)
+
+                revisions = dict(existing_revisions(
+                    database,
+                    infos_by_id.keys(),
+                    self.BATCH_SIZE
+                ))
+                uploads = [
+                    (database, reader, doc_id, revisions.get(doc_id), infos)
+                    for doc_id, infos in infos_by_id.items()
+                ]
+
+                for results in map_ahead(pool, recorded(attach_entries),
+                                         uploads, self.UPLOAD_THREADS * 2):
+                    for name, error in results:
+                        progress.files_read += 1
+                        if error is None:
+                            progress.files_attached += 1
+                        else:
+                            errors.append((name, error))
+
+                    progress.changed()
+
+                progress.position = offset + len(batch)
+                progress.commit()
+        finally:
+            pool.terminate()
+            reader.close()
+
+        return errors
+
+
+class SearchForm(forms.Form):
+    """
+    Searches the local index of a database for documents of one type.
+    """
+    doc_type = forms.ChoiceField(label="Document type")
+    field = forms.ChoiceField(required=False)
+    query = forms.CharField()
+    prefix = forms.BooleanField(
+        required=False,
+        label="Match the beginnings of words"
+    )
+
+    def __init__(self, indexes, *args, **kwargs):
+        super(SearchForm, self).__init__(*args, **kwargs)
+        self.indexes = indexes
+        self.fields["doc_type"].choices = [(doc_type, doc_type)
+                                           for doc_type in sorted(indexes)]
+
+        fields = set()
+        for index in indexes.values():
+            fields.update(index.fields)
+        self.fields["field"].choices = (
+            [("", "-- Any field --")] +
+            [(field, field) for field in sorted(fields)]
+        )
+
+    def clean(self):
+        doc_type = self.cleaned_data.get("doc_type")
+        field = self.cleaned_data.get("field")
+        if doc_type and field and field not in self.indexes[doc_type].fields:
+            raise forms.ValidationError(
+                "'%s' isn't indexed for %s documents." % (field, doc_type)
+            )
+
+        return self.cleaned_data
+
+
+# Forms that can run as background jobs by class name.
+job_forms = {
+    "ImportDataForm": ImportDataForm,
+    "AttachArchiveForm": AttachArchiveForm
+}
+
+
 def get_form_for_document(document):
     """
     Returns a Django form with fields based on the data types of the given
     CouchDB document.
+
+    Form classes are cached by the document's type and the names and types of
+    its fields, so documents of the same shape share one form class.
     """
-    # Get the class name.
-    class_name = str(document.get("type", document["_id"]))
+    # Get the class name from the document's type or couchdbkit's doc_type.
+    # Documents with neither share a name, so they can share a form class.
+    class_name = str(document.get("type") or document.get("doc_type") or
+                     "Document")
     log.debug("class name: %s" % class_name)
 
-    # Type to form field mappings.
-    type_to_field = {
-        int: forms.IntegerField,
-        float: forms.FloatField,
-        str: forms.CharField,
-        unicode: forms.CharField,
-        bool: forms.BooleanField
-    }
+    signature = (class_name, tuple([
+        (field_name, type(value))
+        for field_name, value in sorted(document.items())
+        if type(value) in TYPE_TO_FIELD
+    ]))
+    form = document_form_cache.get(signature)
+    if form is not None:
+        return form
 
     # Convert field types into Field objects.
     fields = SortedDict()
-    for field_name, value in sorted(document.items()):
-        field_type = type_to_field.get(type(value))
+    for field_name, value_type in signature[1]:
+        field_type = TYPE_TO_FIELD[value_type]
 
-        if field_type is not None:
-            # Special fields for CouchDB like _id and _rev get hidden fields.
-            if field_name.startswith("_"):
-                field = field_type(widget=forms.HiddenInput())
-            else:
-                field = field_type()
+        # Special fields for CouchDB like _id and _rev get hidden fields.
+        if field_name.startswith("_"):
+            field = field_type(widget=forms.HiddenInput())
+        else:
+            field = field_type()
 
-            fields[field_name] = field
+        fields[field_name] = field
 
     log.debug("fields: %s" % fields)
 
@@ -220,4 +637,5 @@ def get_form_for_document(document):
     form = type(class_name, (forms.Form,), fields)
     log.debug("form: %s" % form)
 
+    document_form_cache.set(signature, form)
     return form
@@ -0,0 +1,324 @@
+"""
+Reads rows of CSV data and coerces them into documents for registered models,
+either one row at a time or across a pool of processes.
+
+Models with a columnar plan have their rows coerced a chunk at a time, a column
+at a time, when NumPy is installed.
+"""
+import binascii
+import csv
+from itertools import chain, izip
+import multiprocessing
+
+from couch import get_pool, recorded
+from models import registry as registered_models
+from utils import batches, map_ahead
+
+# Default number of rows sent to a worker process at a time.
+CHUNK_SIZE = 500
+
+# Default number of document ids looked up per request when checking for
+# existing documents.
+WINDOW_SIZE = 1000
+
+
+class DuplicateIndex(object):
+    """
+    Tracks the ids of unique documents read during an import so duplicates can
+    be found before they are sent to the database. Ids that are SHA-1 hex
+    digests are kept as raw 20-byte digests to keep the index compact for
+    large files. Copies of up to ``recent_size`` of the most recently added
+    documents, or all of them if no size is given, are also kept to compare
+    duplicates with.
+    """
+    def __init__(self, recent_size=None):
+        self.digests = set()
+        self.recent = {}
+        self.recent_size = recent_size
+
+    def key(self, doc):
+        doc_id = doc.get_id
+        try:
+            return binascii.unhexlify(doc_id)
+        except (TypeError, binascii.Error):
+            return doc_id
+
+    def add(self, doc):
+        """
+        Adds the id of the given document to the index and returns True if the
+        id hadn't been added before. Documents without an id are never
+        duplicates.
+        """
+        key = self.key(doc)
+        if key is None:
+            return True
+
+        if key in self.digests:
+            return False
+
+        self.digests.add(key)
+
+        if self.recent_size is not None and len(self.recent) >= self.recent_size:
+            self.recent.clear()
+
+        # Keep a copy, as saving the document adds its revision to it.
+        self.recent[key] = dict(doc._doc)
+        return True
+
+    def original(self, doc):
+        """
+        Returns a copy of the first document added with the same id as the
+        given document, as it was when added, if it is still kept in the
+        index. Otherwise, returns None.
+        """
+        return self.recent.get(self.key(doc))
+
+
+def read_csv(fh, delimiter, checkpoint=None, positions=None):
+    """
+    Returns the non-empty column names from the first row of the given CSV file
+    object and an iterator of tuples of the line number and list of values for
+    each of the remaining rows.
+
+    If a checkpoint is given, reading resumes at the checkpoint's byte offset
+    using its column names and line number. If a deque of positions is given, a
+    tuple of the line number and the byte offset of the end of each row is
+    appended to it as the row is read.
+    """
+    if positions is not None:
+        # Read one line at a time so the position of the file matches the end
+        # of the last row read.
+        lines = iter(fh.readline, "")
+    else:
+        lines = fh
+
+    reader = csv.reader(lines, delimiter=delimiter)
+
+    if checkpoint is not None:
+        fh.seek(checkpoint["offset"])
+        column_names = checkpoint["column_names"]
+        first_line_num = checkpoint["line_num"]
+    else:
+        try:
+            # Get all non-empty column names using the first row of the data.
+            column_names = filter(lambda i: i, reader.next())
+        except StopIteration:
+            return [], iter([])
+
+        first_line_num = 0
+
+    def rows():
+        for row in reader:
+            line_num = first_line_num + reader.line_num
+            if positions is not None:
+                positions.append((line_num, fh.tell()))
+
+            yield line_num, row
+
+    return column_names, rows()
+
+
+def row_values(column_names, row):
+    """
+    Returns a dictionary of the non-empty values in the given row by column
+    name.
+    """
+    return dict([(name, value) for name, value in izip(column_names, row)
+                 if len(value) > 0])
+
+
+def describe_error(e):
+    """
+    Returns a dictionary with the type, message, and, if known, the column and
+    value of the given error raised while coercing a row.
+    """
+    if isinstance(e, KeyError):
+        column = e.args[0]
+        return {"type": "MissingValue", "column": column, "value": None,
+                "message": "The row has no value for '%s'." % column}
+
+    message = e.args and e.args[0] or e.__class__.__name__
+    if isinstance(message, str):
+        message = message.decode("utf-8", "replace")
+
+    return {"type": e.__class__.__name__,
+            "column": getattr(e, "key", None),
+            "value": getattr(e, "value", None),
+            "message": message}
+
+
+class DocumentData(object):
+    """
+    A coerced document kept as the JSON-ready dictionary that is saved to the
+    database, with the parts of the document interface used by imports.
+    """
+    __slots__ = ("_doc",)
+
+    def __init__(self, doc):
+        self._doc = doc
+
+    @property
+    def get_id(self):
+        return self._doc.get("_id")
+
+    def __contains__(self, key):
+        return key in self._doc
+
+    def __getitem__(self, key):
+        return self._doc[key]
+
+    def to_json(self):
+        return self._doc
+
+
+def coerce_rows(model, column_names, rows, columnar=True,
+                chunk_size=CHUNK_SIZE):
+    """
+    Yields a tuple of the line number, document, and error for each of the
+    given non-empty rows using the model's coercion plan for the given column
+    names. The document is an instance of the given model or, if the row
+    couldn't be coerced, the row's raw values with a dictionary describing the
+    error.
+
+    If the model has a columnar plan and ``columnar`` is set, rows are coerced
+    in chunks of ``chunk_size`` rows instead and documents are yielded as
+    ``DocumentData``. Chunks with values that can't be converted are coerced
+    again one row at a time to report their errors.
+    """
+    plan = columnar and model.columnar_plan(column_names)
+    if not plan:
+        for result in coerce_row_plan(model, column_names, rows):
+            yield result
+        return
+
+    for chunk in batches(rows, chunk_size):
+        try:
+            docs = plan([row for line_num, row in chunk])
+        except (ValueError, OverflowError):
+            for result in coerce_row_plan(model, column_names, chunk):
+                yield result
+            continue
+
+        for (line_num, row), doc in izip(chunk, docs):
+            if doc is not None:
+                yield line_num, DocumentData(doc), None
+
+
+def coerce_row_plan(model, column_names, rows):
+    """
+    Like ``coerce_rows`` but always coerces one row at a time.
+    """
+    plan = model.coercion_plan(column_names)
+
+    for line_num, row in rows:
+        try:
+            values = plan(row)
+
+            # Skip empty documents.
+            if values is None:
+                continue
+
+            document = model(**values)
+
+            # Unique documents set their id when it is first requested.
+            document.get_id
+        except (KeyError, ValueError), e:
+            yield line_num, row_values(column_names, row), describe_error(e)
+        else:
+            yield line_num, document, None
+
+
+def _coerce_chunk(model_name, column_names, chunk):
+    """
+    Coerces a chunk of rows in a worker process and returns the results as
+    JSON-ready dictionaries so they can be sent back to the parent process.
+    """
+    model = registered_models[model_name]
+    return [(line_num, doc.to_json() if error is None else doc, error)
+            for line_num, doc, error in coerce_rows(model, column_names, chunk)]
+
+
+def coerce_rows_parallel(model_name, column_names, rows, processes=None,
+                         chunk_size=CHUNK_SIZE):
+    """
+    Like ``coerce_rows`` but coerces chunks of rows across a pool of worker
+    processes for the registered model with the given name. Results are
+    yielded in the same order as the given rows.
+
+    Only a few chunks per process are read ahead of the results being
+    consumed, so memory use doesn't depend on the number of rows.
+    """
+    model = registered_models[model_name]
+    if model.columnar_plan(column_names):
+        wrap = DocumentData
+    else:
+        wrap = model.wrap
+
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        chunks = map_ahead(
+            pool,
+            _coerce_chunk,
+            ((model_name, column_names, chunk)
+             for chunk in batches(rows, chunk_size)),
+            processes * 2
+        )
+        for chunk in chunks:
+            for line_num, doc, error in chunk:
+                if error is None:
+                    doc = wrap(doc)
+
+                yield line_num, doc, error
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _existing_rows(database, ids):
+    return [row for row in database.documents(keys=ids) if "error" not in row]
+
+
+def existing_rows(database, ids, window_size=WINDOW_SIZE, threads=1):
+    """
+    Yields the ``_all_docs`` row of each of the given document ids that exists
+    in the given database. Ids are looked up in windows of ``window_size`` ids
+    at a time, optionally with several windows in flight across the given
+    number of threads, so neither requests nor responses grow with the number
+    of ids. Threads are taken from the shared pool of ``couch.get_pool`` and
+    are only used when there is more than one window of ids.
+    """
+    windows = batches(ids, window_size)
+    first = next(windows, None)
+    if first is None:
+        return
+
+    second = next(windows, None)
+    if second is None or threads <= 1:
+        windows = chain([first], [second] if second else [], windows)
+        for window in windows:
+            for row in _existing_rows(database, window):
+                yield row
+        return
+
+    results = map_ahead(
+        get_pool(),
+        recorded(_existing_rows),
+        ((database, window) for window in chain([first, second], windows)),
+        threads
+    )
+    for rows in results:
+        for row in rows:
+            yield row
+
+
+def existing_revisions(database, ids, window_size=WINDOW_SIZE, threads=1):
+    """
+    Yields a tuple of the id and current revision of each of the given
+    document ids that exists in the given database.
+    """
+    for row in existing_rows(database, ids, window_size, threads):
+        yield row["id"], row["value"]["rev"]
@@ -0,0 +1,366 @@
+"""
+Runs data imports and archive attachments as background jobs on a local pool
+of worker threads.
+
+Job progress is stored in Django's cache by job id, so every app server
+process that shares the cache can report on the job. Each job keeps a copy of
+its data file and a state file with its options and last checkpoint in
+``CUSHION_IMPORT_DIR`` until it succeeds, so a failed job can be resumed from
+the last batch it saved.
+"""
+import os
+import pprint
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import simplejson
+
+# Seconds to keep job progress after the job was last updated.
+PROGRESS_TIMEOUT = 60 * 60 * 24
+
+# Minimum seconds between saves of progress while a job is running.
+PROGRESS_INTERVAL = 1
+
+# Maximum number of errors stored with the progress of a job.
+MAX_ERRORS = 1000
+
+# Seconds a request resuming a job keeps others from resuming it, which is
+# long enough for the job to be marked as queued again.
+RESUME_TIMEOUT = 10
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process-wide pool of import workers, creating it on first use
+    with ``CUSHION_IMPORT_WORKERS`` threads.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, "CUSHION_IMPORT_WORKERS", 2))
+
+    return _pool
+
+
+def job_path(job_id, extension):
+    """
+    Returns the path of the data or state file of the job with the given id.
+    """
+    directory = getattr(settings, "CUSHION_IMPORT_DIR", None) or tempfile.gettempdir()
+    return os.path.join(directory, "cushion-import-%s.%s" % (job_id, extension))
+
+
+def read_state(job_id):
+    """
+    Returns the saved state of the job with the given id or None if the job
+    has no state file.
+    """
+    try:
+        fh = open(job_path(job_id, "json"))
+    except IOError:
+        return None
+
+    try:
+        return simplejson.load(fh)
+    finally:
+        fh.close()
+
+
+def write_state(job_id, state):
+    # Replace the state file in one step so a crash while writing it can't
+    # leave a partial checkpoint behind.
+    path = job_path(job_id, "json")
+    fh = open("%s.tmp" % path, "w")
+    try:
+        simplejson.dump(state, fh)
+    finally:
+        fh.close()
+
+    os.rename("%s.tmp" % path, path)
+
+
+class ImportProgress(object):
+    """
+    Counts the rows, batches, and errors of an import and records a checkpoint
+    after each saved batch. Progress with a job id is saved to the cache as it
+    changes and its checkpoints are saved to the job's state file; progress
+    without one is only kept in memory.
+    """
+    def __init__(self, job_id=None, state=None):
+        self.job_id = job_id
+        self.state = state
+        self.status = "queued"
+        self.rows_parsed = 0
+        self.rows_coerced = 0
+        self.batches_saved = 0
+        self.errors = []
+        self.message = ""
+
+        # Numbers of errors by type and column, and the number of errors that
+        # were counted without being kept when validating a file.
+        self.validate_only = False
+        self.error_counts = {}
+        self.errors_dropped = 0
+        self.last_saved = 0
+
+        # Column names, the line number and byte offset of the last row read
+        # for the current batch, and the number of rows up to that row.
+        self.column_names = None
+        self.position = None
+        self.rows_read = 0
+        self.checkpoint = None
+
+    def counted_rows(self, rows):
+        """
+        Yields the given rows while counting them as parsed.
+        """
+        for row in rows:
+            self.rows_parsed += 1
+            yield row
+
+    def count_error(self, kind, column=None):
+        """
+        Counts an error of the given kind in the given column, if any.
+        """
+        if column is not None:
+            kind = "%s in '%s'" % (kind, column)
+
+        self.error_counts[kind] = self.error_counts.get(kind, 0) + 1
+
+    def as_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": "import",
+            "status": self.status,
+            "rows_parsed": self.rows_parsed,
+            "rows_coerced": self.rows_coerced,
+            "batches_saved": self.batches_saved,
+            "num_errors": len(self.errors) + self.errors_dropped,
+            "validate_only": self.validate_only,
+            "error_counts": sorted(self.error_counts.items(),
+                                   key=lambda (kind, count): (-count, kind)),
+            "message": self.message,
+            "checkpoint": self.checkpoint
+        }
+
+    def changed(self):
+        """
+        Saves the progress if it hasn't been saved in the last
+        ``PROGRESS_INTERVAL`` seconds.
+        """
+        if time.time() - self.last_saved >= PROGRESS_INTERVAL:
+            self.save()
+
+    def commit(self):
+        """
+        Counts a saved batch and records a checkpoint after the batch.
+        """
+        self.batches_saved += 1
+        self.checkpoint = self.current_checkpoint()
+
+        if self.job_id is not None:
+            self.state["checkpoint"] = self.checkpoint
+            write_state(self.job_id, self.state)
+
+        self.save()
+
+    def current_checkpoint(self):
+        """
+        Returns a checkpoint at the position of the last row of the current
+        batch, with the number of rows and errors up to that row.
+        """
+        line_num, offset = self.position
+        return {
+            "batch": self.batches_saved,
+            "line_num": line_num,
+            "offset": offset,
+            "column_names": self.column_names,
+            "rows": self.rows_read,
+            "errors": len(self.errors)
+        }
+
+    def save(self):
+        if self.job_id is None:
+            return
+
+        progress = self.as_dict()
+
+        # Only store errors once the job has finished.
+        if self.status in ("done", "failed"):
+            progress["errors"] = [stored_error(error)
+                                  for error in self.errors[:MAX_ERRORS]]
+
+        cache.set(progress_key(self.job_id), progress, PROGRESS_TIMEOUT)
+        self.last_saved = time.time()
+
+
+def stored_error(error):
+    """
+    Returns the given error as it is stored with the progress of a finished
+    job. Documents are stored as formatted strings so the cache doesn't need to
+    pickle them. The structured errors found when validating a file are stored
+    as they are.
+    """
+    if isinstance(error, dict):
+        return error
+
+    doc, message = error
+    if not isinstance(doc, basestring):
+        doc = pprint.pformat(getattr(doc, "_doc", doc))
+
+    return doc, message
+
+
+class AttachProgress(ImportProgress):
+    """
+    Counts the files read from an archive and attached to documents. The
+    position of an attachment job is the number of archive entries handled.
+    """
+    def __init__(self, job_id=None, state=None):
+        super(AttachProgress, self).__init__(job_id, state)
+        self.files_total = 0
+        self.files_read = 0
+        self.files_attached = 0
+        self.position = 0
+
+    def as_dict(self):
+        progress = super(AttachProgress, self).as_dict()
+        progress.update({
+            "kind": "attach",
+            "files_total": self.files_total,
+            "files_read": self.files_read,
+            "files_attached": self.files_attached
+        })
+        return progress
+
+    def current_checkpoint(self):
+        return {
+            "batch": self.batches_saved,
+            "entries": self.position,
+            "files_attached": self.files_attached,
+            "errors": len(self.errors)
+        }
+
+
+def progress_key(job_id):
+    return "cushion_import_%s" % job_id
+
+
+def resume_key(job_id):
+    return "%s_resume" % progress_key(job_id)
+
+
+def get_progress(job_id):
+    """
+    Returns a dictionary describing the progress of the job with the given id
+    or None if there is no such job.
+    """
+    return cache.get(progress_key(job_id))
+
+
+def copy_upload(file, path):
+    """
+    Copies the given uploaded file to the given path so it outlives the
+    request.
+    """
+    fh = open(path, "wb")
+    try:
+        for chunk in file.chunks():
+            fh.write(chunk)
+    finally:
+        fh.close()
+
+
+def run_import(form, database, progress, checkpoint=None):
+    progress.status = "running"
+    progress.save()
+
+    try:
+        form.import_data(database,
+                         job_path(progress.job_id, form.FILE_EXTENSION),
+                         progress, checkpoint)
+        progress.status = "done"
+    except Exception:
+        # Keep the data and state files so the job can be resumed.
+        progress.status = "failed"
+        progress.message = traceback.format_exc()
+    else:
+        os.remove(job_path(progress.job_id, form.FILE_EXTENSION))
+        os.remove(job_path(progress.job_id, "json"))
+    finally:
+        progress.save()
+        cache.delete(resume_key(progress.job_id))
+
+
+def submit_import(form, database, file):
+    """
+    Starts importing the given uploaded file into the given database with the
+    given valid ``ImportDataForm`` or ``AttachArchiveForm`` in the background
+    and returns the job id.
+    """
+    state = {
+        "database": database.dbname,
+        "form": form.__class__.__name__,
+        "options": form.options(),
+        "checkpoint": None
+    }
+    progress = form.progress_class(uuid.uuid4().hex, state)
+    progress.save()
+
+    copy_upload(file, job_path(progress.job_id, form.FILE_EXTENSION))
+    write_state(progress.job_id, state)
+    get_pool().apply_async(run_import, (form, database, progress))
+
+    return progress.job_id
+
+
+def resume_import(job_id, database):
+    """
+    Restarts the failed import job with the given id from its last checkpoint
+    and returns False if the job can't be resumed. Jobs that are still queued
+    or running, or whose progress is no longer known, aren't resumed.
+    """
+    from forms import job_forms
+
+    previous_progress = get_progress(job_id)
+    if previous_progress is None or previous_progress["status"] != "failed":
+        return False
+
+    state = read_state(job_id)
+    if state is None or state["database"] != database.dbname:
+        return False
+
+    # Only let one of several requests to resume the same job through. The
+    # claim is released when the resumed job finishes.
+    if not cache.add(resume_key(job_id), True, RESUME_TIMEOUT):
+        return False
+
+    form_class = job_forms[state.get("form", "ImportDataForm")]
+    progress = form_class.progress_class(job_id, state)
+    checkpoint = state["checkpoint"]
+    if checkpoint is not None:
+        progress.checkpoint = checkpoint
+        progress.batches_saved = checkpoint["batch"]
+        progress.rows_parsed = progress.rows_read = checkpoint.get("rows", 0)
+
+        # Keep the errors reported up to the checkpoint. Those after it are
+        # reported again as the rest of the file is read.
+        errors = previous_progress.get("errors", [])
+        progress.errors = list(errors[:checkpoint.get("errors", len(errors))])
+
+    progress.save()
+
+    form = form_class.for_options(state["options"])
+    get_pool().apply_async(run_import, (form, database, progress, checkpoint))
+
+    return True
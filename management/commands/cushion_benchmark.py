@@ -0,0 +1,61 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cushion.benchmarks import (
+    benchmark_coercion,
+    benchmark_empty_database,
+    benchmark_import,
+    benchmark_index_page,
+    benchmark_pagination
+)
+
+
+class Command(BaseCommand):
+    args = "[coercion|import|empty|index|pagination ...]"
+    help = ("Measures the throughput of Cushion's CSV data import and the "
+            "latency of its pages against a fake CouchDB server. Runs every "
+            "benchmark if none are given.")
+    option_list = BaseCommand.option_list + (
+        make_option("--rows", type="int", default=50000,
+                    help="Number of synthetic rows to import."),
+        make_option("--processes", type="int", default=None,
+                    help="Number of processes to use for parallel coercion."),
+        make_option("--docs", type="int", default=20000,
+                    help="Number of documents in generated databases."),
+        make_option("--databases", type="int", default=50,
+                    help="Number of databases listed on the index page."),
+        make_option("--latency", type="float", default=5,
+                    help="Milliseconds the fake server delays each request."),
+    )
+
+    def handle(self, *names, **options):
+        latency = options["latency"] / 1000.0
+        benchmarks = (
+            ("coercion", "rows", lambda: benchmark_coercion(
+                options["rows"], options["processes"])),
+            ("import", "rows", lambda: benchmark_import(
+                options["rows"], latency, processes=options["processes"])),
+            ("empty", "docs", lambda: benchmark_empty_database(
+                options["docs"], latency)),
+            ("index", "pages", lambda: benchmark_index_page(
+                options["databases"], latency=latency)),
+            ("pagination", "pages", lambda: benchmark_pagination(
+                max(options["docs"], 1000),
+                [depth for depth in (0, 1000, 10000, 90000)
+                 if depth < options["docs"]],
+                latency=latency)),
+        )
+
+        unknown = set(names) - set([name for name, unit, run in benchmarks])
+        if unknown:
+            raise CommandError("Unknown benchmarks: %s"
+                               % ", ".join(sorted(unknown)))
+
+        for name, unit, run in benchmarks:
+            if names and name not in names:
+                continue
+
+            for method, seconds, per_second in run():
+                self.stdout.write("%-16s %10.4f s %10.1f %s/s\n"
+                                  % (method, seconds, per_second, unit))
@@ -0,0 +1,53 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cushion.compaction import POLL_INTERVAL, compact_fragmented
+from cushion.couch import get_server
+
+
+class Command(BaseCommand):
+    args = "[database ...]"
+    help = ("Compacts the given databases, or all databases, and their views "
+            "if their files are more than a threshold times the size of their "
+            "data, one database at a time.")
+    option_list = BaseCommand.option_list + (
+        make_option("--threshold", type="float",
+                    default=getattr(settings, "CUSHION_COMPACTION_THRESHOLD", 2),
+                    help="Ratio of file size to data size above which a "
+                         "database is compacted."),
+        make_option("--min-size", type="float",
+                    default=getattr(settings, "CUSHION_COMPACTION_MIN_SIZE", 16),
+                    help="Megabytes below which databases aren't compacted."),
+        make_option("--interval", type="float", default=POLL_INTERVAL,
+                    help="Seconds between checks for finished compactions."),
+        make_option("--every", type="float", default=None,
+                    help="Check the databases again every given number of "
+                         "seconds rather than once."),
+    )
+
+    def handle(self, *database_names, **options):
+        server = get_server()
+        missing = set(database_names) - set(server.all_dbs())
+        if missing:
+            raise CommandError("Unknown databases: %s"
+                               % ", ".join(sorted(missing)))
+
+        while True:
+            compacted = compact_fragmented(
+                server,
+                options["threshold"],
+                options["min_size"] * 1024 * 1024,
+                database_names,
+                options["interval"]
+            )
+            for database_name, ratio in compacted:
+                self.stdout.write("%-30s %8.2f times its data size\n"
+                                  % (database_name, ratio))
+
+            if options["every"] is None:
+                break
+
+            time.sleep(options["every"])
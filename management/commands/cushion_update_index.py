@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cushion.couch import all_dbs, get_database
+from cushion.search import LocalIndex, get_indexes
+
+
+class Command(BaseCommand):
+    args = "[database ...]"
+    help = ("Updates the local search index of the given databases, or of all "
+            "databases, with the changes made since the last update.")
+
+    def handle(self, *database_names, **options):
+        missing = set(database_names) - set(all_dbs())
+        if missing:
+            raise CommandError("Unknown databases: %s"
+                               % ", ".join(sorted(missing)))
+
+        indexes = get_indexes()
+        for database_name in database_names or all_dbs():
+            if database_name.startswith("_"):
+                continue
+
+            index = LocalIndex(database_name, indexes)
+            num_changes = index.update(get_database(database_name))
+            self.stdout.write("%-30s %8i changes\n"
+                              % (database_name, num_changes))
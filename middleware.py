@@ -0,0 +1,114 @@
+"""
+Reports the CouchDB requests made while handling each request.
+
+``CouchTimingMiddleware`` records the CouchDB requests made for a sampled
+share of requests, given by ``CUSHION_TIMING_SAMPLE_RATE`` (1 by default).
+The total time spent waiting on CouchDB is added to sampled responses as a
+``Server-Timing`` header and logged with the request, and each CouchDB
+request is logged at debug level. The ``couch_timing`` context processor
+shows the requests made before a page was rendered in a panel at the bottom
+of the page when ``CUSHION_TIMING_PANEL`` or ``DEBUG`` is set.
+
+If ``CUSHION_PROFILE_THRESHOLD`` is set, sampled requests are also run under
+cProfile, and the profiles of those taking longer than that number of seconds
+are saved in ``CUSHION_PROFILE_DIR``.
+"""
+import cProfile
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+
+from django.conf import settings
+
+from couch import start_recording, stop_recording
+
+log = logging.getLogger(__name__)
+
+
+def server_timing(calls, duration):
+    """
+    Returns a ``Server-Timing`` header value for the given recorded CouchDB
+    requests made during a request that took the given number of seconds.
+    """
+    return 'couchdb;dur=%.1f;desc="%i requests", total;dur=%.1f' % (
+        sum([call["duration"] for call in calls]) * 1000,
+        len(calls),
+        duration * 1000
+    )
+
+
+def profile_path(request, duration):
+    directory = getattr(settings, "CUSHION_PROFILE_DIR", None) or tempfile.gettempdir()
+    name = re.sub(r"[^\w.-]+", "-", request.path).strip("-") or "index"
+    return os.path.join(directory, "cushion-%s-%s-%ims.prof" % (
+        time.strftime("%Y%m%d%H%M%S"),
+        name[:100],
+        duration * 1000
+    ))
+
+
+class CouchTimingMiddleware(object):
+    def process_request(self, request):
+        sample_rate = getattr(settings, "CUSHION_TIMING_SAMPLE_RATE", 1)
+        if random.random() >= sample_rate:
+            return None
+
+        request.couch_timing_start = time.time()
+        start_recording()
+
+        # Profile until process_response rather than calling the view here,
+        # so the view still goes through the other middleware, including
+        # CSRF protection and exception handling.
+        if getattr(settings, "CUSHION_PROFILE_THRESHOLD", None) is not None:
+            request.couch_profile = cProfile.Profile()
+            request.couch_profile.enable()
+
+    def process_response(self, request, response):
+        start = getattr(request, "couch_timing_start", None)
+        if start is None:
+            return response
+
+        profile = getattr(request, "couch_profile", None)
+        if profile is not None:
+            profile.disable()
+
+        calls = stop_recording()
+        duration = time.time() - start
+        response["Server-Timing"] = server_timing(calls, duration)
+
+        for call in calls:
+            log.debug("couchdb method=%s path=%s status=%s bytes_out=%i "
+                      "bytes_in=%i duration_ms=%.1f" % (
+                          call["method"],
+                          call["path"],
+                          call["status"],
+                          call["bytes_out"],
+                          call["bytes_in"],
+                          call["duration"] * 1000
+                      ))
+
+        log.info("request method=%s path=%s status=%i duration_ms=%.1f "
+                 "couchdb_requests=%i couchdb_ms=%.1f couchdb_bytes_in=%i "
+                 "couchdb_bytes_out=%i" % (
+                     request.method,
+                     request.path,
+                     response.status_code,
+                     duration * 1000,
+                     len(calls),
+                     sum([call["duration"] for call in calls]) * 1000,
+                     sum([call["bytes_in"] for call in calls]),
+                     sum([call["bytes_out"] for call in calls])
+                 ),
+                 extra={"couchdb_calls": calls})
+
+        if profile is not None and \
+           duration > settings.CUSHION_PROFILE_THRESHOLD:
+            path = profile_path(request, duration)
+            profile.dump_stats(path)
+            log.warning("Saved the profile of a %.1f ms request for %s to %s"
+                        % (duration * 1000, request.path, path))
+
+        return response
@@ -2,8 +2,16 @@
 Optional models for raw data being loaded into CouchDB.
 """
 from couchdbkit.ext.django import schema
+import calendar
+import copy
 import datetime
 import hashlib
+from itertools import izip, izip_longest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class AlreadyRegistered(Exception):
@@ -38,25 +46,203 @@ class UniqueDocument(object):
         None.
         """
         if hasattr(self, "_unique_fields"):
-            unique_field_strings = []
-            for key in self._unique_fields:
-                attr = getattr(self, key, None)
-                if attr is not None:
-                    if isinstance(attr, basestring):
-                        # hashlib only works with ascii.
-                        attr = attr.encode("utf-8")
-                    unique_field_strings.append(str(attr))
-
-            doc_id = hashlib.sha1("".join(unique_field_strings)).hexdigest()
+            doc_id = self.unique_id(dict([(key, getattr(self, key, None))
+                                          for key in self._unique_fields]))
             self._id = doc_id
         else:
             doc_id = getattr(self, "_id", None)
 
         return doc_id
 
+    @classmethod
+    def unique_id(cls, values):
+        """
+        Returns the SHA-1 hash of the non-empty unique field values in the
+        given dictionary.
+        """
+        unique_field_strings = []
+        for key in cls._unique_fields:
+            attr = values.get(key)
+            if attr is not None:
+                if isinstance(attr, basestring):
+                    # hashlib only works with ascii.
+                    attr = attr.encode("utf-8")
+                unique_field_strings.append(str(attr))
+
+        return hashlib.sha1("".join(unique_field_strings)).hexdigest()
+
 
 class BadValueError(ValueError):
-    pass
+    """
+    Raised when a value can't be converted to the type of its attribute. The
+    attribute name and the raw value are kept when they are known.
+    """
+    def __init__(self, message, key=None, value=None):
+        super(BadValueError, self).__init__(message)
+        self.key = key
+        self.value = value
+
+
+# Month numbers by lowercase long month name, as parsed by the "%B" directive
+# of ``datetime.strptime``.
+MONTH_NUMBERS = dict([(name.lower(), str(number))
+                      for number, name in enumerate(calendar.month_name)
+                      if name])
+
+
+def month_number(name):
+    """
+    Returns the decimal month number as a string for the given long month
+    name, ignoring case.
+    """
+    try:
+        return MONTH_NUMBERS[name.lower()]
+    except KeyError:
+        raise ValueError("time data %r does not match format '%%B'" % name)
+
+
+def decode(value):
+    return value.decode("utf-8")
+
+
+# Coercion plans by model class and column names.
+coercion_plans = {}
+
+
+class CoercionPlan(object):
+    """
+    Coerces rows of values for one model and one list of column names. Column
+    converters and names are resolved when the plan is built, so coercing a
+    row is a single pass over its values followed by the model's derived
+    fields.
+    """
+    def __init__(self, fields, derive):
+        """
+        Takes a list of (name, converter) pairs in column order and a function
+        that adds derived fields to a dictionary of converted values.
+        """
+        self.fields = fields
+        self.derive = derive
+
+    def __call__(self, row):
+        """
+        Returns a dictionary of coerced values for the non-empty values of the
+        given row or None if the row is empty.
+        """
+        values = {}
+        for (name, convert), value in izip(self.fields, row):
+            if value:
+                values[name] = convert(value)
+
+        if not values:
+            return None
+
+        return self.derive(values)
+
+
+# NumPy types that columns of integer and float properties are converted to
+# in bulk by columnar plans.
+NUMPY_TYPES = {
+    schema.IntegerProperty: "int64",
+    schema.FloatProperty: "float64"
+}
+
+# Columnar plans by model class and column names.
+columnar_plans = {}
+
+
+def full_column(value, size):
+    """
+    Returns a column of the given size with the given value in every row.
+    """
+    values = numpy.empty(size, dtype=object)
+    values.fill(value)
+    return values, numpy.ones(size, dtype=bool)
+
+
+class ColumnarPlan(object):
+    """
+    Coerces chunks of rows for one model and one list of column names a column
+    at a time. Integer and float columns are converted in bulk with NumPy, the
+    model's ``derive_columns`` adds derived fields to whole columns, and only
+    the final JSON-ready documents are built row by row.
+
+    Columns are kept as a pair of arrays: the coerced values and whether each
+    row has a value.
+    """
+    def __init__(self, model, columns):
+        self.model = model
+        self.fields = [(column,
+                        NUMPY_TYPES.get(type(model._properties.get(column))),
+                        model.column_converter(column))
+                       for column in columns]
+
+        # Documents start with the JSON of every declared property. Defaults
+        # like lists are copied for each document.
+        self.template = model().to_json()
+        self.mutable_fields = [name for name, value in self.template.items()
+                               if isinstance(value, (list, dict))]
+
+    def __call__(self, rows):
+        """
+        Returns a list with the JSON-ready document for each of the given rows
+        or None if the row is empty.
+
+        Raises ``ValueError`` or ``OverflowError`` if any value can't be
+        converted. Those rows should be coerced one at a time with the model's
+        coercion plan to find the values at fault.
+        """
+        size = len(rows)
+        if size == 0:
+            return []
+
+        raw_columns = list(izip_longest(*rows, fillvalue=""))
+        empty = numpy.ones(size, dtype=bool)
+        columns = {}
+
+        for index, (name, dtype, convert) in enumerate(self.fields):
+            if index < len(raw_columns):
+                raw = numpy.array(raw_columns[index], dtype=object)
+            else:
+                raw = numpy.empty(size, dtype=object)
+                raw.fill("")
+
+            present = raw != ""
+            empty &= ~present
+
+            if dtype is not None:
+                values = numpy.zeros(size, dtype=dtype)
+                values[present] = raw[present].astype(dtype)
+            else:
+                values = numpy.empty(size, dtype=object)
+                values[present] = [convert(value) for value in raw[present]]
+
+            columns[name] = values, present
+
+        self.model.derive_columns(columns, size)
+
+        names = columns.keys()
+        value_lists = [columns[name][0].tolist() for name in names]
+        present_lists = [columns[name][1].tolist() for name in names]
+        unique = hasattr(self.model, "_unique_fields")
+
+        docs = [None] * size
+        for row in numpy.flatnonzero(~empty).tolist():
+            doc = dict(self.template)
+            for name in self.mutable_fields:
+                doc[name] = copy.deepcopy(doc[name])
+
+            for name, values, present in izip(names, value_lists,
+                                              present_lists):
+                if present[row]:
+                    doc[name] = values[row]
+
+            if unique:
+                doc["_id"] = self.model.unique_id(doc)
+
+            docs[row] = doc
+
+        return docs
 
 
 class CoercedDocument(schema.Document):
@@ -67,6 +253,9 @@ class CoercedDocument(schema.Document):
     class Meta:
         app_label = "cushion"
 
+    # Whether chunks of rows can be coerced a column at a time.
+    _columnar = False
+
     @classmethod
     def coerce(cls, values):
         """
@@ -76,22 +265,121 @@ class CoercedDocument(schema.Document):
         values it returns.
         """
         for key, value in values.items():
-            values[key] = value = value.decode("utf-8")
-            if key in cls._properties:
-                try:
-                    values[key] = cls._properties[key].to_python(value)
-                except ValueError, e:
-                    raise BadValueError("Attribute '%s' with value '%s' couldn't be validated: %s"
-                                        % (key, value, e.message))
+            values[key] = cls.column_converter(key)(value)
+
+        return values
+
+    @classmethod
+    def derive(cls, values):
+        """
+        Adds fields derived from the given dictionary of coerced values and
+        returns the dictionary.
 
+        Subclasses that override ``coerce`` should move their extra
+        manipulation here so it can be shared with coercion plans.
+        """
         return values
 
+    @classmethod
+    def column_converter(cls, key):
+        """
+        Returns a function that decodes a raw value for the given attribute
+        name and converts it to the type of the attribute's property, if any.
+        """
+        if key not in cls._properties:
+            return decode
+
+        to_python = cls._properties[key].to_python
+
+        def convert(value):
+            value = decode(value)
+            try:
+                return to_python(value)
+            except ValueError, e:
+                raise BadValueError("Attribute '%s' with value '%s' couldn't be validated: %s"
+                                    % (key, value, e.message), key, value)
+
+        return convert
+
+    @classmethod
+    def derive_columns(cls, columns, size):
+        """
+        Adds the fields of ``derive`` to whole columns of coerced values for a
+        chunk of the given number of rows.
+
+        The columns are a dictionary of a pair of arrays for each field, the
+        coerced values and whether each row has a value, and are changed in
+        place. Like ``derive``, this adds nothing by default. Models that
+        override ``derive`` should override this to match and set
+        ``_columnar`` so chunks of their rows are coerced with a
+        ``ColumnarPlan``.
+        """
+        pass
+
+    @classmethod
+    def columnar_plan(cls, columns):
+        """
+        Returns the cached columnar plan for rows with the given column names,
+        or None if the model doesn't support one or NumPy isn't installed.
+        """
+        if not cls._columnar or numpy is None:
+            return None
+
+        key = (cls, tuple(columns))
+        plan = columnar_plans.get(key)
+        if plan is None:
+            plan = columnar_plans[key] = ColumnarPlan(cls, columns)
+
+        return plan
+
+    @classmethod
+    def coercion_plan(cls, columns):
+        """
+        Returns the cached coercion plan for rows with the given column names.
+        The plan produces the same values as ``coerce`` for each row.
+        """
+        key = (cls, tuple(columns))
+        plan = coercion_plans.get(key)
+        if plan is None:
+            plan = coercion_plans[key] = cls.build_coercion_plan(columns)
+
+        return plan
+
+    @classmethod
+    def build_coercion_plan(cls, columns):
+        """
+        Builds a coercion plan for rows with the given column names.
+        """
+        for klass in cls.__mro__:
+            if klass is CoercedDocument:
+                break
+
+            # Fall back to passing the raw values of each row to ``coerce``
+            # when a subclass customizes it without providing derived fields
+            # or a plan.
+            if ("coerce" in vars(klass) and "derive" not in vars(klass)
+                and "build_coercion_plan" not in vars(klass)):
+                return CoercionPlan([(column, str) for column in columns],
+                                    cls.coerce)
+
+        return CoercionPlan([(column, cls.column_converter(column))
+                             for column in columns],
+                            cls.derive)
+
 
 class CoercedUniqueDocument(UniqueDocument, CoercedDocument):
     pass
 
 
 class Label(CoercedDocument):
+    # Mapping of CSV column names to document attribute names. Other column
+    # names are lowercased.
+    _column_map = {
+        "Filename": "_id",
+        "Site Name": "city",
+        "State/Location": "state"
+    }
+
     @property
     def get_id(self):
         return getattr(self, "_id", None)
@@ -101,19 +389,19 @@ class Label(CoercedDocument):
         """
         Perform extra manipulation of coerced data.
         """
-        # Define mapping of CSV column names to document attribute names.
-        map_columns = {
-            "Filename": "_id",
-            "Site Name": "city",
-            "State/Location": "state"
-        }
-
         values = super(Label, cls).coerce(values)
 
         # Map column names and strip whitespace from values.
-        values = dict([(map_columns.get(key, key.lower()), value.strip())
+        values = dict([(cls._column_map.get(key, key.lower()), value.strip())
                        for key, value in values.items()])
 
+        return cls.derive(values)
+
+    @classmethod
+    def derive(cls, values):
+        """
+        Add fields derived from the coerced data.
+        """
         # Add a species.
         values["species"] = values["_id"].split("-")[0]
 
@@ -133,7 +421,7 @@ class Label(CoercedDocument):
 
         # Change month from long name to decimal.
         if values.get("month"):
-            values["month"] = str(datetime.datetime.strptime(values["month"], "%B").month)
+            values["month"] = month_number(values["month"])
 
         # Add a modification timestamp.
         values["date_modified"] = datetime.datetime.now().isoformat()
@@ -143,6 +431,18 @@ class Label(CoercedDocument):
 
         return values
 
+    @classmethod
+    def build_coercion_plan(cls, columns):
+        fields = []
+        for column in columns:
+            convert = cls.column_converter(column)
+            fields.append((
+                cls._column_map.get(column, column.lower()),
+                lambda value, convert=convert: convert(value).strip()
+            ))
+
+        return CoercionPlan(fields, cls.derive)
+
 registry.register("Label", Label)
 
 
@@ -172,23 +472,32 @@ class Specimen(CoercedUniqueDocument):
     )
     _protected_collections = ("RBC",)
 
+    _columnar = True
+    _feet_per_meter = 3.280839895013123
+
     @classmethod
     def coerce(cls, values):
         """
         Perform extra manipulation of coerced data.
         """
         values = super(Specimen, cls).coerce(values)
+        return cls.derive(values)
 
+    @classmethod
+    def derive(cls, values):
+        """
+        Add fields derived from the coerced data.
+        """
         # Convert meters to feet using a decimal conversion value and cast
         # result back to the same type.
         if "elevation" in values and values.get("elevation_units") == "m.":
-            feet_per_meter = 3.280839895013123
             try:
-                values["elevation"] = cls._properties["elevation"].to_python(values["elevation"] * feet_per_meter)
+                values["elevation"] = cls._properties["elevation"].to_python(values["elevation"] * cls._feet_per_meter)
                 values["elevation_units"] = "ft."
             except TypeError, e:
                 # TODO: get rid of this special exception.
-                raise BadValueError("Elevation can't be converted to meters: %s" % str(e.message))
+                raise BadValueError("Elevation can't be converted to meters: %s" % str(e.message),
+                                    "elevation", values["elevation"])
 
         # Mark protected documents.
         if values.get("collection") in cls._protected_collections:
@@ -199,4 +508,37 @@ class Specimen(CoercedUniqueDocument):
 
         return values
 
+    @classmethod
+    def derive_columns(cls, columns, size):
+        """
+        Add the fields of ``derive`` to a chunk of coerced columns.
+        """
+        if "elevation" in columns and "elevation_units" in columns:
+            elevation, has_elevation = columns["elevation"]
+            units, has_units = columns["elevation_units"]
+            meters = has_elevation & has_units & (units == "m.")
+
+            if meters.any():
+                feet = numpy.trunc(elevation * cls._feet_per_meter)
+                if numpy.abs(feet[meters]).max() >= 2 ** 63:
+                    raise OverflowError("Elevation in feet is too large.")
+
+                elevation = numpy.where(meters, feet, elevation).astype(elevation.dtype)
+                units = units.copy()
+                units[meters] = "ft."
+                columns["elevation"] = elevation, has_elevation
+                columns["elevation_units"] = units, has_units
+
+        if "collection" in columns:
+            collection, has_collection = columns["collection"]
+            protected = numpy.zeros(size, dtype=bool)
+            for name in cls._protected_collections:
+                protected |= has_collection & (collection == name)
+
+            columns["is_protected"] = numpy.ones(size, dtype=bool), protected
+
+        columns["date_modified"] = full_column(
+            datetime.datetime.now().isoformat(), size
+        )
+
 registry.register("Specimen", Specimen)
@@ -0,0 +1,306 @@
+"""
+Searches a local full-text index of the documents of each database.
+
+Apps declare which fields of which document types to index in a
+``search_indexes`` module by registering a ``SearchIndex`` for the document
+type with ``registry``. The modules are found by ``cushion.autodiscover``.
+
+The index of a database is a SQLite file in ``CUSHION_SEARCH_DIR`` with an FTS4
+table per document type, whose columns are the indexed fields. Words are
+matched regardless of case and accents. It is kept up to
+date by reading the database's ``_changes`` feed from the last sequence that
+was indexed, so updates only cost as much as the changes made since the last
+one.
+"""
+from contextlib import closing
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import urllib
+
+from django.conf import settings
+from django.utils import simplejson
+
+from models import Registry
+
+# Number of changes read with their documents per request while updating an
+# index.
+CHANGES_BATCH_SIZE = 500
+
+registry = Registry()
+_discovered = False
+_lock = threading.Lock()
+
+
+class SearchIndex(object):
+    """
+    Declares the fields to index for documents with one ``doc_type``.
+    """
+    fields = ()
+
+    def prepare(self, doc):
+        """
+        Returns the text to index for each field of the given document.
+        """
+        return [field_text(doc.get(field)) for field in self.fields]
+
+
+def field_text(value):
+    if value is None:
+        return ""
+    elif isinstance(value, (list, tuple)):
+        return u" ".join([field_text(item) for item in value])
+    elif isinstance(value, str):
+        return value.decode("utf-8")
+
+    return unicode(value)
+
+
+def get_indexes():
+    """
+    Returns the registered search indexes by document type, importing the
+    ``search_indexes`` module of each installed app the first time.
+    """
+    global _discovered
+
+    with _lock:
+        if not _discovered:
+            from cushion import autodiscover
+            autodiscover()
+            _discovered = True
+
+    return dict(registry)
+
+
+def index_path(database_name):
+    # Database names may contain slashes, which can't be part of a file name.
+    directory = getattr(settings, "CUSHION_SEARCH_DIR", None) or tempfile.gettempdir()
+    return os.path.join(directory, "cushion-search-%s.sqlite"
+                                   % urllib.quote(database_name, ""))
+
+
+def remove_index(database_name):
+    """
+    Deletes the index of the database with the given name, which has to be
+    built again from the start if the database is created again.
+    """
+    try:
+        os.remove(index_path(database_name))
+    except OSError:
+        pass
+
+
+def quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def table_name(doc_type):
+    return quote("fields_%s" % doc_type)
+
+
+def match_expression(query, prefix=False):
+    """
+    Returns an FTS query matching documents with all the words of the given
+    query, or words starting with them if ``prefix`` is set. Anything other
+    than words is ignored so user input can't form FTS query syntax.
+    """
+    words = re.findall(r"\w+", query, re.UNICODE)
+    if prefix:
+        words = ["%s*" % word for word in words]
+
+    return u" ".join(words)
+
+
+class LocalIndex(object):
+    """
+    The search index of one database.
+    """
+    def __init__(self, database_name, indexes=None):
+        self.database_name = database_name
+        self.path = index_path(database_name)
+        if indexes is None:
+            indexes = get_indexes()
+        self.indexes = indexes
+        self.prepare()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.isolation_level = None
+        return connection
+
+    def prepare(self):
+        """
+        Creates the index tables. If the indexed document types or fields have
+        changed since the index was built, the index is emptied to be built
+        again from the start of the changes feed.
+        """
+        schema = simplejson.dumps(sorted(
+            [(doc_type, list(index.fields))
+             for doc_type, index in self.indexes.items()]
+        ))
+
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("CREATE TABLE IF NOT EXISTS meta "
+                                   "(name TEXT PRIMARY KEY, value TEXT)")
+                connection.execute("CREATE TABLE IF NOT EXISTS documents "
+                                   "(id INTEGER PRIMARY KEY, "
+                                   "doc_id TEXT UNIQUE NOT NULL, "
+                                   "doc_type TEXT NOT NULL)")
+
+                if self.get_meta(connection, "schema") != schema:
+                    # Dropping a virtual table drops its shadow tables too.
+                    tables = connection.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'table' "
+                        "AND sql LIKE 'CREATE VIRTUAL TABLE%'"
+                    ).fetchall()
+                    for (name,) in tables:
+                        connection.execute("DROP TABLE %s" % quote(name))
+
+                    connection.execute("DELETE FROM documents")
+                    connection.execute("DELETE FROM meta")
+
+                    for doc_type, index in self.indexes.items():
+                        connection.execute(
+                            "CREATE VIRTUAL TABLE %s USING "
+                            "fts4(%s, tokenize=unicode61)" % (
+                                table_name(doc_type),
+                                ", ".join([quote(field)
+                                           for field in index.fields])
+                            )
+                        )
+
+                    self.set_meta(connection, "schema", schema)
+                    self.set_meta(connection, "last_seq", simplejson.dumps(0))
+
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+
+    def get_meta(self, connection, name):
+        row = connection.execute("SELECT value FROM meta WHERE name = ?",
+                                 (name,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def set_meta(self, connection, name, value):
+        connection.execute("INSERT OR REPLACE INTO meta (name, value) "
+                           "VALUES (?, ?)", (name, value))
+
+    def last_seq(self):
+        """
+        Returns the sequence of the last change in the index.
+        """
+        with closing(self.connect()) as connection:
+            return simplejson.loads(self.get_meta(connection, "last_seq"))
+
+    def update(self, database, batch_size=CHANGES_BATCH_SIZE):
+        """
+        Indexes the changes made to the given database since the last update
+        and returns the number of changes read.
+        """
+        num_changes = 0
+
+        while True:
+            since = self.last_seq()
+            feed = database.res.get("_changes", since=since, limit=batch_size,
+                                    include_docs="true").json_body
+            results = feed["results"]
+            if not results:
+                return num_changes
+
+            with closing(self.connect()) as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    # Another process has indexed these changes already.
+                    stored_seq = self.get_meta(connection, "last_seq")
+                    if simplejson.loads(stored_seq) != since:
+                        connection.execute("ROLLBACK")
+                        continue
+
+                    for change in results:
+                        self.index_change(connection, change)
+
+                    self.set_meta(connection, "last_seq",
+                                  simplejson.dumps(feed["last_seq"]))
+                    connection.execute("COMMIT")
+                except:
+                    connection.execute("ROLLBACK")
+                    raise
+
+            num_changes += len(results)
+            if len(results) < batch_size:
+                return num_changes
+
+    def index_change(self, connection, change):
+        """
+        Replaces the indexed fields of the changed document with those of its
+        new revision.
+        """
+        row = connection.execute(
+            "SELECT id, doc_type FROM documents WHERE doc_id = ?",
+            (change["id"],)
+        ).fetchone()
+        if row is not None:
+            id, doc_type = row
+            connection.execute("DELETE FROM %s WHERE docid = ?"
+                               % table_name(doc_type), (id,))
+            connection.execute("DELETE FROM documents WHERE id = ?", (id,))
+
+        doc = change.get("doc")
+        if change.get("deleted") or doc is None:
+            return
+
+        index = self.indexes.get(doc.get("doc_type"))
+        if index is None:
+            return
+
+        cursor = connection.execute(
+            "INSERT INTO documents (doc_id, doc_type) VALUES (?, ?)",
+            (change["id"], doc["doc_type"])
+        )
+        connection.execute(
+            "INSERT INTO %s (docid, %s) VALUES (?, %s)" % (
+                table_name(doc["doc_type"]),
+                ", ".join([quote(field) for field in index.fields]),
+                ", ".join(["?"] * len(index.fields))
+            ),
+            [cursor.lastrowid] + index.prepare(doc)
+        )
+
+    def search(self, doc_type, query, field=None, prefix=False, limit=50):
+        """
+        Returns the ids of up to ``limit`` documents of the given type with
+        all the words of the given query in the given field, or in any indexed
+        field if no field is given. With ``prefix``, words of the documents
+        only need to start with the words of the query.
+        """
+        index = self.indexes[doc_type]
+        expression = match_expression(query, prefix)
+        if not expression:
+            return []
+
+        if field is None:
+            column = table_name(doc_type)
+        elif field in index.fields:
+            column = quote(field)
+        else:
+            raise ValueError("'%s' isn't indexed for %s documents."
+                             % (field, doc_type))
+
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT documents.doc_id FROM %s JOIN documents "
+                "ON documents.id = %s.docid WHERE %s MATCH ? LIMIT ?" % (
+                    table_name(doc_type),
+                    table_name(doc_type),
+                    column
+                ),
+                (expression, limit)
+            ).fetchall()
+
+        return [doc_id for (doc_id,) in rows]
@@ -0,0 +1,16 @@
+"""
+Search indexes for Cushion's own models.
+"""
+from search import SearchIndex, registry
+
+
+class SpecimenIndex(SearchIndex):
+    fields = ("genus", "species", "collector", "collection")
+
+
+class LabelIndex(SearchIndex):
+    fields = ("species", "city", "state", "collector")
+
+
+registry.register("Specimen", SpecimenIndex())
+registry.register("Label", LabelIndex())
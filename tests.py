@@ -1,4 +1,1003 @@
 """
 Cushion tests.
 """
+import collections
+import datetime
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+import urllib
+import uuid
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.test.client import Client, RequestFactory
+from couchdbkit.exceptions import ResourceNotFound
+from restkit.errors import Unauthorized
+from django.utils import simplejson
+
+from archives import document_id
+from benchmarks import (
+    by_genus,
+    fake_server,
+    page_request,
+    specimen_docs,
+    write_specimen_csv
+)
+import couch
+from compaction import fragmentation, task_database, visible_compaction_tasks
+from exporter import export_csv
+from fakecouch import SortedRows
+from forms import ImportDataForm, get_form_for_document
+from middleware import server_timing
+from importer import (
+    DuplicateIndex,
+    coerce_rows,
+    coerce_rows_parallel,
+    describe_error,
+    existing_rows,
+    read_csv
+)
+from jobs import (
+    ImportProgress,
+    get_progress,
+    job_path,
+    progress_key,
+    resume_import,
+    run_import,
+    submit_import,
+    write_state
+)
+from management.commands import cushion_update_index
+from models import (
+    BadValueError,
+    CoercedDocument,
+    Label,
+    Specimen,
+    month_number,
+    numpy
+)
+from search import index_path, match_expression
+from utils import LRUCache, gather
+from views import (
+    all_doc_revisions,
+    attachment,
+    changes,
+    changes_feed,
+    database as database_page,
+    document,
+    empty_database,
+    recreate_database,
+    view
+)
+
+
+def by_half(doc):
+    yield doc["number"] // 2, None
+
+
+def without_timestamp(values):
+    values = dict(values)
+    values.pop("date_modified", None)
+    return values
+
+
+class CoercionPlanTestCase(unittest.TestCase):
+    """
+    Checks that coercion plans produce the same values as ``coerce``.
+    """
+    def assertEquivalent(self, model, columns, rows):
+        plan = model.coercion_plan(columns)
+
+        for row in rows:
+            values = dict([(name, value) for name, value in zip(columns, row)
+                           if value])
+            try:
+                expected = model.coerce(values)
+            except (KeyError, ValueError), e:
+                self.assertRaises(e.__class__, plan, row)
+                try:
+                    plan(row)
+                except e.__class__, plan_error:
+                    self.assertEqual(str(e), str(plan_error))
+                continue
+
+            self.assertEqual(without_timestamp(expected),
+                             without_timestamp(plan(row)))
+
+    def test_specimen(self):
+        columns = ["genus", "species", "latitude", "longitude", "year",
+                   "month", "day", "collector", "collection", "elevation",
+                   "elevation_units", "notes"]
+        rows = [
+            ["Genus", "species", "49.25", "-123.1", "1999", "7", "4",
+             "Collector", "UBC", "100", "ft.", "Notes"],
+            ["Genus", "species", "49.25", "-123.1", "1999", "7", "4",
+             "Collector", "RBC", "100", "m.", ""],
+            ["Genus", "", "", "", "", "", "", "", "", "", "", "Caf\xc3\xa9"],
+            ["Genus", "species", "north"],
+            ["Genus", "species", "1", "2", "", "", "", "", "", "high", "m."],
+            ["Genus", "species"],
+            ["Genus", "species", "1", "2", "1999", "7", "4", "Collector",
+             "UBC", "100", "ft.", "Notes", "extra"],
+        ]
+        self.assertEquivalent(Specimen, columns, rows)
+
+    def test_label(self):
+        columns = ["Filename", "Site Name", "State/Location", "Elevation",
+                   "Month", "Collector"]
+        rows = [
+            ["sp-1", " Vancouver ", "Canada: BC", "100 ft", "March", "A"],
+            ["sp-2", "Seattle", "WA", "30m", "june", ""],
+            ["sp-3", "", "", "", "", " B "],
+            ["sp-4", "Seattle", "WA", "30", "Juneteenth", ""],
+            ["", "Seattle", "WA"],
+        ]
+        self.assertEquivalent(Label, columns, rows)
+
+    def test_plan_is_cached(self):
+        columns = ["genus", "species"]
+        self.assertTrue(Specimen.coercion_plan(columns) is
+                        Specimen.coercion_plan(list(columns)))
+        self.assertFalse(Specimen.coercion_plan(columns) is
+                         Label.coercion_plan(columns))
+
+    def test_empty_row(self):
+        self.assertEqual(None, Specimen.coercion_plan(["genus"])([""]))
+        self.assertEqual(None, Specimen.coercion_plan(["genus"])([]))
+
+    def test_custom_coerce(self):
+        class Custom(CoercedDocument):
+            @classmethod
+            def coerce(cls, values):
+                values = super(Custom, cls).coerce(values)
+                values["name"] = values["name"].upper()
+                return values
+
+        self.assertEquivalent(Custom, ["name"], [["custom"]])
+
+    def test_month_number(self):
+        for month in xrange(1, 13):
+            name = datetime.date(2000, month, 1).strftime("%B")
+            self.assertEqual(
+                str(datetime.datetime.strptime(name, "%B").month),
+                month_number(name.upper())
+            )
+
+        self.assertRaises(ValueError, month_number, "Smarch")
+
+    def test_bad_value(self):
+        plan = Specimen.coercion_plan(["latitude"])
+        self.assertRaises(BadValueError, plan, ["north"])
+
+        try:
+            plan(["north"])
+        except BadValueError, e:
+            error = describe_error(e)
+            self.assertEqual(("BadValueError", "latitude", u"north"),
+                             (error["type"], error["column"], error["value"]))
+
+
+class ColumnarPlanTestCase(unittest.TestCase):
+    """
+    Checks that columnar coercion produces the same documents and errors as
+    coercing one row at a time.
+    """
+    def results(self, columns, rows, columnar):
+        results = []
+        for line_num, doc, error in coerce_rows(Specimen, columns,
+                                                enumerate(rows), columnar):
+            if error is None:
+                doc = without_timestamp(doc.to_json())
+            results.append((line_num, doc, error))
+        return results
+
+    @unittest.skipIf(numpy is None, "NumPy isn't installed.")
+    def test_specimen(self):
+        columns = ["genus", "species", "latitude", "longitude", "year",
+                   "month", "day", "collector", "collection", "elevation",
+                   "elevation_units", "notes"]
+        rows = [
+            ["Genus", "species", "49.25", "-123.1", "1999", "7", "4",
+             "Collector", "UBC", "100", "ft.", "Notes"],
+            ["Genus", "species", "49.25", "-123.1", "1999", "7", "4",
+             "Collector", "RBC", "-101", "m.", ""],
+            ["Genus", "", "", "", "", "", "", "", "", "", "", "Caf\xc3\xa9"],
+            [],
+            ["Genus", "species", "1", "2", "1999", "7", "4", "Collector",
+             "UBC", "100", "ft.", "Notes", "extra"],
+        ]
+        self.assertEqual(self.results(columns, rows, False),
+                         self.results(columns, rows, True))
+
+        rows.append(["Genus", "species", "north"])
+        self.assertEqual(self.results(columns, rows, False),
+                         self.results(columns, rows, True))
+
+    @unittest.skipIf(numpy is None, "NumPy isn't installed.")
+    def test_without_derived_columns(self):
+        class Count(CoercedDocument):
+            _columnar = True
+
+        columns = ["name", "count"]
+        rows = [["a", "1"], [], ["b", ""]]
+        self.assertEqual(
+            [dict(Count.coerce({"name": "a", "count": "1"}), doc_type="Count"),
+             None,
+             dict(Count.coerce({"name": "b"}), doc_type="Count")],
+            Count.columnar_plan(columns)(rows)
+        )
+
+
+class ParallelCoercionTestCase(unittest.TestCase):
+    """
+    Checks that coercing rows across processes produces the same documents and
+    errors, in the same order, as coercing them in this process.
+    """
+    columns = ["genus", "species", "latitude", "longitude", "year", "month",
+               "day", "collector", "collection", "elevation",
+               "elevation_units", "notes"]
+
+    def results(self, results):
+        return [(line_num,
+                 without_timestamp(doc.to_json()) if error is None else doc,
+                 error)
+                for line_num, doc, error in results]
+
+    def test_specimen(self):
+        rows = [
+            ["Genus", "species", "49.25", "-123.1", "1999", "7", "4",
+             "Collector", "UBC", "100", "ft.", "Notes"],
+            ["Genus", "species", "north"],
+            ["Genus", "", "", "", "", "", "", "", "", "", "", "Caf\xc3\xa9"],
+            [],
+            ["Genus", "species", "1", "2", "1999", "7", "4", "Collector",
+             "RBC", "-101", "m.", ""],
+        ] * 3
+
+        expected = self.results(coerce_rows(Specimen, self.columns,
+                                            enumerate(rows)))
+        self.assertEqual(expected, self.results(coerce_rows_parallel(
+            "Specimen", self.columns, enumerate(rows), processes=2,
+            chunk_size=4
+        )))
+
+
+class SortedRowsTestCase(unittest.TestCase):
+    """
+    Checks the view queries answered by the fake CouchDB server.
+    """
+    def setUp(self):
+        self.rows = SortedRows([
+            ([u"b", 2], u"d4", None),
+            ([u"a", 1], u"d2", None),
+            ([u"a", 1], u"d1", None),
+            (None, u"d0", None),
+            ([u"b", {}], u"d5", None),
+            (7, u"d3", None),
+        ])
+
+    def ids(self, **params):
+        params = dict([(name, value if isinstance(value, basestring)
+                        else simplejson.dumps(value))
+                       for name, value in params.items()])
+        offset, rows, rows_read = self.rows.query(params)
+        return offset, [row[1] for row in rows]
+
+    def test_collation(self):
+        self.assertEqual((0, [u"d0", u"d3", u"d1", u"d2", u"d4", u"d5"]),
+                         self.ids())
+
+    def test_key_range(self):
+        self.assertEqual((2, [u"d1", u"d2", u"d4"]),
+                         self.ids(startkey=[u"a"], endkey=[u"b", 2]))
+        self.assertEqual((2, [u"d1", u"d2"]),
+                         self.ids(startkey=[u"a"], endkey=[u"b", 2],
+                                  inclusive_end="false"))
+        self.assertEqual((1, [u"d4", u"d2", u"d1"]),
+                         self.ids(startkey=[u"b", 2], endkey=[u"a"],
+                                  descending="true"))
+        self.assertEqual((2, [u"d1", u"d2"]), self.ids(key=[u"a", 1]))
+
+    def test_keyset_paging(self):
+        self.assertEqual((4, [u"d4", u"d5"]),
+                         self.ids(startkey=[u"a", 1], startkey_docid=u"d2",
+                                  skip=1, limit=2))
+        self.assertEqual((3, [u"d1", u"d3"]),
+                         self.ids(startkey=[u"a", 1], startkey_docid=u"d1",
+                                  descending="true", limit=2))
+
+
+class DuplicateIndexTestCase(unittest.TestCase):
+    def test_duplicates(self):
+        index = DuplicateIndex(recent_size=2)
+        first = Specimen(genus=u"Genus", species=u"one")
+        self.assertTrue(index.add(first))
+        self.assertTrue(index.add(Specimen(genus=u"Genus", species=u"two")))
+        self.assertFalse(index.add(Specimen(genus=u"Genus", species=u"one")))
+        self.assertEqual(first.to_json(),
+                         index.original(Specimen(genus=u"Genus", species=u"one")))
+
+        # Only the most recent documents are kept to compare with.
+        self.assertTrue(index.add(Specimen(genus=u"Genus", species=u"three")))
+        self.assertEqual(None, index.original(first))
+        self.assertFalse(index.add(first))
+
+    def test_saved_documents(self):
+        index = DuplicateIndex()
+        first = Specimen(genus=u"Genus", species=u"one")
+        index.add(first)
+        first._doc["_rev"] = "1-a"
+        self.assertFalse("_rev" in index.original(first))
+
+    def test_ids_that_are_not_digests(self):
+        index = DuplicateIndex()
+        self.assertTrue(index.add(Label(_id="label-1")))
+        self.assertFalse(index.add(Label(_id="label-1")))
+        self.assertTrue(index.add(Label()))
+        self.assertTrue(index.add(Label()))
+
+
+class ResumeImportTestCase(unittest.TestCase):
+    def test_only_failed_jobs_are_resumed(self):
+        for status in ("queued", "running", "done"):
+            cache.set(progress_key(status), {"status": status})
+            self.assertFalse(resume_import(status, None))
+
+
+class ReadCSVTestCase(unittest.TestCase):
+    def test_resume_from_position(self):
+        fh = tempfile.TemporaryFile()
+        fh.write('a,,b\n1,x,2\n"3\n4",y,5\n\n6,z,7\n')
+        fh.seek(0)
+
+        positions = collections.deque()
+        column_names, rows = read_csv(fh, ",", positions=positions)
+        rows = list(rows)
+        self.assertEqual(["a", "b"], column_names)
+        self.assertEqual([2, 4, 5, 6], [line_num for line_num, row in rows])
+        self.assertEqual(4, len(positions))
+
+        # Resume after the row spanning two lines.
+        line_num, offset = positions[1]
+        checkpoint = {"line_num": line_num, "offset": offset,
+                      "column_names": column_names}
+        column_names, resumed_rows = read_csv(fh, ",", checkpoint)
+        self.assertEqual(rows[2:], list(resumed_rows))
+
+
+class GatherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPool(3)
+
+    def tearDown(self):
+        self.pool.terminate()
+
+    def test_gather(self):
+        self.assertEqual([1, 2, 3],
+                         gather(self.pool, [lambda: 1, lambda: 2, lambda: 3]))
+
+    def test_exceptions(self):
+        def fail():
+            raise ValueError("Bad value")
+
+        self.assertRaises(ValueError, gather, self.pool, [lambda: 1, fail])
+        results = gather(self.pool, [lambda: 1, fail], return_exceptions=True)
+        self.assertEqual(1, results[0])
+        self.assertTrue(isinstance(results[1], ValueError))
+
+    def test_timeout(self):
+        blocked = threading.Event()
+        try:
+            results = gather(self.pool, [lambda: 1, blocked.wait], timeout=0.1,
+                             return_exceptions=True)
+        finally:
+            blocked.set()
+
+        self.assertEqual(1, results[0])
+        self.assertTrue(isinstance(results[1], TimeoutError))
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_least_recently_used_is_forgotten(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.set("c", 3)
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(["a", "c"], cache.keys())
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+
+class CompactionTestCase(unittest.TestCase):
+    def test_fragmentation(self):
+        self.assertEqual(2.5, fragmentation({"disk_size": 250,
+                                             "data_size": 100}))
+        self.assertEqual(2.0, fragmentation({"disk_size": 1, "data_size": 0,
+                                             "sizes": {"file": 200,
+                                                       "active": 100}}))
+        self.assertEqual(None, fragmentation({"disk_size": 250}))
+
+    def test_task_database(self):
+        self.assertEqual("specimens", task_database({"database": "specimens"}))
+        self.assertEqual("specimens/2012", task_database({
+            "database": "shards/00000000-1fffffff/specimens/2012.1351267391"
+        }))
+
+    def test_tasks_of_non_admins(self):
+        class Server(object):
+            def active_tasks(self):
+                raise Unauthorized("You are not a server admin.")
+
+        self.assertEqual([], visible_compaction_tasks(Server(), "specimens"))
+
+
+class DocumentFormTestCase(unittest.TestCase):
+    def test_forms_are_shared_by_shape(self):
+        form = get_form_for_document({"_id": "a", "type": "t", "count": 1})
+        self.assertTrue(form is get_form_for_document(
+            {"_id": "b", "type": "t", "count": 2}
+        ))
+        self.assertFalse(form is get_form_for_document(
+            {"_id": "c", "type": "t", "count": 1.5}
+        ))
+        self.assertEqual(["_id", "count", "type"], form.base_fields.keys())
+
+    def test_forms_are_shared_without_type(self):
+        form = get_form_for_document({"_id": "a", "doc_type": "Specimen",
+                                      "genus": u"Genus"})
+        self.assertTrue(form is get_form_for_document(
+            {"_id": "b", "doc_type": "Specimen", "genus": u"Other"}
+        ))
+        self.assertEqual("Specimen", form.__name__)
+
+        form = get_form_for_document({"_id": "c", "count": 1})
+        self.assertTrue(form is get_form_for_document({"_id": "d", "count": 2}))
+
+
+class FakeCouchTestCase(unittest.TestCase):
+    """
+    Runs a fake CouchDB server for each test and points Cushion at it.
+    """
+    def setUp(self):
+        self.fake_server = fake_server()
+        self.server = self.fake_server.__enter__()
+
+    def tearDown(self):
+        self.fake_server.__exit__(None, None, None)
+
+
+class ImportTestCase(FakeCouchTestCase):
+    def write_csv(self, rows):
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        fh = os.fdopen(fd, "w")
+        try:
+            write_specimen_csv(fh, rows)
+        finally:
+            fh.close()
+
+        self.addCleanup(os.remove, path)
+        return path
+
+    def form(self, **options):
+        return ImportDataForm.for_options(dict({
+            "model": "Specimen",
+            "delimiter": ",",
+            "overwrite": False,
+            "skip_duplicates": False,
+            "stream": True,
+            "batch_size": 5,
+            "parallel": False
+        }, **options))
+
+    def import_data(self, path, **options):
+        return self.form(**options).import_data(
+            couch.get_database("specimens"), path
+        )
+
+    def wait_for_job(self, job_id, timeout=10):
+        started = time.time()
+        while time.time() - started < timeout:
+            progress = get_progress(job_id)
+            if progress["status"] in ("done", "failed"):
+                return progress
+
+            time.sleep(0.01)
+
+        self.fail("Job %s didn't finish." % job_id)
+
+    def test_stream_with_existing_document(self):
+        self.assertEqual([], self.import_data(self.write_csv(1)))
+
+        errors = self.import_data(self.write_csv(10))
+        self.assertEqual(["Document already exists."],
+                         [message for doc, message in errors])
+        self.assertEqual(10,
+                         couch.get_database("specimens").info()["doc_count"])
+
+    def test_stream_overwriting_existing_document(self):
+        self.assertEqual([], self.import_data(self.write_csv(1)))
+        self.assertEqual([], self.import_data(self.write_csv(10),
+                                              overwrite=True))
+        self.assertEqual(10,
+                         couch.get_database("specimens").info()["doc_count"])
+
+    def test_background_job(self):
+        fh = open(self.write_csv(12))
+        try:
+            upload = SimpleUploadedFile("specimens.csv", fh.read())
+        finally:
+            fh.close()
+
+        database = couch.get_database("specimens")
+        job_id = submit_import(self.form(), database, upload)
+        progress = self.wait_for_job(job_id)
+
+        self.assertEqual("done", progress["status"])
+        self.assertEqual((12, 3, []), (progress["rows_parsed"],
+                                       progress["batches_saved"],
+                                       progress["errors"]))
+        self.assertEqual(12, database.info()["doc_count"])
+        self.assertFalse(os.path.exists(job_path(job_id, "csv")))
+        self.assertFalse(os.path.exists(job_path(job_id, "json")))
+
+    def test_resume_failed_job(self):
+        class FailingDatabase(object):
+            """
+            Fails to save documents after the given number of saves.
+            """
+            def __init__(self, database, saves):
+                self.database = database
+                self.saves = saves
+
+            def __getattr__(self, name):
+                return getattr(self.database, name)
+
+            def bulk_save(self, docs):
+                if self.saves == 0:
+                    raise IOError("The server went away.")
+
+                self.saves -= 1
+                return self.database.bulk_save(docs)
+
+        # Rows 3 and 8 can't be coerced, so the first batch ends at row 6.
+        job_id = uuid.uuid4().hex
+        fh = open(job_path(job_id, "csv"), "w")
+        try:
+            fh.write("genus,species,latitude\n")
+            for i in xrange(1, 13):
+                fh.write("Genus,species%i,%s\n"
+                         % (i, "north" if i in (3, 8) else i))
+        finally:
+            fh.close()
+
+        form = self.form()
+        state = {"database": "specimens", "form": "ImportDataForm",
+                 "options": form.options(), "checkpoint": None}
+        write_state(job_id, state)
+        database = couch.get_database("specimens")
+        run_import(form, FailingDatabase(database, 1),
+                   ImportProgress(job_id, state))
+
+        progress = get_progress(job_id)
+        self.assertEqual(("failed", 2), (progress["status"],
+                                         len(progress["errors"])))
+        self.assertEqual((7, 6), (progress["checkpoint"]["line_num"],
+                                  progress["checkpoint"]["rows"]))
+
+        self.assertTrue(resume_import(job_id, database))
+        self.assertFalse(resume_import(job_id, database))
+        progress = self.wait_for_job(job_id)
+
+        self.assertEqual("done", progress["status"])
+        self.assertEqual(12, progress["rows_parsed"])
+        self.assertEqual(["Row 4:", "Row 9:"],
+                         [message.split("\n")[0]
+                          for doc, message in progress["errors"]])
+        self.assertEqual(10, database.info()["doc_count"])
+
+
+class ExistingRowsTestCase(FakeCouchTestCase):
+    def test_windows(self):
+        self.server.save_docs("specimens", [{"_id": "a"}, {"_id": "c"},
+                                            {"_id": "e"}])
+        database = couch.get_database("specimens")
+        ids = ["a", "b", "c", "d", "e"]
+
+        for window_size, threads in ((2, 1), (2, 3), (10, 3)):
+            self.assertEqual(
+                ["a", "c", "e"],
+                [row["id"] for row in existing_rows(database, ids,
+                                                    window_size, threads)]
+            )
+
+        self.assertEqual([], list(existing_rows(database, [], 2, 3)))
+
+
+class EmptyDatabaseTestCase(FakeCouchTestCase):
+    def setUp(self):
+        super(EmptyDatabaseTestCase, self).setUp()
+        self.server.save_docs("specimens", specimen_docs(2500))
+        self.server.add_view("specimens", "specimens", "by_genus", by_genus)
+        self.database = couch.get_database("specimens")
+
+    def test_all_doc_revisions(self):
+        ids = [doc_id for doc_id, rev in all_doc_revisions(self.database, 7)]
+        self.assertEqual(2501, len(ids))
+        self.assertEqual(sorted(set(ids)), ids)
+
+    def test_empty(self):
+        self.assertEqual(2500, empty_database("specimens", threads=2))
+        self.assertEqual(["_design/specimens"],
+                         [row["id"] for row in self.database.all_docs()])
+
+    def test_recreate(self):
+        security = {"readers": {"names": ["reader"], "roles": []}}
+        self.database.set_security(security)
+
+        self.assertEqual(2500, recreate_database("specimens"))
+        database = couch.get_database("specimens")
+        self.assertEqual(["_design/specimens"],
+                         [row["id"] for row in database.all_docs()])
+        self.assertEqual(security, database.get_security())
+        self.assertEqual(["by_genus"],
+                         database.get("_design/specimens")["views"].keys())
+
+
+class CouchTestCase(FakeCouchTestCase):
+    def requests(self, function):
+        """
+        Returns the method and path of each CouchDB request made by calling
+        the given function.
+        """
+        couch.start_recording()
+        try:
+            function()
+        finally:
+            calls = couch.stop_recording()
+
+        return [(call["method"], call["path"]) for call in calls]
+
+    def test_known_databases(self):
+        self.server.save_docs("specimens", [{"_id": "a"}])
+
+        def get_databases():
+            self.assertTrue(couch.get_database("specimens") is
+                            couch.get_database("specimens"))
+            self.assertEqual(["specimens"], couch.all_dbs())
+
+        self.assertEqual([("GET", "/_all_dbs")], self.requests(get_databases))
+
+    def test_unknown_database(self):
+        self.assertEqual([], couch.all_dbs())
+        self.assertTrue(("PUT", "/labels") in self.requests(
+            lambda: couch.get_database("labels")
+        ))
+        self.assertEqual(["labels"], couch.all_dbs())
+
+    def test_concurrently(self):
+        self.server.save_docs("specimens", [{"_id": "a"}])
+        self.server.save_docs("labels", [{"_id": "b"}])
+        specimens = couch.get_database("specimens")
+        labels = couch.get_database("labels")
+
+        results = []
+        calls = self.requests(lambda: results.extend(couch.concurrently(
+            [specimens.info, labels.info, lambda: labels.get("missing")],
+            return_exceptions=True
+        )))
+        self.assertEqual(["specimens", "labels"],
+                         [info["db_name"] for info in results[:2]])
+        self.assertTrue(isinstance(results[2], ResourceNotFound))
+        self.assertEqual([("GET", "/labels"), ("GET", "/labels/missing"),
+                          ("GET", "/specimens")], sorted(calls))
+
+    def test_database_page(self):
+        self.server.save_docs("specimens", specimen_docs(3))
+        self.server.add_view("specimens", "specimens", "by_genus", by_genus)
+        self.server.active_tasks.append({"type": "database_compaction",
+                                         "database": "specimens",
+                                         "progress": 42})
+        couch.get_database("specimens")
+
+        responses = []
+        calls = self.requests(lambda: responses.append(database_page(
+            page_request("/specimens/"), "specimens"
+        )))
+        self.assertEqual(200, responses[0].status_code)
+        for text in ("All Documents (4)", "by_genus",
+                     '<span id="compaction-0">42</span>%'):
+            self.assertTrue(text in responses[0].content, text)
+
+        self.assertEqual([("GET", "/_active_tasks"),
+                          ("GET", "/specimens"),
+                          ("GET", "/specimens/_all_docs")],
+                         sorted(set(calls)))
+
+    def test_update_index_of_unknown_database(self):
+        self.assertRaises(CommandError,
+                          cushion_update_index.Command().handle, "labels")
+        self.assertEqual([], couch.all_dbs())
+
+    def test_views_by_design_doc(self):
+        self.server.add_view("specimens", "specimens", "by_genus", by_genus)
+        database = couch.get_database("specimens")
+        self.assertEqual({"specimens": ["by_genus"]},
+                         couch.views_by_design_doc(database))
+
+        # Only the revisions of the design documents are checked again.
+        calls = self.requests(lambda: self.assertEqual(
+            {"specimens": ["by_genus"]}, couch.views_by_design_doc(database)
+        ))
+        self.assertEqual([("GET", "/specimens/_all_docs")], calls)
+
+        self.server.add_view("specimens", "specimens", "by_species",
+                             by_genus)
+        self.server.add_view("specimens", "labels", "by_genus", by_genus)
+        self.assertEqual({"labels": ["by_genus"],
+                          "specimens": ["by_genus", "by_species"]},
+                         couch.views_by_design_doc(database))
+
+    def test_view_is_revalidated(self):
+        self.server.save_docs("specimens", specimen_docs(3))
+        self.server.add_view("specimens", "specimens", "by_genus", by_genus)
+        database = couch.get_database("specimens")
+        results = couch.view(database, "specimens/by_genus", limit=2)
+        self.assertTrue(results.etag)
+
+        calls = []
+        cached = self.requests(lambda: calls.append(
+            couch.view(database, "specimens/by_genus", limit=2)
+        ))
+        self.assertEqual(1, len(cached))
+        self.assertTrue(calls[0] is results)
+
+        self.server.save_docs("specimens", [{"_id": "new"}])
+        changed = couch.view(database, "specimens/by_genus", limit=2)
+        self.assertFalse(changed is results)
+        self.assertNotEqual(results.etag, changed.etag)
+
+    def test_forget_database(self):
+        self.server.save_docs("specimens", specimen_docs(3))
+        database = couch.get_database("specimens")
+        couch.view(database, "_all_docs")
+        self.assertEqual(1, len(couch.view_cache.keys()))
+
+        couch.forget_database("specimens")
+        self.assertEqual([], couch.view_cache.keys())
+
+
+class KeysetPagingTestCase(FakeCouchTestCase):
+    """
+    Pages through a view of 12 documents with two rows for each key.
+    """
+    def setUp(self):
+        super(KeysetPagingTestCase, self).setUp()
+        self.server.save_docs("numbers", [{"_id": "doc-%02i" % i, "number": i}
+                                          for i in xrange(12)])
+        self.server.add_view("numbers", "numbers", "by_half", by_half)
+
+    def page(self, **data):
+        """
+        Returns the ids of the rows of a page and its positions to page
+        backward and forward from, if any.
+        """
+        data.update({"paging": "keyset", "limit": 4})
+        response = view(page_request("/numbers/", data), "numbers",
+                        "by_half", "numbers")
+        self.assertEqual(200, response.status_code)
+
+        positions = []
+        for name in ("before", "after"):
+            match = re.search(r'%s=([^&"]+)' % name, response.content)
+            positions.append(match and urllib.unquote(match.group(1)))
+
+        return (re.findall(r"<td>doc-(\d+)</td>", response.content),
+                positions[0], positions[1])
+
+    def test_next_and_previous(self):
+        ids, before, after = self.page()
+        self.assertEqual((["00", "01", "02", "03"], None),
+                         (ids, before))
+
+        ids, before, after = self.page(after=after)
+        self.assertEqual(["04", "05", "06", "07"], ids)
+
+        # The last page is full, so it has no next page.
+        ids, before, after = self.page(after=after)
+        self.assertEqual((["08", "09", "10", "11"], None), (ids, after))
+
+        ids, before, after = self.page(before=before)
+        self.assertEqual(["04", "05", "06", "07"], ids)
+
+        ids, before, after = self.page(before=before)
+        self.assertEqual((["00", "01", "02", "03"], None), (ids, before))
+        self.assertTrue(after)
+
+    def test_jump(self):
+        ids, before, after = self.page(jump="3")
+        self.assertEqual(["06", "07", "08", "09"], ids)
+        self.assertTrue(before and after)
+
+        ids, before, after = self.page(after=after)
+        self.assertEqual((["10", "11"], None), (ids, after))
+
+    def test_not_modified(self):
+        path = "/numbers/"
+        data = {"paging": "keyset", "limit": 4}
+        response = view(page_request(path, data), "numbers", "by_half",
+                        "numbers")
+        self.assertTrue(response["ETag"])
+
+        request = page_request(path, data)
+        request.META["HTTP_IF_NONE_MATCH"] = response["ETag"]
+        self.assertEqual(304, view(request, "numbers", "by_half",
+                                   "numbers").status_code)
+
+        self.server.save_docs("numbers", [{"_id": "doc-12", "number": 12}])
+        self.assertEqual(200, view(request, "numbers", "by_half",
+                                   "numbers").status_code)
+
+    def test_last(self):
+        ids, before, after = self.page(last="1")
+        self.assertEqual((["08", "09", "10", "11"], None), (ids, after))
+
+        ids, before, after = self.page(before=before)
+        self.assertEqual(["04", "05", "06", "07"], ids)
+
+
+class AttachmentTestCase(FakeCouchTestCase):
+    content = "".join([chr(i % 256) for i in xrange(100000)])
+
+    def setUp(self):
+        super(AttachmentTestCase, self).setUp()
+        self.server.save_docs("specimens", [{"_id": "sp-1"}])
+
+        request = RequestFactory().post("/specimens/sp-1/", {
+            "file": SimpleUploadedFile("label.jpg", self.content, "image/jpeg")
+        })
+        page = page_request("/specimens/sp-1/")
+        request.user, request.session, request._messages = (
+            page.user, page.session, page._messages
+        )
+        self.assertEqual(302, document(request, "specimens", "sp-1").status_code)
+
+    def download(self, name="label.jpg", **headers):
+        request = page_request("/specimens/sp-1/_attachments/%s" % name)
+        request.META.update(headers)
+        return attachment(request, "specimens", "sp-1", name)
+
+    def test_download(self):
+        response = self.download()
+        self.assertEqual((200, "image/jpeg", "100000"),
+                         (response.status_code, response["Content-Type"],
+                          response["Content-Length"]))
+        self.assertEqual(self.content, response.content)
+
+        self.assertEqual(304, self.download(
+            HTTP_IF_NONE_MATCH=response["ETag"]
+        ).status_code)
+        self.assertRaises(Http404, self.download, "missing.jpg")
+
+    def test_range(self):
+        response = self.download(HTTP_RANGE="bytes=10-19")
+        self.assertEqual((206, "bytes 10-19/100000"),
+                         (response.status_code, response["Content-Range"]))
+        self.assertEqual(self.content[10:20], response.content)
+
+        self.assertEqual(416, self.download(
+            HTTP_RANGE="bytes=200000-"
+        ).status_code)
+
+
+class ChangesTestCase(FakeCouchTestCase):
+    def setUp(self):
+        super(ChangesTestCase, self).setUp()
+        self.server.save_docs("specimens", [{"_id": "sp-%i" % i}
+                                            for i in xrange(1, 4)])
+
+    def ids(self, response):
+        return re.findall(r">(sp-\d+)</a>", response.content)
+
+    def test_recent_changes(self):
+        response = changes(page_request("/specimens/_changes/",
+                                        {"limit": 2}), "specimens")
+        self.assertEqual(["sp-3", "sp-2"], self.ids(response))
+        self.assertTrue("var since = 3;" in response.content)
+
+        response = changes(page_request("/specimens/_changes/",
+                                        {"since": 1, "limit": 1}), "specimens")
+        self.assertEqual(["sp-2"], self.ids(response))
+        self.assertTrue("Newer" in response.content)
+
+    def test_feed_waits_for_changes(self):
+        timer = threading.Timer(0.1, self.server.save_docs,
+                                ("specimens", [{"_id": "sp-4"}]))
+        timer.start()
+        try:
+            response = changes_feed(page_request("/specimens/_changes/feed/",
+                                                 {"since": 3}), "specimens")
+        finally:
+            timer.join()
+
+        feed = simplejson.loads(response.content)
+        self.assertEqual(4, feed["last_seq"])
+        self.assertEqual([("sp-4", reverse("cushion_document",
+                                           args=("specimens", "sp-4")))],
+                         [(change["id"], change["url"])
+                          for change in feed["results"]])
+
+
+class ArchiveTestCase(unittest.TestCase):
+    def test_document_id(self):
+        self.assertEqual("sp-1", document_id("labels/sp-1.jpg", "stem"))
+        self.assertEqual("sp-1.jpg", document_id("labels/sp-1.jpg", "name"))
+        self.assertEqual("labels/sp-1", document_id("labels/sp-1.jpg", "path"))
+
+
+class ExportTestCase(unittest.TestCase):
+    def test_model_columns(self):
+        rows = [{"id": "a", "key": "a", "value": {},
+                 "doc": {"_id": "a", "_rev": "1-a", "genus": u"G\xe9nus",
+                         "latitude": 1.5, "note": None}}]
+        lines = "".join(export_csv(rows, "Specimen")).splitlines()
+        self.assertEqual("_id,collection,collector,day,elevation,genus,"
+                         "latitude,longitude,month,notes,species,year,note",
+                         lines[0])
+        self.assertEqual("a,,,,,G\xc3\xa9nus,1.5,,,,,,", lines[1])
+
+
+class ServerTimingTestCase(unittest.TestCase):
+    def test_server_timing(self):
+        calls = [{"duration": 0.0125}, {"duration": 0.002}]
+        self.assertEqual('couchdb;dur=14.5;desc="2 requests", total;dur=50.0',
+                         server_timing(calls, 0.05))
+
+
+class CouchTimingMiddlewareTestCase(unittest.TestCase):
+    settings = {
+        "MIDDLEWARE_CLASSES": (
+            "cushion.middleware.CouchTimingMiddleware",
+            "django.contrib.sessions.middleware.SessionMiddleware",
+            "django.middleware.csrf.CsrfViewMiddleware",
+            "django.contrib.auth.middleware.AuthenticationMiddleware"
+        ),
+        "CUSHION_PROFILE_THRESHOLD": 60
+    }
+
+    def setUp(self):
+        self.old_settings = dict([(name, getattr(settings, name, None))
+                                  for name in self.settings])
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+
+    def tearDown(self):
+        for name, value in self.old_settings.items():
+            setattr(settings, name, value)
+
+    def test_csrf_is_checked_while_profiling(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.post(reverse("cushion_index"), {"name": "test"})
+        self.assertEqual(403, response.status_code)
+        self.assertTrue("Server-Timing" in response)
+
+
+class SearchTestCase(unittest.TestCase):
+    def test_match_expression(self):
+        self.assertEqual(u"quercus alba", match_expression(u'"quercus" alba*'))
+        self.assertEqual(u"quer* al*", match_expression(u"quer al", prefix=True))
+        self.assertEqual(u"", match_expression(u"* : -"))
+
+    def test_index_path(self):
+        self.assertEqual("cushion-search-plants%2Fspecimens.sqlite",
+                         os.path.basename(index_path("plants/specimens")))
@@ -1,12 +1,32 @@
 from django.conf.urls.defaults import patterns, url
 
-from views import index, database, view, document
+from views import (
+    index,
+    database,
+    import_progress,
+    compaction_progress,
+    changes,
+    changes_feed,
+    search,
+    view,
+    export,
+    document,
+    attachment
+)
 
 
 urlpatterns = patterns("",
     url(r"^$", index, name="cushion_index"),
     url(r"^(?P<database_name>[-\w]+)/_design/(?P<design_doc_name>\w+)/_view/(?P<view_name>.+)/$", view, name="cushion_view"),
     url(r"^(?P<database_name>[-\w]+)/(?P<view_name>_all_docs)/$", view, name="cushion_view"),
+    url(r"^(?P<database_name>[-\w]+)/_design/(?P<design_doc_name>\w+)/_view/(?P<view_name>[^/]+)/export\.(?P<format>csv|ndjson)$", export, name="cushion_export"),
+    url(r"^(?P<database_name>[-\w]+)/(?P<view_name>_all_docs)/export\.(?P<format>csv|ndjson)$", export, name="cushion_export"),
+    url(r"^(?P<database_name>[-\w]+)/_import/(?P<job_id>\w+)/$", import_progress, name="cushion_import_progress"),
+    url(r"^(?P<database_name>[-\w]+)/_compaction/$", compaction_progress, name="cushion_compaction_progress"),
+    url(r"^(?P<database_name>[-\w]+)/_changes/$", changes, name="cushion_changes"),
+    url(r"^(?P<database_name>[-\w]+)/_changes/feed/$", changes_feed, name="cushion_changes_feed"),
+    url(r"^(?P<database_name>[-\w]+)/_search/$", search, name="cushion_search"),
+    url(r"^(?P<database_name>[-\w]+)/(?P<document_id>.+?)/_attachments/(?P<attachment_name>.+)$", attachment, name="cushion_attachment"),
     url(r"^(?P<database_name>[-\w]+)/(?P<document_id>.+)/$", document, name="cushion_document"),
     url(r"^(?P<database_name>[-\w]+)/$", database, name="cushion_database"),
 #     url(r"^(?P<doc_id>.+)/edit/$", edit, name="cushion_edit"),
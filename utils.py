@@ -0,0 +1,143 @@
+"""
+Helpers shared by Cushion's forms and views.
+"""
+import collections
+import itertools
+import Queue
+import threading
+from multiprocessing import TimeoutError
+
+
+def batches(iterable, size):
+    """
+    Yields lists of up to ``size`` items from the given iterable without
+    reading more than one list of items into memory at a time.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+
+        yield batch
+
+
+def map_ahead(pool, function, arguments, ahead):
+    """
+    Yields the results of calling the given function in the given pool with
+    each tuple of arguments, in order. At most ``ahead`` calls are submitted
+    before their results are consumed, so the arguments can be a generator
+    over more data than fits in memory.
+    """
+    pending = collections.deque()
+
+    for args in arguments:
+        pending.append(pool.apply_async(function, args))
+
+        if len(pending) > ahead:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def gather(pool, functions, timeout=None, return_exceptions=False):
+    """
+    Calls each of the given functions without arguments in the given pool at
+    the same time and returns their results in order once all have returned.
+
+    The first exception raised by a function is raised again, or if
+    ``return_exceptions`` is set, returned in place of its result. Functions
+    that haven't returned within ``timeout`` seconds count as having raised
+    ``TimeoutError``, though they are left running.
+    """
+    functions = list(functions)
+    outcomes = [None] * len(functions)
+    finished = Queue.Queue()
+
+    def call(i, function):
+        try:
+            outcomes[i] = (True, function())
+        except Exception, e:
+            outcomes[i] = (False, e)
+        finally:
+            finished.put(i)
+
+    for i, function in enumerate(functions):
+        pool.apply_async(call, (i, function))
+
+    # Waiting on a queue with a timeout polls in a loop of short sleeps, so
+    # wait without one and have a timer end the wait at the deadline instead.
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, finished.put, (None,))
+        timer.daemon = True
+        timer.start()
+
+    try:
+        for i in range(len(functions)):
+            if finished.get() is None:
+                break
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    results = []
+    for outcome in list(outcomes):
+        if outcome is None:
+            outcome = (False, TimeoutError())
+
+        returned, result = outcome
+        if not returned and not return_exceptions:
+            raise result
+
+        results.append(result)
+
+    return results
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping of at most ``max_size`` items that forgets the least
+    recently used item first. Counts how often looked up keys were found.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        with self._lock:
+            return self._items.keys()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
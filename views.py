@@ -1,29 +1,87 @@
-from couchdbkit import Server
+import functools
+import hashlib
+import itertools
+import logging
 import math
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import time
 import urllib
 
+from couchdbkit.exceptions import ResourceNotFound
+from couchdbkit.resource import RequestFailed, escape_docid
 from django.conf import settings
+from restkit.util import url_quote
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseNotModified,
+    HttpResponseRedirect
+)
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-
+from django.utils import simplejson
+
+from compaction import compact, fragmentation, visible_compaction_tasks
+from couch import (
+    all_dbs,
+    concurrently,
+    forget_database,
+    get_database,
+    get_server,
+    recorded,
+    view as cached_view,
+    views_by_design_doc
+)
 from forms import (
+    AttachArchiveForm,
     AttachFileForm,
     CreateDatabaseForm,
     ImportDataForm,
+    SearchForm,
     form_registry,
     get_form_for_document,
     view_form_registry
 )
+from exporter import CONTENT_TYPES, export_csv, export_ndjson, view_rows
+from jobs import ImportProgress, get_progress, resume_import, submit_import
+from models import registry as registered_models
+from search import LocalIndex, get_indexes, remove_index
+from utils import batches, map_ahead
+
+log = logging.getLogger(__name__)
+
+# Number of changes shown at a time on the changes page and the number of
+# seconds a request for new changes waits for one before returning none.
+CHANGES_LIMIT = 50
+CHANGES_TIMEOUT = 25
+
+# Number of bytes of an attachment to read from CouchDB at a time while
+# streaming it to the browser.
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+# Request headers passed on to CouchDB and response headers passed back when
+# downloading attachments.
+ATTACHMENT_REQUEST_HEADERS = (
+    ("HTTP_RANGE", "Range"),
+    ("HTTP_IF_NONE_MATCH", "If-None-Match"),
+    ("HTTP_IF_RANGE", "If-Range")
+)
+ATTACHMENT_RESPONSE_HEADERS = ("Content-Length", "Content-Range", "ETag",
+                               "Accept-Ranges", "Cache-Control")
 
 
 @login_required
 def index(request):
-    server = Server(settings.COUCHDB_SERVER)
-    databases = [server.get_or_create_db(db).info() for db in server.all_dbs()]
+    server = get_server()
+    databases = database_infos(
+        server,
+        all_dbs(),
+        getattr(settings, "CUSHION_INFO_TIMEOUT", 5)
+    )
 
     create_database_form = CreateDatabaseForm(request.POST or None)
     if create_database_form.is_valid():
@@ -39,46 +97,151 @@ def index(request):
                               context_instance=RequestContext(request))
 
 
-def empty_database(server, database_name):
+def database_info(server, database_name):
+    return server[database_name].info()
+
+
+def database_infos(server, database_names, timeout):
     """
-    Deletes all non-design documents from the given database.
+    Returns the info of each of the given databases, fetched at the same time
+    on the shared pool. Databases whose info couldn't be fetched within the
+    given number of seconds are described by their name and an error.
     """
-    database = server.get_or_create_db(database_name)
+    infos = concurrently(
+        [functools.partial(database_info, server, database_name)
+         for database_name in database_names],
+        timeout=timeout,
+        return_exceptions=True
+    )
+
+    databases = []
+    for database_name, info in zip(database_names, infos):
+        if isinstance(info, TimeoutError):
+            databases.append({"db_name": database_name,
+                              "error": "Timed out"})
+        elif isinstance(info, Exception):
+            log.warning("Couldn't get info for database '%s': %s"
+                        % (database_name, info))
+            databases.append({"db_name": database_name,
+                              "error": str(info)})
+        else:
+            databases.append(info)
+
+    return databases
+
+
+def all_doc_revisions(database, page_size):
+    """
+    Yields a tuple of the id and revision of each document in the given
+    database, reading ids and revisions without document bodies one page at a
+    time using the last id of each page as the start key of the next.
+    """
+    startkey = None
+    while True:
+        params = {"limit": page_size}
+        if startkey is not None:
+            params["startkey"] = startkey
+
+        rows = list(database.all_docs(**params))
+        for row in rows:
+            # The start key is only included in the page if the document
+            # wasn't deleted since the last page was read.
+            if row["id"] != startkey:
+                yield row["id"], row["value"]["rev"]
+
+        if len(rows) < page_size:
+            return
+
+        startkey = rows[-1]["id"]
+
+
+def delete_documents(database, revisions):
+    """
+    Deletes the documents with the given ids and revisions and returns the
+    number of documents deleted.
+    """
+    database.bulk_save([{"_id": doc_id, "_rev": rev, "_deleted": True}
+                        for doc_id, rev in revisions])
+    return len(revisions)
+
+
+def empty_database(database_name, threads=4):
+    """
+    Deletes all non-design documents from the given database, sending up to
+    the given number of batches of deletions at the same time.
+    """
+    database = get_database(database_name)
     documents_per_delete = 1000
-    documents_deleted = 0
-    docs = []
 
-    # Get all non-design document ids.
-    for doc in database.all_docs(include_docs=True):
-        # Ignore design documents.
-        if doc["doc"]["_id"].startswith("_design"):
-            continue
+    # Get all non-design document ids and revisions.
+    revisions = ((doc_id, rev)
+                 for doc_id, rev in all_doc_revisions(database, documents_per_delete)
+                 if not doc_id.startswith("_design"))
+
+    pool = ThreadPool(threads)
+    try:
+        return sum(map_ahead(
+            pool,
+            recorded(delete_documents),
+            ((database, batch) for batch in batches(revisions, documents_per_delete)),
+            threads
+        ))
+    finally:
+        pool.terminate()
+
+
+def recreate_database(database_name):
+    """
+    Deletes all non-design documents from the given database by deleting and
+    recreating the database and restoring its design documents and security
+    object. This is much faster than deleting each document of a large
+    database.
+    """
+    server = get_server()
+    database = get_database(database_name)
+    doc_count = database.info()["doc_count"]
+    security = database.get_security()
+
+    # Keep full copies of the design documents including their attachments.
+    design_docs = []
+    for design_doc in database.all_docs(startkey="_design", endkey="_design0"):
+        doc = database.get(design_doc["id"], attachments=True)
+        del doc["_rev"]
+        design_docs.append(doc)
+
+    server.delete_db(database_name)
+    forget_database(database_name)
+    remove_index(database_name)
+    database = get_database(database_name)
 
-        # Mark each document as deleted.
-        doc["doc"]["_deleted"] = True
-        docs.append(doc["doc"])
+    if design_docs:
+        database.bulk_save(design_docs)
 
-        # If we've reached the maximum number of docs to store before a save,
-        # save and reset the docs list.
-        if len(docs) == documents_per_delete:
-            database.bulk_save(docs)
-            docs = []
-            documents_deleted += documents_per_delete
+    if security:
+        database.set_security(security)
 
-    if len(docs) > 0:
-        # Save all documents appended since the last save.
-        database.bulk_save(docs)
-        documents_deleted += len(docs)
+    return doc_count - len(design_docs)
 
-    return documents_deleted
+
+def report_validation(request, progress):
+    """
+    Adds a message with the outcome of checking data without saving it.
+    """
+    if progress["num_errors"]:
+        messages.error(request, "There was a problem with one or more rows in your data. Nothing has been saved.")
+    else:
+        messages.success(request, "No problems were found in your data. Nothing has been saved.")
 
 
 @login_required
 def database(request, database_name):
-    server = Server(settings.COUCHDB_SERVER)
+    server = get_server()
 
     if request.GET.get("empty") and request.POST.get("confirmation"):
-        documents_deleted = empty_database(server, database_name)
+        if request.POST.get("recreate"):
+            documents_deleted = recreate_database(database_name)
+        else:
+            documents_deleted = empty_database(database_name)
         messages.success(
             request,
             "Database '%s' has been emptied of %i documents." % (database_name, documents_deleted)
@@ -87,11 +250,13 @@ def database(request, database_name):
 
     if request.GET.get("delete") and request.POST.get("confirmation"):
         server.delete_db(database_name)
+        forget_database(database_name)
+        remove_index(database_name)
         messages.success(request, "Database '%s' has been deleted." % database_name)
         return HttpResponseRedirect(reverse("cushion_index"))
 
     context = {}
-    database = server.get_or_create_db(database_name)
+    database = get_database(database_name)
 
     if request.GET.get("add"):
         context["add_forms"] = form_registry
@@ -128,37 +293,117 @@ def database(request, database_name):
             context["add_form"] = add_form
 
     if request.GET.get("compact"):
-        database.compact()
-        messages.success(request, "Database '%s' has been compacted." % database_name)
+        compact(database)
+        messages.success(request, "Compaction of database '%s' and its views has started." % database_name)
         return HttpResponseRedirect(reverse("cushion_database", args=(database_name,)))
 
-    form = ImportDataForm(request.POST or None, request.FILES or None)
-    if form.is_valid():
-        errors = form.import_data(database, request.FILES["file"])
+    if request.GET.get("import_job") and request.POST.get("resume"):
+        job_id = request.GET.get("import_job")
+        if resume_import(job_id, database):
+            messages.info(request, "Your data import has been resumed from its last saved batch.")
+        else:
+            messages.error(request, "The import job could not be resumed.")
+
+        return HttpResponseRedirect("%s?import_job=%s" % (
+            reverse("cushion_database", args=(database_name,)),
+            job_id
+        ))
+
+    # Attach the files in an uploaded archive to documents.
+    attaching = bool(request.GET.get("attach"))
+    attach_form = AttachArchiveForm(
+        attaching and request.POST or None,
+        attaching and request.FILES or None
+    )
+    if attach_form.is_valid():
+        if attach_form.cleaned_data["background"]:
+            job_id = submit_import(attach_form, database, request.FILES["file"])
+            messages.info(request, "Your files are being attached in the background.")
+            return HttpResponseRedirect("%s?import_job=%s" % (
+                reverse("cushion_database", args=(database_name,)),
+                job_id
+            ))
+
+        errors = attach_form.import_data(database, request.FILES["file"])
         if len(errors) > 0:
+            messages.error(request, "One or more files could not be attached.")
+            context["errors"] = errors
+            context["error_subject"] = "file"
+        else:
+            messages.success(request, "Your files were attached successfully.")
+            return HttpResponseRedirect(reverse("cushion_database", args=(database_name,)))
+
+    form = ImportDataForm(
+        not attaching and request.POST or None,
+        not attaching and request.FILES or None
+    )
+    if form.is_valid():
+        if form.cleaned_data["background"]:
+            job_id = submit_import(form, database, request.FILES["file"])
+            messages.info(request, "Your data is being imported in the background.")
+            return HttpResponseRedirect("%s?import_job=%s" % (
+                reverse("cushion_database", args=(database_name,)),
+                job_id
+            ))
+
+        progress = ImportProgress()
+        errors = form.import_data(database, request.FILES["file"], progress)
+        if progress.validate_only:
+            context["validation"] = progress.as_dict()
+            context["validation"]["errors"] = errors
+            report_validation(request, context["validation"])
+        elif len(errors) > 0:
             messages.error(request, "There was a problem with one or more rows in your data. Please correct these rows and try uploading again.")
             context["errors"] = errors
         else:
             messages.success(request, "Your data was imported successfully.")
             return HttpResponseRedirect(reverse("cushion_database", args=(database_name,)))
 
-    # Fetch all documents defining a key range that includes only design
-    # documents.
-    views_by_design_doc = {}
-    for design_doc in database.all_docs(startkey="_design", endkey="_design0"):
-        doc = database.get(design_doc["id"])
-        if "views" in doc:
-            # Convert "_design/mydesigndoc" to "mydesigndoc".
-            design_doc_name = design_doc["id"].split("/")[1]
-            views_by_design_doc[design_doc_name] = sorted(doc["views"].keys())
+    # Report on the background import job started by this page, if any.
+    if request.GET.get("import_job"):
+        import_progress = get_progress(request.GET.get("import_job"))
+        if import_progress is None:
+            messages.error(request, "The import job could not be found.")
+        elif import_progress.get("kind") == "attach":
+            if import_progress["status"] == "failed":
+                messages.error(request, "Your files could not be attached.")
+            elif import_progress["status"] == "done":
+                if import_progress["errors"]:
+                    messages.error(request, "One or more files could not be attached.")
+                    context["errors"] = import_progress["errors"]
+                    context["error_subject"] = "file"
+                else:
+                    messages.success(request, "Your files were attached successfully.")
+        elif import_progress["status"] == "failed":
+            messages.error(request, "Your data could not be imported.")
+        elif import_progress["status"] == "done" and import_progress.get("validate_only"):
+            context["validation"] = import_progress
+            report_validation(request, import_progress)
+        elif import_progress["status"] == "done":
+            if import_progress["errors"]:
+                messages.error(request, "There was a problem with one or more rows in your data. Please correct these rows and try uploading again.")
+                context["errors"] = import_progress["errors"]
+            else:
+                messages.success(request, "Your data was imported successfully.")
+
+        context["import_progress"] = import_progress
+
+    info, views, tasks = concurrently([
+        database.info,
+        functools.partial(views_by_design_doc, database),
+        functools.partial(visible_compaction_tasks, server, database_name)
+    ])
 
     context.update({
         "title": "Database: %s" % database_name,
         "server": server,
-        "database_info": database.info(),
+        "database_info": info,
         "database_name": database.dbname,
-        "views_by_design_doc": views_by_design_doc,
+        "views_by_design_doc": views,
+        "fragmentation": fragmentation(info),
+        "compaction_tasks": tasks,
         "form": form,
+        "attach_form": attach_form,
         "confirm_empty": request.GET.get("empty"),
         "confirm_delete": request.GET.get("delete")
     })
@@ -168,15 +413,308 @@ def database(request, database_name):
                               context_instance=RequestContext(request))
 
 
+@login_required
+def import_progress(request, database_name, job_id):
+    """
+    Returns the progress of a background import job as JSON.
+    """
+    progress = get_progress(job_id)
+    if progress is None:
+        raise Http404
+
+    progress = dict(progress)
+    progress.pop("errors", None)
+
+    return HttpResponse(simplejson.dumps(progress), mimetype="application/json")
+
+
+@login_required
+def compaction_progress(request, database_name):
+    """
+    Returns the running compactions of a database as JSON.
+    """
+    tasks = visible_compaction_tasks(get_server(), database_name)
+    return HttpResponse(simplejson.dumps(tasks), mimetype="application/json")
+
+
+def stream_body(body, chunk_size=ATTACHMENT_CHUNK_SIZE):
+    """
+    Yields the given response body from CouchDB in chunks of up to the given
+    number of bytes and releases its connection when done or abandoned.
+    """
+    try:
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+
+            yield chunk
+    finally:
+        body.close()
+
+
+@login_required
+def attachment(request, database_name, document_id, attachment_name):
+    """
+    Streams an attachment of a document from CouchDB to the browser without
+    reading it into memory. Ranges and ETags are passed between the browser
+    and CouchDB, so downloads can be resumed and cached.
+    """
+    database = get_database(database_name)
+
+    headers = {"Accept": "*/*"}
+    for meta_name, header in ATTACHMENT_REQUEST_HEADERS:
+        if meta_name in request.META:
+            headers[header] = request.META[meta_name]
+
+    try:
+        couchdb_response = database.res(escape_docid(document_id)).get(
+            url_quote(attachment_name, safe=""),
+            headers=headers
+        )
+    except ResourceNotFound:
+        raise Http404
+    except RequestFailed, e:
+        # Pass unsatisfiable ranges and other client errors to the browser.
+        if e.status_int is None or e.status_int >= 500:
+            raise
+
+        return HttpResponse(status=e.status_int)
+
+    if couchdb_response.status_int == 304:
+        couchdb_response.skip_body()
+        return HttpResponseNotModified()
+
+    response = HttpResponse(
+        stream_body(couchdb_response.body_stream()),
+        content_type=couchdb_response.headers.get(
+            "content-type",
+            "application/octet-stream"
+        ),
+        status=couchdb_response.status_int
+    )
+    for header in ATTACHMENT_RESPONSE_HEADERS:
+        value = couchdb_response.headers.get(header.lower())
+        if value is not None:
+            response[header] = value
+
+    return response
+
+
+def change_rows(database_name, results):
+    """
+    Adds the URL of the document page to each of the given changes that
+    didn't delete its document.
+    """
+    for change in results:
+        if not change.get("deleted"):
+            change["url"] = reverse("cushion_document",
+                                    args=(database_name, change["id"]))
+
+    return results
+
+
+@login_required
+def changes(request, database_name):
+    """
+    Lists the changes to a database after the ``since`` sequence, or the most
+    recent changes if no sequence is given, newest first. The page keeps the
+    last sequence it has shown and asks ``changes_feed`` for the changes after
+    it, so new changes are added to the page as they happen.
+    """
+    database = get_database(database_name)
+    limit = int(request.GET.get("limit", CHANGES_LIMIT))
+    since = request.GET.get("since")
+
+    if since is None:
+        # Read the update sequence before the changes so no change made in
+        # between is missed when watching for new changes.
+        last_seq = database.info()["update_seq"]
+        feed = database.res.get("_changes", descending="true",
+                                limit=limit).json_body
+        results = feed["results"]
+        has_newer = False
+    else:
+        feed = database.res.get("_changes", since=since,
+                                limit=limit).json_body
+        results = feed["results"]
+        results.reverse()
+        last_seq = feed["last_seq"]
+        has_newer = len(results) == limit
+
+    context = {
+        "title": "Changes",
+        "database_name": database_name,
+        "changes": change_rows(database_name, results),
+        "since": since,
+        "last_seq": last_seq,
+        "last_seq_json": simplejson.dumps(last_seq),
+        "has_newer": has_newer,
+        "limit": limit
+    }
+    return render_to_response("cushion/changes.html", context,
+                              context_instance=RequestContext(request))
+
+
+@login_required
+def changes_feed(request, database_name):
+    """
+    Returns the changes to a database after the ``since`` sequence as JSON,
+    waiting up to ``CHANGES_TIMEOUT`` seconds for a change if there are none
+    yet.
+    """
+    database = get_database(database_name)
+    feed = database.res.get(
+        "_changes",
+        feed="longpoll",
+        since=request.GET.get("since", "0"),
+        limit=CHANGES_LIMIT,
+        timeout=CHANGES_TIMEOUT * 1000
+    ).json_body
+
+    feed = {
+        "last_seq": feed["last_seq"],
+        "results": change_rows(database_name, feed["results"])
+    }
+    return HttpResponse(simplejson.dumps(feed), mimetype="application/json")
+
+
+@login_required
+def search(request, database_name):
+    """
+    Searches the local index of a database for documents with the given words
+    in one or any of the indexed fields. The index is brought up to date with
+    the changes made to the database since its last update first.
+    """
+    database = get_database(database_name)
+    indexes = get_indexes()
+    form = SearchForm(indexes, request.GET or None)
+    context = {
+        "title": "Search",
+        "database_name": database_name,
+        "form": form
+    }
+
+    if form.is_valid():
+        start = time.time()
+        index = LocalIndex(database_name, indexes)
+        context["num_changes"] = index.update(database)
+        context["update_time"] = time.time() - start
+
+        start = time.time()
+        context["results"] = index.search(
+            form.cleaned_data["doc_type"],
+            form.cleaned_data["query"],
+            form.cleaned_data["field"] or None,
+            form.cleaned_data["prefix"]
+        )
+        context["search_time"] = time.time() - start
+
+    return render_to_response("cushion/search.html", context,
+                              context_instance=RequestContext(request))
+
+
+def parse_key(value):
+    """
+    Returns the JSON value of the given view key string or the string itself if
+    it isn't valid JSON.
+    """
+    try:
+        return simplejson.loads(value)
+    except ValueError:
+        return value
+
+
+def row_position(row):
+    """
+    Returns the JSON-encoded key and document id of the given view row to page
+    from.
+    """
+    return simplejson.dumps([row["key"], row.get("id")])
+
+
+def keyset_page(database, view_path, params, limit, start=None,
+                include_start=False, backward=False):
+    """
+    Returns the rows of one page of the given view, the view's total number of
+    rows, whether there are more rows after the page in the direction of
+    paging, and the ETag of the view results.
+
+    Pages start at the given tuple of a key and document id, if any, rather
+    than after a number of skipped rows, so every page costs the same no
+    matter how deep into the view it is. The row at the start is left out of
+    the page unless requested. Pages read backward are returned in the view's
+    order.
+    """
+    params = dict(params)
+    descending = params.pop("descending", "false") == "true"
+
+    if backward:
+        descending = not descending
+
+        # The start of the view ends a page read backward.
+        params.pop("endkey", None)
+        params.pop("endkey_docid", None)
+        if "startkey" in params:
+            params["endkey"] = params.pop("startkey")
+        if "startkey_docid" in params:
+            params["endkey_docid"] = params.pop("startkey_docid")
+
+    if start is not None:
+        params["startkey"] = start[0]
+        if start[1] is not None:
+            params["startkey_docid"] = start[1]
+
+        if not include_start:
+            params["skip"] = 1
+
+    results = cached_view(
+        database,
+        view_path,
+        limit=limit + 1,
+        descending=descending,
+        **params
+    )
+    rows = list(results)
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    if backward:
+        rows.reverse()
+
+    return rows, results.total_rows, more, results.etag
+
+
+def page_etag(request, view_etag):
+    """
+    Returns an ETag for the page showing view results with the given ETag to
+    the requesting user, or None if the page can't be validated with one.
+    """
+    if not view_etag or len(messages.get_messages(request)):
+        return None
+
+    return '"%s"' % hashlib.md5(
+        "\n".join([view_etag, str(request.user.pk), request.get_full_path()])
+    ).hexdigest()
+
+
 @login_required
 def view(request, database_name, view_name, design_doc_name=None):
-    server = Server(settings.COUCHDB_SERVER)
-    database = server.get_or_create_db(database_name)
+    database = get_database(database_name)
 
     get_data = dict([(str(key), value) for key, value in request.GET.items()])
+    keyset = get_data.pop("paging", None) == "keyset"
+    after = get_data.pop("after", None)
+    before = get_data.pop("before", None)
+    jump = get_data.pop("jump", None)
+    last = get_data.pop("last", None)
     skip = int(get_data.pop("skip", "0"))
     limit = int(get_data.pop("limit", "10"))
-    page = skip / limit + 1
+
+    if keyset:
+        page = None
+    else:
+        page = skip / limit + 1
 
     request.session["last_couchdb_view"] = {
         "name": view_name,
@@ -189,25 +727,68 @@ def view(request, database_name, view_name, design_doc_name=None):
     else:
         view_path = view_name
 
-    documents_list = database.view(
-        view_path,
-        limit=limit,
-        skip=skip,
-        **get_data
-    )
+    if keyset:
+        # Page forward from the last row of the previous page, backward from
+        # the first row of the next page, or from either end of the view.
+        # Jumping to a key starts the page at the first row with a key greater
+        # than or equal to the given key.
+        if before:
+            documents, total_rows, more, etag = keyset_page(
+                database, view_path, get_data, limit,
+                start=simplejson.loads(before),
+                backward=True
+            )
+            has_previous, has_next = more, True
+        elif last:
+            documents, total_rows, more, etag = keyset_page(
+                database, view_path, get_data, limit,
+                backward=True
+            )
+            has_previous, has_next = more, False
+        else:
+            if after:
+                start = simplejson.loads(after)
+            elif jump:
+                start = (parse_key(jump), None)
+            else:
+                start = None
+
+            documents, total_rows, more, etag = keyset_page(
+                database, view_path, get_data, limit,
+                start=start,
+                include_start=bool(jump and not after)
+            )
+            has_previous, has_next = bool(after or jump), more
+
+        num_pages = int(math.ceil(total_rows / float(limit)))
+        last_page = None
+        previous_page = next_page = None
+        if documents and has_previous:
+            previous_page = row_position(documents[0])
+        if documents and has_next:
+            next_page = row_position(documents[-1])
+    else:
+        documents_list = cached_view(
+            database,
+            view_path,
+            limit=limit,
+            skip=skip,
+            **get_data
+        )
 
-    num_pages = int(math.ceil(documents_list.total_rows / float(limit)))
-    last_page = (num_pages - 1) * limit
+        etag = documents_list.etag
+        num_pages = int(math.ceil(documents_list.total_rows / float(limit)))
+        last_page = (num_pages - 1) * limit
 
-    if page > 1:
-        previous_page = skip - limit
-    else:
-        previous_page = None
+        if page > 1:
+            previous_page = skip - limit
+        else:
+            previous_page = None
 
-    if page < num_pages:
-        next_page = skip + limit
-    else:
-        next_page = None
+        if page < num_pages:
+            next_page = skip + limit
+        else:
+            next_page = None
 
     # Find out if a form is registered with for this view and load the form if
     # it exists.
@@ -231,32 +812,105 @@ def view(request, database_name, view_name, design_doc_name=None):
     else:
         form = None
 
-    documents = list(documents_list)
+    if not keyset:
+        documents = list(documents_list)
+
+    # Let the browser reuse its copy of this page while the view results are
+    # unchanged, unless the page has a form or messages to show.
+    if form is None and request.method == "GET":
+        etag = page_etag(request, etag)
+    else:
+        etag = None
+
+    if etag and request.META.get("HTTP_IF_NONE_MATCH") == etag:
+        return HttpResponseNotModified()
+
     get_data["limit"] = limit
     query_string = urllib.urlencode(get_data)
 
-    return render_to_response("cushion/view.html",
-                              {"title": "View: %s" % view_name,
-                               "database_name": database_name,
-                               "view": view_name,
-                               "design_doc_name": design_doc_name,
-                               "documents": documents,
-                               "form": form,
-                               "num_pages": num_pages,
-                               "page": page,
-                               "previous_page": previous_page,
-                               "next_page": next_page,
-                               "last_page": last_page,
-                               "limit": limit,
-                               "query_string": query_string,
-                               "key": get_data.get("key")},
-                              context_instance=RequestContext(request))
+    context = {
+        "title": "View: %s" % view_name,
+        "database_name": database_name,
+        "view": view_name,
+        "design_doc_name": design_doc_name,
+        "documents": documents,
+        "form": form,
+        "num_pages": num_pages,
+        "page": page,
+        "previous_page": previous_page,
+        "next_page": next_page,
+        "last_page": last_page,
+        "limit": limit,
+        "query_string": query_string,
+        "keyset": keyset,
+        "jump": jump,
+        "export_models": sorted(registered_models.keys()),
+        "query_params": sorted(get_data.items()),
+        "key": get_data.get("key")
+    }
+    response = render_to_response("cushion/view.html", context,
+                                  context_instance=RequestContext(request))
+    if etag:
+        response["ETag"] = etag
+
+    return response
+
+
+@login_required
+def export(request, database_name, view_name, format, design_doc_name=None):
+    """
+    Streams every row of a view as CSV or newline-delimited JSON. Query
+    parameters other than paging parameters are passed on to the view. CSV
+    exports use the properties of the registered model named by the ``model``
+    parameter, if any, as columns for the documents of the rows.
+
+    Django 1.3 has no ``StreamingHttpResponse``, so the rows are streamed by
+    giving ``HttpResponse`` a generator.
+    """
+    database = get_database(database_name)
+
+    params = dict([(str(key), value) for key, value in request.GET.items()])
+    for name in ("paging", "after", "before", "jump", "last", "skip", "limit"):
+        params.pop(name, None)
+
+    model_name = params.pop("model", None)
+    if model_name:
+        if format != "csv" or model_name not in registered_models:
+            raise Http404
+
+        params["include_docs"] = "true"
+
+    if design_doc_name:
+        view_path = "%s/%s" % (design_doc_name, view_name)
+    else:
+        view_path = view_name
+
+    # Read the first row before responding so a missing view gets an error
+    # page rather than an empty download.
+    rows = view_rows(database, view_path, params)
+    try:
+        first_rows = list(itertools.islice(rows, 1))
+    except ResourceNotFound:
+        raise Http404
+
+    rows = itertools.chain(first_rows, rows)
+    if format == "csv":
+        content = export_csv(rows, model_name)
+    else:
+        content = export_ndjson(rows)
+
+    response = HttpResponse(content, content_type=CONTENT_TYPES[format])
+    response["Content-Disposition"] = 'attachment; filename="%s-%s.%s"' % (
+        database_name,
+        view_path.replace("/", "-"),
+        format
+    )
+    return response
 
 
 @login_required
 def document(request, database_name, document_id, view_name=None):
-    server = Server(settings.COUCHDB_SERVER)
-    database = server.get_or_create_db(database_name)
+    database = get_database(database_name)
     document = database.get(document_id)
 
     # Delete this document.
@@ -288,8 +942,16 @@ def document(request, database_name, document_id, view_name=None):
     # Attach an uploaded file.
     attach_form = AttachFileForm(request.POST or None, request.FILES or None)
     if attach_form.is_valid():
+        # Stream the uploaded file to CouchDB from wherever Django stored it
+        # rather than reading it into memory.
         file = request.FILES["file"]
-        database.put_attachment(document, file.read(), file.name)
+        database.put_attachment(
+            document,
+            file,
+            file.name,
+            content_type=file.content_type,
+            content_length=file.size
+        )
         messages.success(
             request,
             "Attachment '%s' has been added to document '%s'." % (file.name, document_id)
@@ -318,7 +980,6 @@ def document(request, database_name, document_id, view_name=None):
 
     context = {
         "title": "Document: %s" % document_id,
-        "couchdb_server": settings.COUCHDB_SERVER,
         "database_name": database_name,
         "view_name": view_name,
         "document_id": document_id,